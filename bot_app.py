@@ -0,0 +1,176 @@
+import os
+import sys
+import logging
+import asyncio
+import secrets
+import signal
+from typing import Set
+from dotenv import load_dotenv
+from aiogram import Bot, Dispatcher
+from aiogram.enums import ParseMode
+from aiogram.types import CallbackQuery
+from aiogram.client.default import DefaultBotProperties
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import web
+
+from config import config
+from handlers.base import router as base_router
+from handlers.new_generation import router as generation_router, make_recovery_handler
+from services.integration import integration_service
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+
+async def on_startup(bot: Bot, dispatcher: Dispatcher):
+    """Действия при запуске бота"""
+    logger.info("====== Starting bot ======")
+    
+    try:
+        # Результаты задач, прерванных перезапуском, отправляются напрямую в чат
+        integration_service.set_recovery_handler(make_recovery_handler(bot))
+        await integration_service.initialize()
+        logger.info("Successfully initialized integration service")
+    except Exception as e:
+        logger.error(f"Failed to initialize integration service: {str(e)}", exc_info=True)
+        sys.exit(1)
+    
+    logger.info("==========================")
+    logger.info("Starting bot")
+
+async def on_shutdown(bot: Bot, dispatcher: Dispatcher):
+    """Действия при завершении работы бота"""
+    logger.info("====== Shutting down bot ======")
+    
+    try:
+        await integration_service.shutdown()
+        logger.info("Successfully shut down integration service")
+    except Exception as e:
+        logger.error(f"Error during shutdown: {str(e)}", exc_info=True)
+    
+    # Закрываем сессию бота
+    await bot.session.close()
+    
+    logger.info("==========================")
+
+async def setup_bot() -> tuple[Bot, Dispatcher]:
+    """Настройка бота и диспетчера"""
+    bot = Bot(
+        token=config.tg_bot.token,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+    dp = Dispatcher()
+    
+    # Регистрация хэндлеров
+    dp.include_router(base_router)
+    dp.include_router(generation_router)
+    
+    # Регистрация обработчиков запуска и завершения
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    
+    return bot, dp
+
+async def wait_for_stop_signal():
+    """Ожидает SIGINT или SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    await stop_event.wait()
+
+async def run_worker():
+    """Процесс-воркер: выполняет генерации из канала заданий без Telegram"""
+    logger.info("====== Starting worker ======")
+    await integration_service.initialize()
+    await wait_for_stop_signal()
+    logger.info("====== Shutting down worker ======")
+    await integration_service.shutdown()
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Прием апдейтов через webhook на aiohttp-сервере"""
+    # Без заданного секрета генерируем свой: Telegram получит его в set_webhook
+    secret_token = config.tg_bot.webhook_secret or secrets.token_urlsafe(32)
+    host = config.tg_bot.webhook_host.rstrip('/')
+    if "://" not in host:
+        # WEBHOOK_HOST обычно задан без схемы, Telegram принимает только https
+        host = f"https://{host}"
+    webhook_url = f"{host}{config.tg_bot.webhook_path}"
+
+    async def set_webhook(bot: Bot, dispatcher: Dispatcher):
+        await bot.set_webhook(
+            webhook_url,
+            secret_token=secret_token,
+            allowed_updates=dispatcher.resolve_used_update_types()
+        )
+        logger.info(f"Webhook set to {webhook_url}")
+
+    dp.startup.register(set_webhook)
+
+    # Апдейты, которые обрабатываются в фоне
+    updates: Set[asyncio.Task] = set()
+
+    async def process_update(update: dict):
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.error(f"Failed to process update: {e}", exc_info=True)
+
+    async def handle_update(request: web.Request) -> web.Response:
+        """Отвечает Telegram сразу, апдейт обрабатывается параллельно в фоне"""
+        received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(received, secret_token):
+            return web.Response(status=401)
+        task = asyncio.create_task(process_update(await request.json()))
+        updates.add(task)
+        task.add_done_callback(updates.discard)
+        return web.Response()
+
+    async def drain_updates(app: web.Application):
+        """Дожидается обработки уже принятых апдейтов"""
+        if not updates:
+            return
+        logger.info(f"Waiting for {len(updates)} updates in progress")
+        _, still_pending = await asyncio.wait(set(updates), timeout=config.tg_bot.drain_timeout)
+        if still_pending:
+            logger.warning(f"{len(still_pending)} updates were not processed before shutdown")
+
+    app = web.Application()
+    app.router.add_post(config.tg_bot.webhook_path, handle_update)
+    # Должен выполниться до остановки сервисов в обработчике shutdown диспетчера
+    app.on_shutdown.append(drain_updates)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host="0.0.0.0", port=config.tg_bot.port)
+    await site.start()
+    logger.info(f"Listening for webhook updates on port {config.tg_bot.port}")
+    try:
+        await wait_for_stop_signal()
+    finally:
+        # Сначала перестаем принимать запросы, затем дожидаемся обработки и останавливаем сервисы
+        await runner.cleanup()
+
+async def main():
+    """Основная функция запуска"""
+    # Загружаем переменные окружения из .env файла
+    load_dotenv()
+
+    if config.tg_bot.mode == "worker":
+        await run_worker()
+        return
+
+    bot, dp = await setup_bot()
+
+    if config.tg_bot.updates_mode == "webhook":
+        await run_webhook(bot, dp)
+        return
+    
+    # Удаляем webhook и запускаем polling
+    await bot.delete_webhook(drop_pending_updates=True)
+    await dp.start_polling(bot)
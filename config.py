@@ -5,10 +5,22 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Верхняя граница RUNNINGHUB_MAX_JOBS_n; фактический лимит подбирается адаптивно
+MAX_JOBS_LIMIT = 20
+
+# Режимы процесса: все в одном процессе, только Telegram или только генерации
+BOT_MODES = ("all", "frontend", "worker")
+
 @dataclass
 class TgBot:
     token: str
     webhook_host: str = None
+    mode: str = "all"  # Режим процесса: all, frontend или worker
+    updates_mode: str = "polling"  # Получение апдейтов: polling или webhook
+    webhook_path: str = "/webhook"  # Путь, на который Telegram присылает апдейты
+    webhook_secret: str = ""  # Секрет заголовка X-Telegram-Bot-Api-Secret-Token
+    port: int = 8080  # Порт HTTP-сервера в режиме webhook
+    drain_timeout: float = 30.0  # Сколько ждать обработки принятых апдейтов при остановке
 
 @dataclass
 class RunningHubAccount:
@@ -25,6 +37,67 @@ class RunningHub:
     max_retries: int = 3  # Максимальное количество попыток для HTTP запросов
     max_tasks: int = 5  # Максимальное количество одновременных задач на аккаунт
     polling_interval: int = 5  # Интервал проверки статуса задачи в секундах
+    min_poll_interval: float = 1.0  # Минимальный интервал опроса около ожидаемого завершения
+    max_poll_interval: float = 15.0  # Максимальный интервал опроса
+    expected_completion_time: float = 60.0  # Начальная оценка времени выполнения workflow
+    poll_rate_per_account: float = 2.0  # Лимит запросов статуса в секунду на аккаунт
+    poll_concurrency: int = 20  # Количество одновременных запросов статуса
+    scheduler_policy: str = "least_loaded"  # least_loaded, weighted_round_robin или latency_weighted
+    adaptive_limits: bool = True  # Адаптивный (AIMD) лимит задач на аккаунт
+    min_tasks: int = 1  # Минимальный адаптивный лимит
+    aimd_increase: float = 1.0  # Аддитивное увеличение лимита
+    aimd_decrease_factor: float = 0.5  # Мультипликативное уменьшение лимита
+    aimd_cooldown: float = 10.0  # Минимальный интервал между уменьшениями лимита в секундах
+    latency_spike_factor: float = 2.0  # Во сколько раз задержка должна превысить среднюю для уменьшения лимита
+    upload_cache_size: int = 10000  # Максимальное количество записей в кэше загрузок
+    upload_cache_ttl: int = 86400  # Время жизни записи кэша загрузок в секундах
+    upload_cache_path: str = ""  # Путь к SQLite для кэша загрузок (пусто - только память)
+    image_max_side: int = 2048  # Длинная сторона фото перед загрузкой (0 - без нормализации)
+    image_jpeg_quality: int = 90  # Качество JPEG при пережатии
+    image_max_bytes: int = 10 * 1024 * 1024  # Фото больше этого размера пережимаются всегда (лимит RunningHub)
+    image_workers: int = 2  # Процессов для подготовки фото
+    near_duplicate_backgrounds: bool = True  # Считать почти одинаковые фоны одним изображением
+    near_duplicate_distance: int = 3  # Максимальное расстояние Хэмминга между dHash почти одинаковых фонов
+    near_duplicate_index_size: int = 100000  # Максимум фонов в индексе перцептивных хэшей
+    spool_path: str = "temp/spool"  # Каталог для фото, ожидающих второго шага сценария
+    spool_ttl: int = 3600  # Через сколько секунд без обращений фото удаляется
+    spool_max_mb: int = 2048  # Максимальный размер каталога фото в мегабайтах (0 - без ограничения)
+    spool_sweep_interval: int = 60  # Период очистки каталога фото в секундах
+    preupload_ttl: int = 600  # Через сколько секунд снимать резерв неиспользованной предзагрузки
+    result_cache_path: str = ""  # Каталог кэша готовых результатов (пусто - без кэша)
+    result_cache_max_mb: int = 1024  # Максимальный размер кэша результатов в мегабайтах
+    task_store_path: str = ""  # Путь к SQLite-журналу задач для восстановления после перезапуска
+    task_store_flush_interval: float = 0.2  # Период пакетной записи журнала задач в секундах
+    slot_ledger_path: str = ""  # SQLite-файл общего учета слотов для нескольких процессов
+    slot_lease_ttl: float = 60.0  # Через сколько секунд истекает непродленная аренда слота
+    slot_ledger_poll_interval: float = 0.5  # Интервал повторной попытки занять слот в общем учете
+    job_channel_path: str = ""  # SQLite-файл канала заданий между frontend и воркерами
+    job_poll_interval: float = 0.2  # Интервал опроса канала заданий в секундах
+    job_claim_ttl: float = 120.0  # Через сколько секунд задание упавшего воркера возвращается в очередь
+    max_queue_depth: int = 200  # Максимум задач, ожидающих отправки (0 - без ограничения)
+    max_user_tasks: int = 3  # Максимум незавершенных задач одного пользователя (0 - без ограничения)
+    dedup_requests: bool = True  # Одинаковые запросы присоединяются к уже выполняющейся задаче
+    batch_max_products: int = 10  # Максимум фото продуктов в пакете (альбоме Telegram)
+    hedging: bool = False  # Дублировать задачи, застрявшие в очереди RunningHub, на другом аккаунте
+    hedge_quantile: float = 0.9  # Квантиль обычного ожидания в очереди, после которого задача дублируется
+    hedge_min_delay: float = 15.0  # Минимальная задержка перед дублированием в секундах
+    hedge_ratio: float = 0.1  # Доля задач, которые можно дублировать (ограничивает расход монет)
+    paid_user_ids: frozenset = frozenset()  # Telegram ID пользователей платной полосы
+    paid_lane_weight: float = 3.0  # Доля платной полосы при выдаче задач
+    standard_lane_weight: float = 1.0  # Доля обычной полосы при выдаче задач
+    seed_node_id: str = ""  # ID ноды workflow с полем seed (пусто - seed не передается)
+    http_pool_size: int = 100  # Общий лимит соединений HTTP-клиента
+    http_pool_size_per_host: int = 50  # Лимит соединений на один хост
+    http_keepalive_timeout: float = 60.0  # Время жизни простаивающего keep-alive соединения
+    http_dns_cache_ttl: int = 300  # Время кэширования DNS в секундах
+    http_connect_timeout: float = 10.0  # Таймаут установки соединения
+    http_timeout: float = 30.0  # Таймаут обычного запроса к API
+    http_poll_timeout: float = 15.0  # Таймаут запроса статуса задачи
+    http_upload_timeout: float = 120.0  # Таймаут загрузки изображения
+    upload_concurrency: int = 4  # Количество одновременных загрузок изображений
+    deliver_concurrency: int = 4  # Количество одновременных отправок результатов
+    stage_queue_size: int = 100  # Размер очереди каждой стадии конвейера
+    stats_log_interval: int = 60  # Интервал вывода метрик стадий в лог (0 - отключено)
 
 @dataclass
 class Config:
@@ -77,7 +150,7 @@ def load_config() -> Config:
 
         try:
             max_jobs = int(getenv(f"RUNNINGHUB_MAX_JOBS_{account_index}", "5"))
-            if max_jobs <= 0 or max_jobs > 5:
+            if max_jobs <= 0 or max_jobs > MAX_JOBS_LIMIT:
                 logger.warning(f"Invalid max_jobs value for account {account_index}, using default: 5")
                 max_jobs = 5
         except ValueError:
@@ -106,12 +179,55 @@ def load_config() -> Config:
         raise ValueError(error_msg)
 
     logger.info(f"Successfully loaded {len(accounts)} RunningHub account(s)")
+
+    mode = getenv("BOT_MODE", "all").lower()
+    if mode not in BOT_MODES:
+        raise ValueError(f"BOT_MODE must be one of {', '.join(BOT_MODES)}, got {mode}")
+    job_channel_path = getenv("JOB_CHANNEL_PATH", "")
+    if mode != "all" and not job_channel_path:
+        raise ValueError(f"JOB_CHANNEL_PATH is required for BOT_MODE={mode}")
     return Config(
         tg_bot=TgBot(
             token=getenv("BOT_TOKEN"),
-            webhook_host=getenv("WEBHOOK_HOST")
+            webhook_host=getenv("WEBHOOK_HOST"),
+            mode=mode,
+            updates_mode=getenv("UPDATES_MODE", "polling").lower(),
+            webhook_path=getenv("WEBHOOK_PATH", "/webhook"),
+            webhook_secret=getenv("WEBHOOK_SECRET", ""),
+            port=int(getenv("PORT", "8080"))
         ),
-        runninghub=RunningHub(accounts=accounts)
+        runninghub=RunningHub(
+            accounts=accounts,
+            scheduler_policy=getenv("RUNNINGHUB_SCHEDULER", "least_loaded"),
+            adaptive_limits=getenv("RUNNINGHUB_ADAPTIVE_LIMITS", "true").lower() == "true",
+            upload_cache_path=getenv("UPLOAD_CACHE_PATH", ""),
+            image_max_side=int(getenv("IMAGE_MAX_SIDE", "2048")),
+            image_jpeg_quality=int(getenv("IMAGE_JPEG_QUALITY", "90")),
+            image_workers=int(getenv("IMAGE_WORKERS", "2")),
+            near_duplicate_backgrounds=getenv("NEAR_DUPLICATE_BACKGROUNDS", "true").lower() == "true",
+            near_duplicate_distance=int(getenv("NEAR_DUPLICATE_DISTANCE", "3")),
+            near_duplicate_index_size=int(getenv("NEAR_DUPLICATE_INDEX_SIZE", "100000")),
+            spool_path=getenv("SPOOL_PATH", "temp/spool"),
+            spool_ttl=int(getenv("SPOOL_TTL", "3600")),
+            spool_max_mb=int(getenv("SPOOL_MAX_MB", "2048")),
+            result_cache_path=getenv("RESULT_CACHE_PATH", ""),
+            result_cache_max_mb=int(getenv("RESULT_CACHE_MAX_MB", "1024")),
+            task_store_path=getenv("TASK_STORE_PATH", ""),
+            slot_ledger_path=getenv("SLOT_LEDGER_PATH", ""),
+            job_channel_path=job_channel_path,
+            paid_user_ids=frozenset(
+                int(user_id) for user_id in getenv("PAID_USER_IDS", "").split(",") if user_id.strip()
+            ),
+            paid_lane_weight=float(getenv("PAID_LANE_WEIGHT", "3")),
+            max_queue_depth=int(getenv("MAX_QUEUE_DEPTH", "200")),
+            hedging=getenv("RUNNINGHUB_HEDGING", "false").lower() == "true",
+            hedge_quantile=float(getenv("RUNNINGHUB_HEDGE_QUANTILE", "0.9")),
+            hedge_ratio=float(getenv("RUNNINGHUB_HEDGE_RATIO", "0.1")),
+            max_user_tasks=int(getenv("MAX_USER_TASKS", "3")),
+            dedup_requests=getenv("DEDUP_REQUESTS", "true").lower() == "true",
+            batch_max_products=int(getenv("BATCH_MAX_PRODUCTS", "10")),
+            seed_node_id=getenv("WORKFLOW_NODE_PRODUCT_SEED", "")
+        )
     )
 
 config = load_config()
@@ -1,12 +1,22 @@
 import asyncio
+import functools
 import logging
+import os
+import uuid
+from typing import Dict, List, Optional, Tuple
 from aiogram import Bot, F, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, URLInputFile, CallbackQuery
+from aiogram.types import Message, URLInputFile, FSInputFile, CallbackQuery, InputMediaPhoto, PhotoSize
 
+from config import config
 from services.integration import integration_service
+from services.task_queue import AdmissionResult, REJECT_QUEUE_FULL, REJECT_USER_LIMIT
+from services.preupload import preuploader
+from services.result_cache import result_cache
+from services.spool import spool
 from keyboards import get_main_menu_keyboard, get_cancel_keyboard, get_result_keyboard
 from messages import (
     GENERATION_STARTED,
@@ -15,16 +25,93 @@ from messages import (
     SEND_BACKGROUND_PHOTO,
     PROCESSING_COMPLETE,
     PROCESSING_FAILED,
-    IN_QUEUE
+    IN_QUEUE,
+    QUEUE_FULL,
+    NO_ACCOUNTS,
+    USER_TASKS_LIMIT,
+    QUEUE_POSITION,
+    BATCH_PRODUCTS_RECEIVED,
+    BATCH_COMPLETE
 )
 
 router = Router()
 
+# Сколько ждать остальные сообщения альбома после первого, в секундах
+ALBUM_COLLECT_DELAY = 1.0
+# Максимум фото в одном альбоме Telegram
+ALBUM_SIZE = 10
+
+# Собираемые альбомы: (chat_id, media_group_id) -> сообщения
+_albums: Dict[Tuple[int, str], List[Message]] = {}
+
+def admission_message(admission: AdmissionResult) -> str:
+    """Ответ пользователю о приеме задачи в очередь"""
+    if admission.reason == REJECT_QUEUE_FULL:
+        return QUEUE_FULL
+    if admission.reason == REJECT_USER_LIMIT:
+        return USER_TASKS_LIMIT(config.runninghub.max_user_tasks)
+    if not admission:
+        return NO_ACCOUNTS
+    if admission.position is None or admission.eta is None:
+        return IN_QUEUE
+    return QUEUE_POSITION(admission.position, admission.eta)
+
+def failure_message(result: dict) -> str:
+    """Ответ о неудачной генерации; отказ воркера в приеме задачи - тем же текстом, что и сразу"""
+    if result.get("reason"):
+        return admission_message(AdmissionResult(accepted=False, reason=result["reason"]))
+    return PROCESSING_FAILED
+
 class GenerationStates(StatesGroup):
     waiting_for_product = State()
     waiting_for_background = State()
+    waiting_for_batch_background = State()
     processing = State()
 
+async def collect_album(message: Message) -> Optional[List[Message]]:
+    """Собирает сообщения альбома.
+
+    Telegram присылает каждое фото альбома отдельным сообщением. Первое
+    ждет остальные и возвращает весь альбом, для остальных возвращается None.
+    """
+    key = (message.chat.id, message.media_group_id)
+    album = _albums.get(key)
+    if album is not None:
+        album.append(message)
+        return None
+    _albums[key] = album = [message]
+    try:
+        await asyncio.sleep(ALBUM_COLLECT_DELAY)
+    finally:
+        del _albums[key]
+    return sorted(album, key=lambda item: item.message_id)
+
+class ResultBatch:
+    """Собирает результаты задач пакета и отдает их все вместе"""
+
+    def __init__(self, size: int, on_complete):
+        self.results: List[Optional[dict]] = [None] * size
+        self.pending = size
+        self.on_complete = on_complete
+
+    def callback(self, index: int):
+        """callback задачи с номером index"""
+        async def done(result: dict):
+            if self.results[index] is not None:
+                return
+            self.results[index] = result
+            self.pending -= 1
+            if self.pending == 0:
+                await self.on_complete(self.results)
+        return done
+
+async def download_photo(bot: Bot, photo: PhotoSize) -> str:
+    """Потоково скачивает фото во временный файл без блокировки event loop и возвращает его handle"""
+    file = await bot.get_file(photo.file_id)
+    handle, path = spool.allocate()
+    await bot.download_file(file.file_path, destination=path)
+    return handle
+
 @router.callback_query(F.data == "generate")
 async def start_generation(callback: CallbackQuery, state: FSMContext):
     """Начало процесса генерации"""
@@ -41,28 +128,46 @@ async def start_generation_command(message: Message, state: FSMContext):
 @router.message(F.photo, GenerationStates.waiting_for_product)
 async def process_product_photo(message: Message, state: FSMContext, bot: Bot):
     """Обработка фотографии продукта"""
+    if message.media_group_id:
+        await process_product_album(message, state, bot)
+        return
+
     photo = message.photo[-1]
-    file = await bot.get_file(photo.file_id)
-    # Сохраняем временный файл и получаем URL
-    temp_file_path = f"temp/product_{photo.file_id}.jpg"
-    file_data = await bot.download_file(file.file_path)
-    with open(temp_file_path, "wb") as f:
-        f.write(file_data.read())
-
-    if not temp_file_path:
-        raise ValueError("Temp file path is not defined")
-        
-    if not temp_file_path:
-        raise ValueError("Failed to generate product photo URL")
-        
-    # Сохраняем URL и ID в состоянии
+    product_photo_handle = await download_photo(bot, photo)
+
+    # Сохраняем путь и ID в состоянии
     await state.update_data(
-        product_photo_url=f"file://{temp_file_path}",
+        product_photo_url=spool.source(product_photo_handle),
+        product_photo_handle=product_photo_handle,
         product_photo_id=photo.file_id
     )
     await state.set_state(GenerationStates.waiting_for_background)
     await message.answer(SEND_BACKGROUND_PHOTO, reply_markup=get_cancel_keyboard())
 
+    # Загружаем фото продукта в RunningHub, пока пользователь выбирает фон.
+    # Результат хранит preuploader: его забирает обработчик фона через take()
+    preuploader.start(message.from_user.id, spool.source(product_photo_handle))
+
+async def process_product_album(message: Message, state: FSMContext, bot: Bot):
+    """Обработка альбома фотографий продуктов для пакетной генерации"""
+    album = await collect_album(message)
+    if album is None:
+        return
+
+    limit = config.runninghub.batch_max_products
+    photos = album[:limit]
+    # Все фото альбома скачиваются одновременно
+    handles = await asyncio.gather(*(download_photo(bot, item.photo[-1]) for item in photos))
+    await state.update_data(
+        batch_product_handles=list(handles),
+        batch_media_group=message.media_group_id
+    )
+    await state.set_state(GenerationStates.waiting_for_batch_background)
+    await message.answer(
+        BATCH_PRODUCTS_RECEIVED(len(handles), len(album) - len(photos)),
+        reply_markup=get_cancel_keyboard()
+    )
+
 @router.message(F.photo, GenerationStates.waiting_for_background)
 async def process_background_photo(message: Message, state: FSMContext, bot: Bot):
     """Обработка фонового изображения и запуск генерации"""
@@ -71,44 +176,245 @@ async def process_background_photo(message: Message, state: FSMContext, bot: Bot
     if not product_photo_url:
         raise ValueError("Product photo URL is not defined")
 
-    background_photo = message.photo[-1]
-    background_file = await bot.get_file(background_photo.file_id)
-    # Сохраняем временный файл и получаем URL
-    temp_file_path = f"temp/background_{background_photo.file_id}.jpg"
-    file_data = await bot.download_file(background_file.file_path)
-    with open(temp_file_path, "wb") as f:
-        f.write(file_data.read())
-
-    background_url = f"file://{temp_file_path}"
+    background_url = spool.source(await download_photo(bot, message.photo[-1]))
 
     try:
+        # Фото продукта, загруженное заранее, и его аккаунт
+        preupload = await preuploader.take(message.from_user.id)
+
         # Добавляем задачу в очередь через IntegrationService
-        await integration_service.add_generation_task(
+        admission = await integration_service.add_generation_task(
             product_image_url=product_photo_url,
             background_image_url=background_url,
-            callback=lambda result: handle_generation_result(result, message, state)
+            callback=lambda result: handle_generation_result(
+                result, message, state, product_photo_url, background_url
+            ),
+            api_key=preupload.api_key if preupload else None,
+            product_file=preupload.file_name if preupload else None,
+            context={"chat_id": message.chat.id, "user_id": message.from_user.id}
         )
 
+        if not admission:
+            # Отказ сразу, пока пользователь не ждет результата
+            await message.answer(admission_message(admission), reply_markup=get_main_menu_keyboard())
+            await state.clear()
+            return
+        if admission.cached:
+            # Такой результат уже есть - он придет сразу
+            return
+
         await message.answer(GENERATION_STARTED, reply_markup=get_cancel_keyboard())
-        await message.answer(IN_QUEUE)
+        await message.answer(admission_message(admission))
     except Exception as e:
         logging.error(f"Generation error: {str(e)}")
         await message.answer(GENERATION_FAILED)
         await state.clear()
 
-async def handle_generation_result(result: dict, message: Message, state: FSMContext):
+@router.message(F.photo, GenerationStates.waiting_for_batch_background)
+async def process_batch_background(message: Message, state: FSMContext, bot: Bot):
+    """Обработка фона для пакета продуктов и запуск генераций"""
+    data = await state.get_data()
+    if message.media_group_id and message.media_group_id == data.get("batch_media_group"):
+        # Фото того же альбома, пришедшее после сборки пакета
+        return
+
+    products = [spool.source(handle) for handle in data.get("batch_product_handles") or []]
+    products = [source for source in products if source]
+    if not products:
+        await message.answer(PROCESSING_FAILED, reply_markup=get_main_menu_keyboard())
+        await state.clear()
+        return
+
+    background_url = spool.source(await download_photo(bot, message.photo[-1]))
+    batch = ResultBatch(len(products), lambda results: send_batch_results(message, state, results))
+    # Пакет занимает в лимите задач пользователя одно место
+    context = {
+        "chat_id": message.chat.id,
+        "user_id": message.from_user.id,
+        "batch_id": uuid.uuid4().hex
+    }
+
+    try:
+        # Фон загружается на каждый аккаунт один раз (кэш загрузок), задачи
+        # расходятся по аккаунтам пула и выполняются одновременно
+        admissions = []
+        for index, product_url in enumerate(products):
+            admissions.append(await integration_service.add_generation_task(
+                product_image_url=product_url,
+                background_image_url=background_url,
+                callback=batch.callback(index),
+                context=dict(context)
+            ))
+
+        accepted = [admission for admission in admissions if admission]
+        if not accepted:
+            # Отказ сразу, пока пользователь не ждет результата
+            await message.answer(admission_message(admissions[0]), reply_markup=get_main_menu_keyboard())
+            await state.clear()
+            return
+        for index, admission in enumerate(admissions):
+            if not admission:
+                await batch.callback(index)({"status": "FAILED"})
+        if all(admission.cached for admission in accepted):
+            # Все результаты уже есть - они придут сразу
+            return
+
+        await message.answer(GENERATION_STARTED, reply_markup=get_cancel_keyboard())
+        await message.answer(admission_message(accepted[-1]))
+    except Exception as e:
+        logging.error(f"Batch generation error: {str(e)}")
+        await message.answer(GENERATION_FAILED)
+        await state.clear()
+
+def result_photo_sources(result: dict, index: int) -> list:
+    """Источники изображения результата в порядке предпочтения: file_id, файл кэша, URL RunningHub"""
+    paths = result.get("output_paths") or []
+    file_ids = result.get("output_file_ids") or []
+    sources = []
+    if index < len(file_ids) and file_ids[index]:
+        sources.append(file_ids[index])
+    if index < len(paths) and os.path.isfile(paths[index]):
+        sources.append(FSInputFile(paths[index]))
+    sources.append(URLInputFile(result["output_urls"][index]))
+    return sources
+
+async def remember_file_id(result: dict, index: int, photo, sent: Message) -> None:
+    """Запоминает file_id загруженного в Telegram изображения"""
+    if result.get("cache_key") and not isinstance(photo, str) and sent.photo:
+        # Следующие отправки этого изображения не загружают его в Telegram заново
+        await result_cache.remember_file_id(result["cache_key"], index, sent.photo[-1].file_id)
+
+async def send_result_photo(send_photo, result: dict, index: int, **kwargs) -> None:
+    """Отправляет одно изображение результата, перебирая источники"""
+    sources = result_photo_sources(result, index)
+    for number, photo in enumerate(sources):
+        try:
+            sent = await send_photo(photo, **kwargs)
+            break
+        except TelegramBadRequest as e:
+            if number == len(sources) - 1:
+                raise
+            logging.warning(f"Failed to send cached photo, trying next source: {e}")
+    await remember_file_id(result, index, photo, sent)
+
+async def send_result_photos(send_photo, result: dict) -> None:
+    """Отправляет изображения результата: по file_id, из кэша на диске или по URL RunningHub"""
+    for index in range(len(result.get("output_urls", []))):
+        await send_result_photo(
+            send_photo, result, index, caption=PROCESSING_COMPLETE, reply_markup=get_result_keyboard()
+        )
+
+async def send_batch_results(message: Message, state: FSMContext, results: List[Optional[dict]]) -> None:
+    """Отправляет результаты пакета альбомами (не больше 10 фото в каждом)"""
+    photos = [
+        (result, index)
+        for result in results
+        if result.get("status") == "SUCCESS"
+        for index in range(len(result.get("output_urls", [])))
+    ]
+    failed = sum(1 for result in results if result.get("status") != "SUCCESS")
+
+    for start in range(0, len(photos), ALBUM_SIZE):
+        chunk = photos[start:start + ALBUM_SIZE]
+        media = [result_photo_sources(result, index)[0] for result, index in chunk]
+        try:
+            if len(chunk) == 1:
+                sent = [await message.answer_photo(media[0])]
+            else:
+                sent = await message.answer_media_group([InputMediaPhoto(media=photo) for photo in media])
+        except TelegramBadRequest as e:
+            # Например, устаревший file_id - отправляем по одному с перебором источников
+            logging.warning(f"Failed to send batch album, sending photos one by one: {e}")
+            for result, index in chunk:
+                await send_result_photo(message.answer_photo, result, index)
+            continue
+        for (result, index), photo, item in zip(chunk, media, sent):
+            await remember_file_id(result, index, photo, item)
+
+    if photos:
+        await message.answer(BATCH_COMPLETE(len(photos), failed), reply_markup=get_main_menu_keyboard())
+    else:
+        await message.answer(PROCESSING_FAILED, reply_markup=get_main_menu_keyboard())
+    await state.clear()
+
+async def handle_generation_result(
+    result: dict,
+    message: Message,
+    state: FSMContext,
+    product_image_url: str,
+    background_image_url: str
+):
     """Обработка результата генерации"""
     if result.get("status") == "SUCCESS":
-        for image_url in result.get("output_urls", []):
-            await message.answer_photo(
-                URLInputFile(image_url),
-                caption=PROCESSING_COMPLETE,
-                reply_markup=get_result_keyboard()
-            )
+        await send_result_photos(message.answer_photo, result)
     else:
-        await message.answer(PROCESSING_FAILED)
+        await message.answer(failure_message(result))
     
     await state.clear()
+    # Запоминаем загруженные файлы и их аккаунт для кнопки "Сгенерировать ещё"
+    await state.update_data(last_generation={
+        "product_image_url": product_image_url,
+        "background_image_url": background_image_url,
+        "api_key": result.get("api_key"),
+        "product_file": result.get("product_file"),
+        "background_file": result.get("background_file"),
+    })
+
+def make_recovery_handler(bot: Bot):
+    """Фабрика callback'ов для задач, восстановленных после перезапуска.
+
+    Сообщение и FSM-состояние исходного запроса не сохраняются, поэтому
+    результат отправляется напрямую в чат из context задачи.
+    """
+    def create_callback(context: dict):
+        chat_id = (context or {}).get("chat_id")
+        if chat_id is None:
+            return None
+
+        async def deliver(result: dict):
+            if result.get("status") == "SUCCESS":
+                await send_result_photos(functools.partial(bot.send_photo, chat_id), result)
+            else:
+                await bot.send_message(chat_id, failure_message(result))
+
+        return deliver
+
+    return create_callback
+
+@router.callback_query(F.data == "regenerate")
+async def regenerate_image(callback: CallbackQuery, state: FSMContext):
+    """Повторная генерация на тех же изображениях с новым seed"""
+    data = await state.get_data()
+    last_generation = data.get("last_generation")
+    if not last_generation:
+        await callback.message.answer(
+            "Для повторной генерации отправьте изображения заново",
+            reply_markup=get_main_menu_keyboard()
+        )
+        await callback.answer()
+        return
+
+    message = callback.message
+    try:
+        admission = await integration_service.regenerate_task(
+            last_generation,
+            callback=lambda result: handle_generation_result(
+                result,
+                message,
+                state,
+                last_generation["product_image_url"],
+                last_generation["background_image_url"]
+            ),
+            context={"chat_id": message.chat.id, "user_id": callback.from_user.id}
+        )
+        if admission:
+            await message.answer(admission_message(admission), reply_markup=get_cancel_keyboard())
+        else:
+            await message.answer(admission_message(admission), reply_markup=get_main_menu_keyboard())
+    except Exception as e:
+        logging.error(f"Regeneration error: {str(e)}")
+        await message.answer(GENERATION_FAILED)
+    await callback.answer()
 
 @router.callback_query(F.data == "cancel")
 async def cancel_generation(callback: CallbackQuery, state: FSMContext):
@@ -118,6 +424,14 @@ async def cancel_generation(callback: CallbackQuery, state: FSMContext):
     
     if task_id:
         await integration_service.cancel_task(task_id)
+    preuploader.discard(callback.from_user.id)
+    current_state = await state.get_state()
+    if current_state == GenerationStates.waiting_for_background:
+        # Задача еще не создана - фото продукта больше не понадобится
+        spool.discard(data.get("product_photo_handle"))
+    elif current_state == GenerationStates.waiting_for_batch_background:
+        for handle in data.get("batch_product_handles") or []:
+            spool.discard(handle)
     
     await state.clear()
     await callback.message.answer("Генерация отменена", reply_markup=get_main_menu_keyboard())
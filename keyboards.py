@@ -28,7 +28,10 @@ def get_result_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура после генерации"""
     keyboard = [
         [
-            InlineKeyboardButton(text="🔄 Сгенерировать ещё", callback_data="generate"),
+            InlineKeyboardButton(text="🔄 Сгенерировать ещё", callback_data="regenerate"),
+            InlineKeyboardButton(text="🖼 Новые фото", callback_data="generate")
+        ],
+        [
             InlineKeyboardButton(text="🏠 В меню", callback_data="menu")
         ]
     ]
@@ -17,6 +17,8 @@ def HELP_MESSAGE() -> str:
         "2. Отправьте фотографию вашего продукта\n"
         "3. Отправьте фотографию с референсом фона/окружения\n"
         "4. Дождитесь результата генерации\n\n"
+        "Можно отправить альбом из нескольких фото продуктов - все они будут "
+        "сгенерированы на одном фоне и придут одним альбомом.\n\n"
         "Бот создаст новое изображение вашего продукта с выбранным фоном.\n"
         "Для лучшего результата:\n"
         "• Фото продукта должно быть качественным и четким\n"
@@ -37,3 +39,30 @@ GENERATION_COMPLETE = "Генерация завершена!"
 GENERATION_ERROR = "Произошла ошибка при генерации."
 GENERATION_CANCELLED = "Генерация отменена."
 IN_QUEUE = "Задача добавлена в очередь. Ожидайте результат."
+
+# Сообщения о приеме задачи в очередь
+QUEUE_FULL = "Сейчас очень много задач. Пожалуйста, попробуйте через несколько минут."
+NO_ACCOUNTS = "Генерация временно недоступна. Пожалуйста, попробуйте позже."
+
+def USER_TASKS_LIMIT(limit: int) -> str:
+    return f"У вас уже {limit} генерации в работе. Дождитесь результата и попробуйте снова."
+
+def QUEUE_POSITION(position: int, eta: float) -> str:
+    minutes = max(1, round(eta / 60))
+    return (
+        f"Задача добавлена в очередь.\n"
+        f"Место в очереди: {position}\n"
+        f"Примерное время ожидания: {minutes} мин."
+    )
+
+# Сообщения пакетной генерации (альбом фото продуктов на одном фоне)
+def BATCH_PRODUCTS_RECEIVED(count: int, skipped: int) -> str:
+    text = f"Получено фото продуктов: {count}. Теперь отправьте фотографию фона"
+    if skipped:
+        text += f"\nЗа один раз обрабатывается не больше {count} фото, пропущено: {skipped}"
+    return text
+
+def BATCH_COMPLETE(done: int, failed: int) -> str:
+    if not failed:
+        return PROCESSING_COMPLETE
+    return f"Готово изображений: {done}. Не удалось обработать фото: {failed}"
@@ -1,8 +1,12 @@
 import asyncio
 import logging
-from typing import Dict, Optional, Any
+import time
+from typing import Collection, Dict, List, Optional, Any, Tuple
 from dataclasses import dataclass
-from .runninghub import RunningHubAccount, RunningHubAPI
+from config import config
+from .runninghub import RunningHubAccount, RunningHubAPI, runninghub_api
+from .scheduler import SchedulingPolicy, create_policy
+from .slot_ledger import SlotLedger, create_ledger
 
 logger = logging.getLogger(__name__)
 
@@ -10,14 +14,56 @@ logger = logging.getLogger(__name__)
 class AccountStatus:
     active_tasks: int = 0
     max_tasks: int = 5
+    reserved: int = 0  # Задачи, выбравшие аккаунт, но еще не занявшие слот
+    remote_tasks: int = 0  # Слоты, занятые другими процессами (по общему учету)
+    adaptive_limit: float = 0.0  # Адаптивный лимит (AIMD), 0 - не используется
+    baseline_latency: Optional[float] = None  # EWMA времени выполнения задачи
+    last_decrease: float = 0.0  # Время последнего уменьшения лимита
+
+    @property
+    def limit(self) -> int:
+        """Текущий лимит одновременных задач"""
+        if self.adaptive_limit <= 0:
+            return self.max_tasks
+        return max(1, min(self.max_tasks, int(self.adaptive_limit)))
 
 class AccountManager:
-    def __init__(self):
-        from .runninghub import RunningHubAPI
-        self.runninghub_api = RunningHubAPI()
+    def __init__(
+        self,
+        policy: Optional[str] = None,
+        api: Optional[RunningHubAPI] = None,
+        ledger: Optional[SlotLedger] = None
+    ):
+        self.runninghub_api = api or runninghub_api
+        self.policy: SchedulingPolicy = create_policy(policy or config.runninghub.scheduler_policy)
+        # Учет слотов между процессами (локальный, если SLOT_LEDGER_PATH не задан)
+        self.ledger = ledger or create_ledger(
+            config.runninghub.slot_ledger_path,
+            lease_ttl=config.runninghub.slot_lease_ttl
+        )
         self.accounts: Dict[str, RunningHubAccount] = {}
         self.account_status: Dict[str, AccountStatus] = {}
-        self.lock = asyncio.Lock()
+        # Примитивы asyncio создаются при первом обращении внутри event loop:
+        # в Python 3.9 они привязываются к loop в момент создания
+        self._lock: Optional[asyncio.Lock] = None
+        self._condition: Optional[asyncio.Condition] = None
+        # Аренды слотов в общем учете по аккаунтам
+        self._leases: Dict[str, List[str]] = {}
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        """Общий lock состояния аккаунтов"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @property
+    def _slot_released(self) -> asyncio.Condition:
+        """Условие для ожидания освобождения слота (использует общий lock)"""
+        if self._condition is None:
+            self._condition = asyncio.Condition(self.lock)
+        return self._condition
 
     def add_account(self, api_key: str, workflow_id: str, max_tasks: int = 5) -> None:
         """Добавляет аккаунт в пул"""
@@ -27,22 +73,276 @@ class AccountManager:
             max_tasks=max_tasks
         )
         self.accounts[api_key] = account
-        self.account_status[api_key] = AccountStatus(max_tasks=max_tasks)
+        status = AccountStatus(max_tasks=max_tasks)
+        if config.runninghub.adaptive_limits:
+            # Начинаем с базового лимита и подстраиваемся под ответы RunningHub
+            status.adaptive_limit = float(min(max_tasks, config.runninghub.max_tasks))
+        self.account_status[api_key] = status
+        self.policy.add_account(api_key, self.account_status[api_key])
 
     async def get_available_account(self) -> Optional[str]:
         """Возвращает доступный аккаунт"""
         async with self.lock:
-            for api_key, status in self.account_status.items():
-                if status.active_tasks < status.max_tasks:
-                    status.active_tasks += 1
-                    return api_key
+            return self._take_slot()
+
+    def _take_slot(self, api_key: Optional[str] = None) -> Optional[str]:
+        """Занимает слот на аккаунте, выбранном политикой (или указанном)"""
+        chosen = api_key is None
+        if chosen:
+            api_key = self.policy.choose()
+            if api_key is None:
+                return None
+        status = self.account_status[api_key]
+        if status.active_tasks + status.remote_tasks >= status.limit:
+            return None
+        status.active_tasks += 1
+        if chosen:
+            self.policy.on_selected(api_key)
+        self.policy.update(api_key)
+        return api_key
+
+    def select_account(self, exclude: Collection[str] = ()) -> Optional[str]:
+        """Выбирает аккаунт по политике планирования, не занимая слот.
+
+        Аккаунты из exclude выбираются, только если других нет.
+        """
+        api_key = self.policy.choose()
+        if api_key is not None and api_key not in exclude:
+            return api_key
+        candidates = [key for key in self.account_status if key not in exclude] or list(self.account_status)
+        if not candidates:
+            return None
+        # Все подходящие аккаунты заняты или политика выбрала исключенный -
+        # берем наименее загруженный, свободные раньше занятых
+        return min(
+            candidates,
+            key=lambda key: (
+                not self.policy.has_capacity(self.account_status[key]),
+                self.policy.load(self.account_status[key])
+            )
+        )
+
+    def has_free_slot(self, api_key: str) -> bool:
+        """Есть ли у аккаунта свободный слот с учетом резервирований"""
+        status = self.account_status.get(api_key)
+        return status is not None and self.policy.has_capacity(status)
+
+    def reserve_account(self, api_key: Optional[str] = None, exclude: Collection[str] = ()) -> Optional[str]:
+        """Мягко резервирует аккаунт (выбранный политикой или указанный) под будущую задачу"""
+        chosen = api_key is None
+        if chosen:
+            api_key = self.select_account(exclude)
+        if api_key in self.account_status:
+            self.account_status[api_key].reserved += 1
+            if chosen:
+                self.policy.on_selected(api_key)
+            self.policy.update(api_key)
+            return api_key
+        return None
+
+    def release_reservation(self, api_key: str) -> None:
+        """Снимает мягкое резервирование аккаунта"""
+        status = self.account_status.get(api_key)
+        if status and status.reserved > 0:
+            status.reserved -= 1
+            self.policy.update(api_key)
+
+    def on_overload(self, api_key: str) -> None:
+        """Уменьшает лимит аккаунта после ответа об очереди или перегрузке (AIMD)"""
+        status = self.account_status.get(api_key)
+        if status is None or status.adaptive_limit <= 0:
+            return
+        now = time.monotonic()
+        # Одно уменьшение за период, чтобы пачка отказов не обнулила лимит
+        if now - status.last_decrease < config.runninghub.aimd_cooldown:
+            return
+        status.last_decrease = now
+        previous = status.limit
+        status.adaptive_limit = max(
+            float(config.runninghub.min_tasks),
+            status.adaptive_limit * config.runninghub.aimd_decrease_factor
+        )
+        self.policy.update(api_key)
+        logger.warning(f"Account {api_key[:5]}... overloaded, limit {previous} -> {status.limit}")
+
+    async def on_task_completed(self, api_key: str, latency: float) -> None:
+        """Учитывает время выполнения задачи: растит лимит или снижает при скачке задержки"""
+        status = self.account_status.get(api_key)
+        if status is None:
+            return
+        self.policy.record_latency(api_key, latency)
+
+        baseline = status.baseline_latency
+        status.baseline_latency = latency if baseline is None else 0.8 * baseline + 0.2 * latency
+        if status.adaptive_limit <= 0:
+            return
+
+        if baseline is not None and latency > baseline * config.runninghub.latency_spike_factor:
+            self.on_overload(api_key)
+            return
+
+        # Аддитивный рост: примерно +1 слот за каждые limit успешных задач
+        async with self._slot_released:
+            previous = status.limit
+            status.adaptive_limit = min(
+                float(status.max_tasks),
+                status.adaptive_limit + config.runninghub.aimd_increase / status.adaptive_limit
+            )
+            self.policy.update(api_key)
+            if status.limit > previous:
+                logger.info(f"Account {api_key[:5]}... limit {previous} -> {status.limit}")
+                self._slot_released.notify_all()
+
+    async def acquire_account(self, api_key: Optional[str] = None) -> str:
+        """Ожидает свободный слот и занимает аккаунт (конкретный, если указан).
+
+        Слот занимается сначала локально, затем в общем учете. Если другие
+        процессы заняли аккаунт раньше, задача ждет своей очереди в учете.
+        """
+        ticket: Optional[int] = None
+        ticket_account: Optional[str] = None
+        try:
+            while True:
+                async with self._slot_released:
+                    taken = self._take_slot(api_key)
+                    while not taken:
+                        await self._slot_released.wait()
+                        taken = self._take_slot(api_key)
+
+                if ticket is not None and ticket_account != taken:
+                    await self.ledger.cancel_ticket(ticket)
+                    ticket = None
+                attempt = asyncio.ensure_future(
+                    self.ledger.try_acquire(taken, self.account_status[taken].limit, ticket)
+                )
+                try:
+                    lease_id, ticket = await asyncio.shield(attempt)
+                except asyncio.CancelledError:
+                    # Запрос к учету доработает в потоке - не оставляем выданную аренду
+                    ticket = None
+                    attempt.add_done_callback(self._discard_attempt)
+                    await self._return_slot(taken)
+                    raise
+                except Exception as e:
+                    # Учет недоступен - работаем по локальному лимиту
+                    logger.error(f"Slot ledger error, using local limit: {e}")
+                    return taken
+                if lease_id:
+                    self._leases.setdefault(taken, []).append(lease_id)
+                    return taken
+
+                # Аккаунт занят другими процессами - ждем освобождения или опрашиваем учет
+                ticket_account = taken
+                await self._return_slot(taken)
+                async with self._slot_released:
+                    try:
+                        await asyncio.wait_for(
+                            self._slot_released.wait(),
+                            timeout=config.runninghub.slot_ledger_poll_interval
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            if ticket is not None:
+                await self.ledger.cancel_ticket(ticket)
+
+    async def try_acquire_account(self, exclude: Tuple[str, ...] = ()) -> Optional[str]:
+        """Занимает слот на наименее загруженном аккаунте, не дожидаясь освобождения"""
+        async with self._slot_released:
+            candidates = sorted(
+                (
+                    api_key for api_key, status in self.account_status.items()
+                    if api_key not in exclude and self.policy.has_capacity(status)
+                ),
+                key=lambda api_key: self.policy.load(self.account_status[api_key])
+            )
+            taken = next((api_key for api_key in candidates if self._take_slot(api_key)), None)
+        if taken is None:
             return None
 
+        try:
+            lease_id, ticket = await self.ledger.try_acquire(taken, self.account_status[taken].limit)
+        except Exception as e:
+            logger.error(f"Slot ledger error, using local limit: {e}")
+            return taken
+        if ticket is not None:
+            # Ждать очереди не нужно
+            await self.ledger.cancel_ticket(ticket)
+        if not lease_id:
+            await self._return_slot(taken)
+            return None
+        self._leases.setdefault(taken, []).append(lease_id)
+        return taken
+
+    def _discard_attempt(self, attempt: asyncio.Future) -> None:
+        """Отдает аренду или номер в очереди, полученные отмененным ожиданием"""
+        if attempt.cancelled() or attempt.exception() is not None:
+            return
+        lease_id, ticket = attempt.result()
+        loop = asyncio.get_running_loop()
+        if lease_id:
+            loop.create_task(self.ledger.release(lease_id))
+        if ticket is not None:
+            loop.create_task(self.ledger.cancel_ticket(ticket))
+
+    async def _return_slot(self, api_key: str) -> None:
+        """Возвращает локально занятый слот, не получивший аренду"""
+        async with self._slot_released:
+            status = self.account_status[api_key]
+            status.active_tasks = max(0, status.active_tasks - 1)
+            self.policy.update(api_key)
+
     async def release_account(self, api_key: str) -> None:
         """Освобождает аккаунт"""
-        async with self.lock:
+        leases = self._leases.get(api_key)
+        if leases:
+            await self.ledger.release(leases.pop())
+        async with self._slot_released:
             if api_key in self.account_status:
-                self.account_status[api_key].active_tasks -= 1
+                status = self.account_status[api_key]
+                status.active_tasks = max(0, status.active_tasks - 1)
+                self.policy.update(api_key)
+                # Будим всех: ожидающие могут ждать конкретный аккаунт
+                self._slot_released.notify_all()
+
+    async def release_all_accounts(self) -> None:
+        """Освобождает все занятые слоты"""
+        self._leases.clear()
+        await self.ledger.release_all()
+        async with self._slot_released:
+            for api_key, status in self.account_status.items():
+                status.active_tasks = 0
+                status.reserved = 0
+                self.policy.update(api_key)
+            self._slot_released.notify_all()
+
+    async def _sync_ledger(self) -> None:
+        """Продлевает аренды этого процесса и обновляет чужую загрузку аккаунтов"""
+        interval = config.runninghub.slot_lease_ttl / 3
+        while True:
+            try:
+                await self.ledger.renew()
+                usage = await self.ledger.remote_usage()
+                async with self._slot_released:
+                    for api_key, status in self.account_status.items():
+                        remote = usage.get(api_key, 0)
+                        if remote != status.remote_tasks:
+                            freed = remote < status.remote_tasks
+                            status.remote_tasks = remote
+                            self.policy.update(api_key)
+                            if freed:
+                                self._slot_released.notify_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error syncing slot ledger: {e}", exc_info=True)
+            # Чужая загрузка нужна актуальной, но не чаще раза в пару интервалов опроса
+            await asyncio.sleep(min(interval, config.runninghub.slot_ledger_poll_interval * 4))
+
+    @property
+    def total_capacity(self) -> int:
+        """Суммарное количество слотов по всем аккаунтам"""
+        return sum(status.max_tasks for status in self.account_status.values())
 
     async def check_accounts_status(self) -> Dict[str, Dict[str, Any]]:
         """Проверяет статус всех аккаунтов"""
@@ -57,13 +357,17 @@ class AccountManager:
         return results
 
     async def close(self) -> None:
-        """Закрывает все аккаунты"""
-        await self.runninghub_api.close()
+        """Закрывает все аккаунты (общий HTTP-клиент закрывает IntegrationService)"""
+        if self._heartbeat and not self._heartbeat.done():
+            self._heartbeat.cancel()
+        self._heartbeat = None
+        await self.release_all_accounts()
+        await self.ledger.close()
 
     def has_available_accounts(self) -> bool:
         """Проверяет наличие доступных аккаунтов"""
         return any(
-            status.active_tasks < status.max_tasks
+            status.active_tasks + status.remote_tasks < status.limit
             for status in self.account_status.values()
         )
 
@@ -79,4 +383,10 @@ class AccountManager:
             except Exception as e:
                 logger.error(f"Failed to initialize account {account.api_key}: {e}")
 
+        if self.ledger.shared and self._heartbeat is None:
+            logger.info(f"Using shared slot ledger as {self.ledger.holder}")
+            self._heartbeat = asyncio.get_running_loop().create_task(
+                self._sync_ledger(), name="slot_ledger_sync"
+            )
+
 account_manager = AccountManager()
@@ -0,0 +1,112 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+from config import config
+
+# Полосы приоритета
+LANE_PAID = "paid"
+LANE_STANDARD = "standard"
+
+def priority_lane(user_id: Optional[int]) -> str:
+    """Полоса пользователя: платные пользователи идут в отдельную полосу"""
+    if user_id is not None and user_id in config.runninghub.paid_user_ids:
+        return LANE_PAID
+    return LANE_STANDARD
+
+def lane_weights() -> Dict[str, float]:
+    """Доли полос в выдаче задач"""
+    return {
+        LANE_PAID: config.runninghub.paid_lane_weight,
+        LANE_STANDARD: config.runninghub.standard_lane_weight,
+    }
+
+class _Lane:
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.deficit = 0.0
+        # Очереди пользователей в порядке обхода
+        self.flows: "OrderedDict[Hashable, Deque[Any]]" = OrderedDict()
+
+class _DRRBuffer:
+    """Двухуровневый deficit round-robin: взвешенно между полосами, поровну между пользователями"""
+
+    def __init__(self, key: Callable[[Any], Tuple[str, Hashable]], weights: Dict[str, float]):
+        self.key = key
+        self.weights = weights
+        self.lanes: "OrderedDict[str, _Lane]" = OrderedDict()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, item: Any) -> None:
+        lane_name, flow = self.key(item)
+        lane = self.lanes.get(lane_name)
+        if lane is None:
+            lane = _Lane(max(0.01, self.weights.get(lane_name, 1.0)))
+            self.lanes[lane_name] = lane
+        queue = lane.flows.get(flow)
+        if queue is None:
+            queue = lane.flows[flow] = deque()
+        queue.append(item)
+        self.size += 1
+
+    def popleft(self) -> Any:
+        while True:
+            lane_name, lane = next(iter(self.lanes.items()))
+            if lane.deficit < 1:
+                lane.deficit += lane.weight
+                if lane.deficit < 1:
+                    # Полоса с малым весом копит дефицит несколько раундов
+                    self.lanes.move_to_end(lane_name)
+                    continue
+
+            # Внутри полосы - по одной задаче от каждого пользователя по кругу
+            flow, queue = next(iter(lane.flows.items()))
+            item = queue.popleft()
+            if queue:
+                lane.flows.move_to_end(flow)
+            else:
+                del lane.flows[flow]
+            lane.deficit -= 1
+            self.size -= 1
+
+            if not lane.flows:
+                # Пустая полоса не копит дефицит
+                del self.lanes[lane_name]
+            elif lane.deficit < 1:
+                self.lanes.move_to_end(lane_name)
+            return item
+
+    def __iter__(self):
+        for lane in self.lanes.values():
+            for queue in lane.flows.values():
+                yield from queue
+
+class FairQueue(asyncio.Queue):
+    """asyncio.Queue со справедливым порядком выдачи между пользователями и полосами.
+
+    key(item) возвращает (полоса, пользователь). Полосы получают доли
+    выдачи пропорционально весам, пользователи внутри полосы - поровну,
+    поэтому пачка задач одного пользователя не задерживает остальных.
+    """
+
+    def __init__(
+        self,
+        key: Callable[[Any], Tuple[str, Hashable]],
+        weights: Optional[Dict[str, float]] = None,
+        maxsize: int = 0
+    ):
+        self._key = key
+        self._weights = weights or {}
+        super().__init__(maxsize=maxsize)
+
+    def _init(self, maxsize: int) -> None:
+        self._queue = _DRRBuffer(self._key, self._weights)
+
+    def _put(self, item: Any) -> None:
+        self._queue.append(item)
+
+    def _get(self) -> Any:
+        return self._queue.popleft()
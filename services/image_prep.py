@@ -0,0 +1,174 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple, Union
+
+from PIL import Image, ImageOps, ImageStat
+
+logger = logging.getLogger(__name__)
+
+# Тег EXIF с ориентацией снимка
+EXIF_ORIENTATION = 0x0112
+
+# У изображений почти без текстуры (однотонный фон, плавный градиент) dHash
+# вырождается: почти все биты одинаковы, и разные цвета дают один хэш
+MIN_DHASH_BITS = 4
+# Минимальный разброс яркости уменьшенной копии для перцептивного сравнения
+MIN_DHASH_STDDEV = 4.0
+
+def normalize_image(
+    source: Union[str, bytes],
+    max_side: int,
+    quality: int,
+    max_bytes: int
+) -> Optional[bytes]:
+    """Поворачивает снимок по EXIF, уменьшает до max_side и пережимает в JPEG.
+
+    Выполняется в отдельном процессе. Возвращает None, если изображение
+    уже подходит (JPEG нужного размера без поворота) - тогда загружается
+    оригинал без потери качества.
+    """
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        size = os.path.getsize(source) if isinstance(source, str) else len(source)
+        if (
+            image.format == "JPEG"
+            and orientation == 1
+            and max(image.size) <= max_side
+            and size <= max_bytes
+        ):
+            return None
+
+        image = ImageOps.exif_transpose(image)
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            # Прозрачность на белом фоне, палитры и CMYK - в RGB
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background.paste(image, mask=image.getchannel("A"))
+            else:
+                background.paste(image.convert("RGB"))
+            image = background
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue()
+
+def compute_fingerprint(source: Union[str, bytes], size: int = 8) -> Optional[Tuple[int, Tuple[int, ...]]]:
+    """Перцептивный хэш (dHash) и сигнатура изображения: (ширина, высота, средний R, G, B).
+
+    dHash - знаки разностей соседних пикселей уменьшенной копии, он устойчив
+    к пережатию, масштабу и небольшим изменениям яркости. Сигнатура
+    подтверждает совпадение хэшей. Для изображений почти без текстуры
+    возвращает None - их dHash ничего не говорит о содержимом.
+    """
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        width, height = image.size
+        gray = image.convert("L").resize((size + 1, size), Image.LANCZOS)
+        mean = ImageStat.Stat(image.resize((32, 32), Image.BOX)).mean
+    pixels = gray.tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for column in range(size):
+            value = (value << 1) | (pixels[offset + column] > pixels[offset + column + 1])
+    bits = bin(value).count("1")
+    if (
+        bits < MIN_DHASH_BITS
+        or bits > size * size - MIN_DHASH_BITS
+        or ImageStat.Stat(gray).stddev[0] < MIN_DHASH_STDDEV
+    ):
+        return None
+    return value, (width, height, *(round(channel) for channel in mean))
+
+class ImageNormalizer:
+    """Подготовка изображений к загрузке в RunningHub в пуле процессов.
+
+    Декодирование и пережатие фото с телефона занимает сотни миллисекунд
+    CPU, поэтому выполняется вне event loop и вне GIL основного процесса.
+    """
+
+    def __init__(self, max_side: int = 2048, quality: int = 90, max_bytes: int = 10 * 1024 * 1024, workers: int = 2):
+        self.max_side = max_side
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_side > 0 and self.workers > 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: процесс бота многопоточный, fork в таком состоянии небезопасен.
+            # Процесс пула заново выполняет главный модуль, поэтому точка входа
+            # (bot_new.py) импортирует бот и сервисы только при запуске
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    @staticmethod
+    def _payload(source: Union[str, bytes, io.IOBase]) -> Optional[Union[str, bytes]]:
+        """Путь или байты для передачи в процесс; None для URL и потоков"""
+        if isinstance(source, str):
+            if source.startswith(("http://", "https://")):
+                # URL загружается потоком без скачивания целиком
+                return None
+            return source[len("file://"):] if source.startswith("file://") else source
+        if isinstance(source, io.BytesIO):
+            return source.getvalue()
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return bytes(source)
+        return None
+
+    async def _run(self, func, *args):
+        """Выполняет func в пуле процессов (или в потоке, если пул выключен)"""
+        if self.workers <= 0:
+            return await asyncio.to_thread(func, *args)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        except BrokenProcessPool:
+            self._executor = None
+            raise
+
+    async def normalize(self, source: Union[str, bytes, io.IOBase]) -> Union[str, bytes, io.IOBase]:
+        """Возвращает нормализованные байты JPEG или исходный источник, если нормализация не нужна"""
+        if not self.enabled:
+            return source
+        payload = self._payload(source)
+        if payload is None:
+            return source
+        try:
+            result = await self._run(normalize_image, payload, self.max_side, self.quality, self.max_bytes)
+        except Exception as e:
+            # Не изображение, поврежденный файл или упавший пул - пусть решает RunningHub
+            logger.warning(f"Failed to normalize image, uploading original: {e}")
+            return source
+        return source if result is None else result
+
+    async def fingerprint(self, source: Union[str, bytes, io.IOBase]) -> Optional[Tuple[int, Tuple[int, ...]]]:
+        """Перцептивный хэш и сигнатура изображения или None, если сравнивать нечего"""
+        payload = self._payload(source)
+        if payload is None:
+            return None
+        try:
+            return await self._run(compute_fingerprint, payload)
+        except Exception as e:
+            logger.warning(f"Failed to compute perceptual hash: {e}")
+            return None
+
+    def close(self) -> None:
+        """Останавливает пул процессов"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -1,19 +1,62 @@
 import asyncio
-from typing import Dict, Any
-from .account_manager import AccountManager
-from .task_queue import TaskQueue
-from .runninghub import RunningHubAPI
+import logging
+import random
+from typing import Callable, Dict, Any, Optional
+from .account_manager import account_manager
+from .task_queue import task_queue, AdmissionResult, REJECT_QUEUE_FULL, REJECT_USER_LIMIT
+from .preupload import preuploader
+from .runninghub import upload_cache, image_normalizer, runninghub_api
+from .task_store import task_store
+from .result_cache import result_cache
+from .spool import spool
+from .job_channel import JobChannel
 from config import config
 
+logger = logging.getLogger(__name__)
+
+# Режимы процесса (BOT_MODE)
+MODE_ALL = "all"  # Telegram и генерации в одном процессе
+MODE_FRONTEND = "frontend"  # Только Telegram: задания уходят воркерам через канал
+MODE_WORKER = "worker"  # Только генерации: задания приходят из канала
+
 class IntegrationService:
-    def __init__(self, accounts: Dict[str, Dict[str, Any]]):
-        self.runninghub_api = RunningHubAPI(api_url=config.runninghub.api_url)
-        self.account_manager = AccountManager()
-        self.task_queue = TaskQueue(self.account_manager)
+    def __init__(self, accounts: Dict[str, Dict[str, Any]], mode: str = MODE_ALL):
+        # Общий HTTP-клиент: закрывается один раз при завершении работы
+        self.runninghub_api = runninghub_api
+        # Общий пул аккаунтов и очередь, чтобы слоты не дублировались
+        self.account_manager = account_manager
+        self.task_queue = task_queue
         self.accounts = accounts
+        self.mode = mode
+        self.channel: Optional[JobChannel] = None
+        self._channel_task: Optional[asyncio.Task] = None
+        self.recovery_handler: Optional[Callable[[Optional[Dict[str, Any]]], Any]] = None
 
     async def initialize(self) -> None:
         """Инициализирует все компоненты"""
+        if not config.runninghub.seed_node_id:
+            # seed входит в ключ запроса, поэтому повтор не берется из кэша,
+            # но RunningHub получает те же входные данные
+            logger.warning(
+                "WORKFLOW_NODE_PRODUCT_SEED is not set: regenerate resubmits the same "
+                "inputs and may return the same image"
+            )
+        if self.mode != MODE_ALL:
+            self.channel = JobChannel(
+                config.runninghub.job_channel_path,
+                poll_interval=config.runninghub.job_poll_interval,
+                claim_ttl=config.runninghub.job_claim_ttl
+            )
+        loop = asyncio.get_running_loop()
+        if self.mode == MODE_FRONTEND:
+            # Результаты приходят от воркеров через канал
+            self._channel_task = loop.create_task(
+                self.channel.deliver_results(fallback=self.recovery_handler),
+                name="job_results"
+            )
+            logger.info("Running as frontend, generations are handled by workers")
+            return
+
         # Преобразуем аккаунты в формат RunningHubAccount
         runninghub_accounts = {
             account.api_key: account
@@ -21,25 +64,152 @@ class IntegrationService:
         }
         
         await self.account_manager.initialize(runninghub_accounts)
+        if self.mode == MODE_WORKER:
+            # Результаты восстановленных задач возвращаются frontend'у через канал
+            self.task_queue.recovery_handler = self._job_callback_from_context
         await self.task_queue.start()
+        if self.mode == MODE_WORKER:
+            self._channel_task = loop.create_task(
+                self.channel.consume(self._start_job, self.task_queue.free_capacity),
+                name="job_consumer"
+            )
+            logger.info("Running as worker, waiting for jobs")
 
     async def shutdown(self) -> None:
         """Завершает работу всех компонентов"""
+        if self._channel_task and not self._channel_task.done():
+            self._channel_task.cancel()
+            try:
+                await self._channel_task
+            except asyncio.CancelledError:
+                pass
+        self._channel_task = None
+        await preuploader.close()
+        await spool.close()
         await self.task_queue.stop()
+        await self.account_manager.close()
+        await task_store.close()
+        if self.channel:
+            self.channel.close()
         await self.runninghub_api.close()
+        upload_cache.close()
+        image_normalizer.close()
+        result_cache.close()
+
+    def set_recovery_handler(self, handler: Callable[[Optional[Dict[str, Any]]], Any]) -> None:
+        """Задает фабрику callback'ов для задач, восстановленных после перезапуска"""
+        self.recovery_handler = handler
+        if self.mode == MODE_ALL:
+            self.task_queue.recovery_handler = handler
 
     async def add_generation_task(
         self,
         product_image_url: str,
         background_image_url: str,
-        callback: Any
-    ) -> None:
+        callback: Any,
+        api_key: Optional[str] = None,
+        product_file: Optional[str] = None,
+        background_file: Optional[str] = None,
+        seed: Optional[int] = None,
+        context: Optional[Dict[str, Any]] = None
+    ) -> AdmissionResult:
         """Добавляет задачу генерации в очередь"""
-        await self.task_queue.add_task(
+        if self.mode == MODE_FRONTEND:
+            admission = await self._admit_job(context)
+            if not admission:
+                return admission
+            # Источники изображений - строки (URL или путь на общем диске узла)
+            await self.channel.submit({
+                "product_image_url": product_image_url,
+                "background_image_url": background_image_url,
+                "api_key": api_key,
+                "product_file": product_file,
+                "background_file": background_file,
+                "seed": seed,
+                "context": context,
+            }, callback)
+            return admission
+
+        return await self.task_queue.add_task(
             product_image_url=product_image_url,
             background_image_url=background_image_url,
-            callback=callback
+            callback=callback,
+            api_key=api_key,
+            product_file=product_file,
+            background_file=background_file,
+            seed=seed,
+            context=context
+        )
+
+    async def _admit_job(self, context: Optional[Dict[str, Any]]) -> AdmissionResult:
+        """Прием задания на frontend'е: те же лимиты, что у очереди в одном процессе.
+
+        Очередь ожидания - невзятые задания канала: воркеры забирают их
+        только под свободную емкость. Время ожидания frontend не оценивает.
+        """
+        pending = await self.channel.pending_count()
+        max_depth = config.runninghub.max_queue_depth
+        if max_depth and pending >= max_depth:
+            logger.warning(f"Job channel is full ({pending} jobs), rejecting new task")
+            return AdmissionResult(accepted=False, reason=REJECT_QUEUE_FULL)
+
+        user_id = (context or {}).get("user_id")
+        max_user_tasks = config.runninghub.max_user_tasks
+        if (
+            max_user_tasks
+            and user_id is not None
+            and not self.channel.has_batch(user_id, (context or {}).get("batch_id"))
+            and self.channel.user_jobs(user_id) >= max_user_tasks
+        ):
+            logger.info(f"User {user_id} already has {max_user_tasks} jobs in progress")
+            return AdmissionResult(accepted=False, reason=REJECT_USER_LIMIT)
+        return AdmissionResult(accepted=True, position=pending + 1)
+
+    async def _start_job(self, job_id: str, payload: Dict[str, Any]) -> bool:
+        """Запускает задание из канала на воркере"""
+        context = dict(payload.get("context") or {}, job_id=job_id)
+        return await self.task_queue.add_task(
+            product_image_url=payload["product_image_url"],
+            background_image_url=payload["background_image_url"],
+            callback=self._job_callback(job_id),
+            api_key=payload.get("api_key"),
+            product_file=payload.get("product_file"),
+            background_file=payload.get("background_file"),
+            seed=payload.get("seed"),
+            context=context
+        )
+
+    def _job_callback(self, job_id: str) -> Callable[[Dict[str, Any]], Any]:
+        """Callback воркера: возвращает результат в канал"""
+        async def complete(result: Dict[str, Any]) -> None:
+            await self.channel.complete(job_id, result)
+        return complete
+
+    def _job_callback_from_context(self, context: Optional[Dict[str, Any]]) -> Any:
+        """Callback для задания, восстановленного после перезапуска воркера"""
+        job_id = (context or {}).get("job_id")
+        if not job_id:
+            return None
+        asyncio.get_running_loop().create_task(self.channel.adopt(job_id))
+        return self._job_callback(job_id)
+
+    async def regenerate_task(
+        self,
+        last_generation: Dict[str, Any],
+        callback: Any,
+        context: Optional[Dict[str, Any]] = None
+    ) -> AdmissionResult:
+        """Повторяет генерацию с новым seed на уже загруженных файлах"""
+        return await self.add_generation_task(
+            product_image_url=last_generation["product_image_url"],
+            background_image_url=last_generation["background_image_url"],
+            callback=callback,
+            api_key=last_generation.get("api_key"),
+            product_file=last_generation.get("product_file"),
+            background_file=last_generation.get("background_file"),
+            seed=random.randint(0, 2**31 - 1),
+            context=context
         )
 
 # Создаем и экспортируем экземпляр сервиса
-integration_service = IntegrationService(config.runninghub.accounts)
+integration_service = IntegrationService(config.runninghub.accounts, mode=config.tg_bot.mode)
@@ -0,0 +1,272 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .fair_queue import lane_weights, priority_lane
+
+logger = logging.getLogger(__name__)
+
+# Состояния задания в канале
+JOB_PENDING = "pending"
+JOB_CLAIMED = "claimed"
+JOB_DONE = "done"
+
+class JobChannel:
+    """Канал заданий между процессом бота (frontend) и процессами-воркерами.
+
+    Задания и результаты лежат в общем SQLite-файле (WAL). Frontend кладет
+    задания и забирает готовые результаты, воркеры забирают задания пачками
+    и возвращают результаты. Задание воркера, переставшего продлевать
+    захват, возвращается в очередь.
+
+    Воркеры забирают задания справедливо: раньше те, чьих заданий у
+    воркеров сейчас меньше, с учетом весов полос приоритета.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.2, claim_ttl: float = 120.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.claim_ttl = claim_ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._callbacks: Dict[str, Any] = {}
+        # Незавершенные задания этого frontend'а по пользователям:
+        # user_id -> {batch_id или job_id: число заданий}; пакет - одно место
+        self._user_jobs: Dict[Any, Dict[str, int]] = {}
+        self._job_owners: Dict[str, Tuple[Any, str]] = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, state TEXT NOT NULL, payload TEXT NOT NULL, "
+            "result TEXT, claimed_by TEXT, claimed_at REAL, created_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)")
+
+    def _transaction(self, func, *args):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    # --- frontend ---
+
+    async def submit(self, payload: Dict[str, Any], callback: Any = None) -> str:
+        """Кладет задание в канал; callback получит результат в этом процессе"""
+        job_id = uuid.uuid4().hex
+        if callback is not None:
+            self._callbacks[job_id] = callback
+        context = payload.get("context") or {}
+        user_id = context.get("user_id")
+        if user_id is not None:
+            unit = context.get("batch_id") or job_id
+            units = self._user_jobs.setdefault(user_id, {})
+            units[unit] = units.get(unit, 0) + 1
+            self._job_owners[job_id] = (user_id, unit)
+        await asyncio.to_thread(
+            self._transaction,
+            self._db.execute,
+            "INSERT INTO jobs (job_id, state, payload, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, JOB_PENDING, json.dumps(payload), time.time())
+        )
+        return job_id
+
+    def _forget(self, job_id: str) -> None:
+        """Освобождает место задания в лимите пользователя"""
+        owner = self._job_owners.pop(job_id, None)
+        if owner is None:
+            return
+        user_id, unit = owner
+        units = self._user_jobs.get(user_id, {})
+        if units.get(unit, 0) > 1:
+            units[unit] -= 1
+            return
+        units.pop(unit, None)
+        if not units:
+            self._user_jobs.pop(user_id, None)
+
+    def user_jobs(self, user_id: Any) -> int:
+        """Незавершенные задания пользователя, отправленные этим frontend'ом (пакет - одно)"""
+        return len(self._user_jobs.get(user_id, {}))
+
+    def has_batch(self, user_id: Any, batch_id: Optional[str]) -> bool:
+        """Есть ли у пользователя незавершенные задания пакета batch_id"""
+        return batch_id is not None and batch_id in self._user_jobs.get(user_id, {})
+
+    def _pending_count(self) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = ?", (JOB_PENDING,)
+            ).fetchone()[0]
+
+    async def pending_count(self) -> int:
+        """Задания, которые еще не взял ни один воркер"""
+        return await asyncio.to_thread(self._pending_count)
+
+    def _take_results(self, limit: int) -> List[Tuple[str, Dict[str, Any], Dict[str, Any]]]:
+        rows = self._db.execute(
+            "SELECT job_id, payload, result FROM jobs WHERE state = ? ORDER BY created_at LIMIT ?",
+            (JOB_DONE, limit)
+        ).fetchall()
+        if rows:
+            self._db.executemany("DELETE FROM jobs WHERE job_id = ?", [(row[0],) for row in rows])
+        return [(job_id, json.loads(payload), json.loads(result)) for job_id, payload, result in rows]
+
+    async def deliver_results(
+        self,
+        fallback: Optional[Callable[[Optional[Dict[str, Any]]], Any]] = None
+    ) -> None:
+        """Цикл frontend: передает готовые результаты в callback'и"""
+        while True:
+            try:
+                results = await asyncio.to_thread(self._transaction, self._take_results, 50)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to read job results: {e}")
+                results = []
+            for job_id, payload, result in results:
+                self._forget(job_id)
+                callback = self._callbacks.pop(job_id, None)
+                if callback is None and fallback is not None:
+                    # Задание отправлено до перезапуска frontend
+                    callback = fallback(payload.get("context"))
+                if callback is None:
+                    logger.warning(f"Dropping result of job {job_id}: no callback")
+                    continue
+                try:
+                    await callback(result)
+                except Exception as e:
+                    logger.error(f"Error delivering job {job_id} result: {e}", exc_info=True)
+            if not results:
+                await asyncio.sleep(self.poll_interval)
+
+    # --- worker ---
+
+    @staticmethod
+    def _flow(payload: Dict[str, Any]) -> Tuple[str, Hashable]:
+        """(полоса, пользователь) задания, как у задач в FairQueue"""
+        user_id = (payload.get("context") or {}).get("user_id")
+        return priority_lane(user_id), user_id
+
+    def _fair_order(
+        self,
+        pending: List[Tuple[str, str]],
+        claimed: List[Tuple[str]]
+    ) -> List[Tuple[str, Dict[str, Any]]]:
+        """Порядок выдачи: по числу заданий пользователя в работе, деленному на вес полосы.
+
+        При равенстве - в порядке поступления. Порядок считается по состоянию
+        канала, поэтому одинаков для всех воркеров.
+        """
+        weights = lane_weights()
+        taken = Counter(self._flow(json.loads(payload)) for (payload,) in claimed)
+        ranked = []
+        for position, (job_id, payload) in enumerate(pending):
+            payload = json.loads(payload)
+            flow = self._flow(payload)
+            taken[flow] += 1
+            share = taken[flow] / max(0.01, weights.get(flow[0], 1.0))
+            ranked.append((share, position, job_id, payload))
+        ranked.sort(key=lambda item: item[:2])
+        return [(job_id, payload) for _, _, job_id, payload in ranked]
+
+    def _claim(self, limit: int) -> List[Tuple[str, Dict[str, Any]]]:
+        now = time.time()
+        # Задания воркеров, переставших продлевать захват
+        self._db.execute(
+            "UPDATE jobs SET state = ?, claimed_by = NULL WHERE state = ? AND claimed_at < ?",
+            (JOB_PENDING, JOB_CLAIMED, now - self.claim_ttl)
+        )
+        # Невзятых заданий не больше MAX_QUEUE_DEPTH (ограничивает frontend)
+        pending = self._db.execute(
+            "SELECT job_id, payload FROM jobs WHERE state = ? ORDER BY created_at", (JOB_PENDING,)
+        ).fetchall()
+        if not pending:
+            return []
+        claimed = self._db.execute("SELECT payload FROM jobs WHERE state = ?", (JOB_CLAIMED,)).fetchall()
+        jobs = self._fair_order(pending, claimed)[:limit]
+        self._db.executemany(
+            "UPDATE jobs SET state = ?, claimed_by = ?, claimed_at = ? WHERE job_id = ?",
+            [(JOB_CLAIMED, self.holder, now, job_id) for job_id, _ in jobs]
+        )
+        return jobs
+
+    async def claim(self, limit: int) -> List[Tuple[str, Dict[str, Any]]]:
+        """Забирает до limit заданий из очереди"""
+        return await asyncio.to_thread(self._transaction, self._claim, limit)
+
+    def _adopt(self, job_id: str) -> None:
+        self._db.execute(
+            "UPDATE jobs SET state = ?, claimed_by = ?, claimed_at = ? WHERE job_id = ? AND state != ?",
+            (JOB_CLAIMED, self.holder, time.time(), job_id, JOB_DONE)
+        )
+
+    async def adopt(self, job_id: str) -> None:
+        """Закрепляет за воркером задание, восстановленное после его перезапуска"""
+        await asyncio.to_thread(self._transaction, self._adopt, job_id)
+
+    async def complete(self, job_id: str, result: Dict[str, Any]) -> None:
+        """Возвращает результат задания frontend'у"""
+        await asyncio.to_thread(
+            self._transaction,
+            self._db.execute,
+            "UPDATE jobs SET state = ?, result = ? WHERE job_id = ? AND state != ?",
+            (JOB_DONE, json.dumps(result), job_id, JOB_DONE)
+        )
+
+    async def renew(self) -> None:
+        """Продлевает захват заданий этого воркера"""
+        await asyncio.to_thread(
+            self._transaction,
+            self._db.execute,
+            "UPDATE jobs SET claimed_at = ? WHERE state = ? AND claimed_by = ?",
+            (time.time(), JOB_CLAIMED, self.holder)
+        )
+
+    async def consume(
+        self,
+        handler: Callable[[str, Dict[str, Any]], Awaitable[bool]],
+        capacity: Callable[[], int]
+    ) -> None:
+        """Цикл воркера: забирает задания, пока есть свободная емкость"""
+        last_renew = 0.0
+        while True:
+            try:
+                if time.monotonic() - last_renew > self.claim_ttl / 3:
+                    await self.renew()
+                    last_renew = time.monotonic()
+                free = capacity()
+                jobs = await self.claim(free) if free > 0 else []
+            except sqlite3.Error as e:
+                logger.error(f"Failed to claim jobs: {e}")
+                jobs = []
+            for job_id, payload in jobs:
+                try:
+                    accepted = await handler(job_id, payload)
+                except Exception as e:
+                    logger.error(f"Error starting job {job_id}: {e}", exc_info=True)
+                    accepted = False
+                if not accepted:
+                    # Причина отказа (очередь, лимит пользователя) нужна frontend'у для ответа
+                    await self.complete(job_id, {"status": "FAILED", "reason": getattr(accepted, "reason", None)})
+            if not jobs:
+                await asyncio.sleep(self.poll_interval)
+
+    def close(self) -> None:
+        """Закрывает SQLite"""
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+# Допустимое отличие среднего цвета (по каналу) и пропорций почти одинаковых изображений
+MAX_COLOR_DIFFERENCE = 12
+MAX_ASPECT_DIFFERENCE = 0.02
+
+class PerceptualIndex:
+    """Индекс перцептивных хэшей (64-битный dHash) для поиска почти одинаковых изображений.
+
+    Поиск по расстоянию Хэмминга через multi-index hashing: хэш делится на
+    max_distance + 1 частей, и у хэшей на расстоянии не больше max_distance
+    хотя бы одна часть совпадает точно (принцип Дирихле). Кандидаты
+    берутся из таблиц частей, поэтому поиск не перебирает весь индекс.
+
+    Каждому хэшу соответствует digest (sha256) изображения, загруженного
+    первым, и его сигнатура (размеры и средний цвет): близкие хэши считаются
+    одним изображением, только если совпадают и сигнатуры. Объем ограничен
+    max_entries, вытесняются давно не найденные записи (LRU).
+    """
+
+    def __init__(self, max_distance: int = 3, max_entries: int = 100000, bits: int = 64):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        parts = max_distance + 1
+        # Границы частей хэша: (сдвиг, маска)
+        self._parts = []
+        start = 0
+        for index in range(parts):
+            width = bits // parts + (1 if index < bits % parts else 0)
+            self._parts.append((start, (1 << width) - 1))
+            start += width
+        self._tables: List[Dict[int, Set[int]]] = [{} for _ in self._parts]
+        self._entries: "OrderedDict[int, Tuple[str, Optional[tuple]]]" = OrderedDict()
+        # digest изображения -> digest найденного почти одинакового
+        self._aliases: "OrderedDict[str, str]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _chunks(self, fingerprint: int):
+        for table, (shift, mask) in zip(self._tables, self._parts):
+            yield table, (fingerprint >> shift) & mask
+
+    @staticmethod
+    def _similar(signature: Optional[tuple], other: Optional[tuple]) -> bool:
+        """Совпадают ли пропорции и средний цвет (без сигнатуры сравнивается только хэш)"""
+        if signature is None or other is None:
+            return True
+        width, height, *color = signature
+        other_width, other_height, *other_color = other
+        aspect, other_aspect = width / height, other_width / other_height
+        if abs(aspect - other_aspect) > MAX_ASPECT_DIFFERENCE * max(aspect, other_aspect):
+            return False
+        return all(abs(a - b) <= MAX_COLOR_DIFFERENCE for a, b in zip(color, other_color))
+
+    def find(self, fingerprint: int, signature: Optional[tuple] = None) -> Optional[str]:
+        """digest ближайшего похожего изображения на расстоянии не больше max_distance"""
+        best, best_distance = None, self.max_distance + 1
+        seen = set()
+        for table, chunk in self._chunks(fingerprint):
+            for candidate in table.get(chunk, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                distance = bin(candidate ^ fingerprint).count("1")
+                if distance < best_distance and self._similar(signature, self._entries[candidate][1]):
+                    best, best_distance = candidate, distance
+        if best is None:
+            return None
+        self._entries.move_to_end(best)
+        return self._entries[best][0]
+
+    def add(self, fingerprint: int, digest: str, signature: Optional[tuple] = None) -> str:
+        """Добавляет изображение; возвращает digest почти одинакового из индекса или свой"""
+        canonical = self.find(fingerprint, signature)
+        if canonical is None:
+            canonical = digest
+            # Тот же хэш у непохожего изображения: в индексе остается первое
+            if fingerprint not in self._entries:
+                for table, chunk in self._chunks(fingerprint):
+                    table.setdefault(chunk, set()).add(fingerprint)
+                self._entries[fingerprint] = (digest, signature)
+                while len(self._entries) > self.max_entries:
+                    self._remove(self._entries.popitem(last=False)[0])
+        self._remember(digest, canonical)
+        return canonical
+
+    def canonical(self, digest: str) -> str:
+        """digest, под которым известно это изображение (свой, если похожих не было)"""
+        return self._aliases.get(digest, digest)
+
+    def alias(self, digest: str) -> Optional[str]:
+        """Уже найденный для этого digest результат или None"""
+        canonical = self._aliases.get(digest)
+        if canonical is not None:
+            self._aliases.move_to_end(digest)
+        return canonical
+
+    def _remember(self, digest: str, canonical: str) -> None:
+        self._aliases[digest] = canonical
+        self._aliases.move_to_end(digest)
+        while len(self._aliases) > self.max_entries:
+            self._aliases.popitem(last=False)
+
+    def _remove(self, fingerprint: int) -> None:
+        for table, chunk in self._chunks(fingerprint):
+            bucket = table.get(chunk)
+            if bucket is not None:
+                bucket.discard(fingerprint)
+                if not bucket:
+                    del table[chunk]
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class Stage:
+    """Стадия конвейера с собственной ограниченной очередью и пулом обработчиков"""
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Any], Awaitable[None]],
+        concurrency: int,
+        maxsize: int = 0,
+        queue: Optional[asyncio.Queue] = None
+    ):
+        self.name = name
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        # Можно передать очередь со своим порядком выдачи (например, FairQueue)
+        self.queue: asyncio.Queue = queue if queue is not None else asyncio.Queue(maxsize=maxsize)
+        self._workers: List[asyncio.Task] = []
+        self._running = False
+
+        # Метрики стадии
+        self.in_progress = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_service_time = 0.0
+        self.last_service_time = 0.0
+        self.max_queue_depth = 0
+
+    async def put(self, item: Any) -> None:
+        """Ставит элемент в очередь стадии (ждет, если очередь заполнена)"""
+        await self.queue.put(item)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def offer(self, item: Any) -> bool:
+        """Ставит элемент в очередь без ожидания; False, если очередь заполнена"""
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            return False
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return True
+
+    def start(self) -> None:
+        """Запускает обработчики стадии"""
+        if self._running:
+            return
+        self._running = True
+        loop = asyncio.get_running_loop()
+        self._workers = [
+            loop.create_task(self._worker(), name=f"stage_{self.name}_{i}")
+            for i in range(self.concurrency)
+        ]
+
+    async def stop(self) -> None:
+        """Останавливает обработчики стадии"""
+        self._running = False
+        for worker in self._workers:
+            if not worker.done():
+                worker.cancel()
+        results = await asyncio.gather(*self._workers, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+                logger.error(f"Error in stage {self.name} worker: {result}")
+        self._workers = []
+
+    def drain(self) -> List[Any]:
+        """Забирает все необработанные элементы из очереди"""
+        items = []
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+            self.queue.task_done()
+        return items
+
+    async def _worker(self) -> None:
+        """Забирает элементы из очереди и передает их обработчику"""
+        while self._running:
+            item = await self.queue.get()
+            self.in_progress += 1
+            started = time.monotonic()
+            try:
+                await self.handler(item)
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Unhandled error in stage {self.name}: {e}", exc_info=True)
+            finally:
+                self.last_service_time = time.monotonic() - started
+                self.total_service_time += self.last_service_time
+                self.in_progress -= 1
+                self.queue.task_done()
+
+    @property
+    def avg_service_time(self) -> float:
+        """Среднее время обработки одного элемента в секундах"""
+        completed = self.processed + self.failed
+        return self.total_service_time / completed if completed else 0.0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Возвращает метрики стадии"""
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "queue_limit": self.queue.maxsize,
+            "in_progress": self.in_progress,
+            "concurrency": self.concurrency,
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_service_time": round(self.avg_service_time, 3),
+            "last_service_time": round(self.last_service_time, 3),
+        }
+
+class Pipeline:
+    """Набор последовательных стадий обработки"""
+
+    def __init__(self, stages: Optional[List[Stage]] = None):
+        self.stages: Dict[str, Stage] = {}
+        for stage in stages or []:
+            self.add_stage(stage)
+
+    def add_stage(self, stage: Stage) -> None:
+        """Добавляет стадию"""
+        self.stages[stage.name] = stage
+
+    def __getitem__(self, name: str) -> Stage:
+        return self.stages[name]
+
+    def start(self) -> None:
+        """Запускает все стадии"""
+        for stage in self.stages.values():
+            stage.start()
+
+    async def stop(self) -> None:
+        """Останавливает все стадии"""
+        for stage in self.stages.values():
+            await stage.stop()
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Возвращает метрики всех стадий"""
+        return {name: stage.get_stats() for name, stage in self.stages.items()}
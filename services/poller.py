@@ -0,0 +1,296 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import config
+from .runninghub import RunningHubAPI, CODE_SUCCESS, CODE_TASK_RUNNING, CODE_TASK_QUEUED, runninghub_api
+from .stats import LatencyStats, METRIC_RUN, METRIC_START, latency_stats
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class PolledTask:
+    task_id: str
+    api_key: str
+    workflow_id: Optional[str]
+    future: asyncio.Future
+    started_at: float = field(default_factory=time.monotonic)
+    deadline: float = 0.0
+    polls: int = 0
+    errors: int = 0
+    status_code: Optional[int] = None
+    running: bool = False  # Задача вышла из очереди RunningHub
+    seq: int = 0
+
+class RateLimiter:
+    """Token bucket: ограничивает количество запросов в секунду"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def try_acquire(self) -> float:
+        """Забирает токен; возвращает 0 или время ожидания следующего токена"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class TaskPoller:
+    """Единый опрос статусов всех задач RunningHub, находящихся в работе"""
+
+    def __init__(self, api: Optional[RunningHubAPI] = None, stats: Optional[LatencyStats] = None):
+        self.runninghub_api = api or runninghub_api
+        # Наблюдаемое время выполнения по workflow и аккаунтам
+        self.stats = stats or latency_stats
+        self._tasks: Dict[str, PolledTask] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._limiters: Dict[str, RateLimiter] = {}
+        # Создаются в start(), внутри event loop (в Python 3.9 примитивы привязываются к loop)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._running = False
+        self._loop_task: Optional[asyncio.Task] = None
+        self._checks: set = set()
+        # Подписчики на коды статуса задач: callback(api_key, code)
+        self.status_listeners: List[Callable[[str, Optional[int]], None]] = []
+
+    def start(self) -> None:
+        """Запускает цикл опроса"""
+        if self._running:
+            return
+        self._running = True
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(config.runninghub.poll_concurrency)
+        self._loop_task = asyncio.get_running_loop().create_task(
+            self._run(), name="task_poller"
+        )
+
+    async def stop(self) -> None:
+        """Останавливает цикл опроса и завершает ожидающих"""
+        self._running = False
+        if self._loop_task and not self._loop_task.done():
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+        self._loop_task = None
+        for check in list(self._checks):
+            check.cancel()
+        for task in self._tasks.values():
+            if not task.future.done():
+                task.future.set_result(None)
+        self._tasks.clear()
+        self._heap.clear()
+
+    def watch(
+        self,
+        api_key: str,
+        task_id: str,
+        workflow_id: Optional[str] = None,
+        timeout: Optional[float] = None
+    ) -> asyncio.Future:
+        """Ставит задачу на опрос; future получит outputs или None"""
+        self.start()
+        existing = self._tasks.get(task_id)
+        if existing:
+            return existing.future
+
+        now = time.monotonic()
+        task = PolledTask(
+            task_id=task_id,
+            api_key=api_key,
+            workflow_id=workflow_id,
+            future=asyncio.get_running_loop().create_future(),
+            started_at=now,
+            deadline=now + (timeout or config.runninghub.task_timeout)
+        )
+        self._tasks[task_id] = task
+        self._schedule(task, now + self._next_interval(task, now))
+        return task.future
+
+    async def wait_for_outputs(
+        self,
+        api_key: str,
+        task_id: str,
+        workflow_id: Optional[str] = None,
+        timeout: Optional[float] = None
+    ) -> Optional[List[Dict[str, Any]]]:
+        """Ожидает результат задачи; None при ошибке или таймауте"""
+        return await asyncio.shield(self.watch(api_key, task_id, workflow_id, timeout))
+
+    def cancel(self, task_id: str) -> None:
+        """Снимает задачу с опроса"""
+        task = self._tasks.pop(task_id, None)
+        if task and not task.future.done():
+            task.future.set_result(None)
+
+    def get_status(self, task_id: str) -> Optional[int]:
+        """Последний код статуса задачи (804 - выполняется, 805 - в очереди)"""
+        task = self._tasks.get(task_id)
+        return task.status_code if task else None
+
+    @property
+    def in_flight(self) -> int:
+        """Количество задач на опросе"""
+        return len(self._tasks)
+
+    def expected_completion(self, workflow_id: Optional[str]) -> float:
+        """Ожидаемое время выполнения workflow в секундах"""
+        return self.stats.mean(
+            METRIC_RUN,
+            workflow_id=workflow_id,
+            default=config.runninghub.expected_completion_time
+        )
+
+    def _record_completion(self, task: PolledTask, now: float) -> None:
+        """Учитывает время выполнения задачи в статистике workflow и аккаунта"""
+        self.stats.record(METRIC_RUN, now - task.started_at, task.workflow_id, task.api_key)
+
+    def _next_interval(self, task: PolledTask, now: float) -> float:
+        """Адаптивный интервал: редко до ожидаемого завершения, часто около него"""
+        min_interval = config.runninghub.min_poll_interval
+        max_interval = config.runninghub.max_poll_interval
+        expected = self.expected_completion(task.workflow_id)
+        age = now - task.started_at
+        # Первая проверка - когда обычно завершаются самые быстрые задачи (p10)
+        first_check = self.stats.quantile(
+            METRIC_RUN, 0.1, workflow_id=task.workflow_id, default=expected * 0.8
+        )
+        if age < first_check:
+            return max(min_interval, min(max_interval, first_check - age))
+        # Частый опрос, пока не прошло время, за которое завершается 90% задач
+        slow_check = self.stats.quantile(
+            METRIC_RUN, 0.9, workflow_id=task.workflow_id, default=expected * 1.5
+        )
+        if age < max(expected * 1.5, slow_check):
+            return min_interval
+        # Задача задерживается - постепенно увеличиваем интервал
+        return max(min_interval, min(max_interval, (age - expected) * 0.25))
+
+    def _schedule(self, task: PolledTask, at: float) -> None:
+        """Добавляет проверку задачи в кучу"""
+        task.seq = next(self._seq)
+        # Проверка не позже дедлайна, чтобы таймаут срабатывал вовремя
+        heapq.heappush(self._heap, (min(at, task.deadline), task.seq, task.task_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _limiter(self, api_key: str) -> RateLimiter:
+        limiter = self._limiters.get(api_key)
+        if limiter is None:
+            limiter = RateLimiter(config.runninghub.poll_rate_per_account)
+            self._limiters[api_key] = limiter
+        return limiter
+
+    async def _run(self) -> None:
+        """Основной цикл: берет из кучи ближайшие проверки"""
+        while self._running:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            at, seq, task_id = self._heap[0]
+            now = time.monotonic()
+            if at > now:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=at - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            task = self._tasks.get(task_id)
+            # Устаревшая запись (задача снята или перепланирована)
+            if task is None or task.seq != seq:
+                continue
+
+            if now >= task.deadline:
+                logger.warning(
+                    f"Task {task_id} timed out after {now - task.started_at:.0f} seconds"
+                )
+                self._finish(task, None)
+                continue
+
+            wait = self._limiter(task.api_key).try_acquire()
+            if wait > 0:
+                self._schedule(task, now + wait)
+                continue
+
+            # Не допускаем повторного планирования, пока идет запрос
+            task.seq = -1
+            await self._semaphore.acquire()
+            check = asyncio.get_running_loop().create_task(self._check(task))
+            self._checks.add(check)
+            check.add_done_callback(self._checks.discard)
+
+    async def _check(self, task: PolledTask) -> None:
+        """Выполняет один запрос статуса задачи"""
+        try:
+            task.polls += 1
+            response = await self.runninghub_api.get_task_response(task.api_key, task.task_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error polling task {task.task_id}: {e}")
+            response = None
+        finally:
+            self._semaphore.release()
+
+        if task.task_id not in self._tasks:
+            return
+
+        now = time.monotonic()
+        if response is None:
+            task.errors += 1
+            if task.errors > config.runninghub.max_retries:
+                self._finish(task, None)
+            else:
+                self._schedule(task, now + config.runninghub.retry_delay)
+            return
+
+        task.errors = 0
+        code = response.get("code")
+        task.status_code = code
+        if not task.running and code in (CODE_SUCCESS, CODE_TASK_RUNNING):
+            # Время ожидания в очереди RunningHub (с точностью до интервала опроса)
+            task.running = True
+            self.stats.record(METRIC_START, now - task.started_at, task.workflow_id, task.api_key)
+        for listener in self.status_listeners:
+            try:
+                listener(task.api_key, code)
+            except Exception as e:
+                logger.error(f"Error in poller status listener: {e}", exc_info=True)
+        if code == CODE_SUCCESS and response.get("data"):
+            self._record_completion(task, now)
+            self._finish(task, response["data"])
+        elif code in (CODE_SUCCESS, CODE_TASK_RUNNING, CODE_TASK_QUEUED):
+            self._schedule(task, now + self._next_interval(task, now))
+        else:
+            logger.error(
+                f"Task {task.task_id} failed with code {code}: {response.get('msg')}"
+            )
+            self._finish(task, None)
+
+    def _finish(self, task: PolledTask, outputs: Optional[List[Dict[str, Any]]]) -> None:
+        """Завершает ожидание задачи"""
+        self._tasks.pop(task.task_id, None)
+        if not task.future.done():
+            task.future.set_result(outputs)
+        logger.debug(f"Task {task.task_id} finished after {task.polls} polls")
+
+# Единый экземпляр для всех компонентов
+task_poller = TaskPoller()
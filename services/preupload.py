@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Hashable, Optional
+
+from config import config
+from .account_manager import AccountManager, account_manager
+from .runninghub import RunningHubAPI, ImageSource, runninghub_api
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class PreUpload:
+    api_key: str
+    task: asyncio.Task
+    created_at: float = field(default_factory=time.monotonic)
+
+@dataclass
+class PreUploadResult:
+    api_key: str
+    file_name: str
+
+class PreUploader:
+    """Загружает фото продукта заранее, пока пользователь выбирает фон.
+
+    Аккаунт под загрузку мягко резервируется до тех пор, пока результат
+    не заберут через take() или загрузку не отменят через discard().
+    """
+
+    def __init__(self, account_manager: AccountManager, api: Optional[RunningHubAPI] = None):
+        self.account_manager = account_manager
+        self.runninghub_api = api or runninghub_api
+        self._uploads: Dict[Hashable, PreUpload] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def start(self, key: Hashable, source: ImageSource) -> Optional[str]:
+        """Начинает фоновую загрузку; возвращает выбранный аккаунт"""
+        self.discard(key)
+        api_key = self.account_manager.reserve_account()
+        if api_key is None:
+            return None
+
+        task = asyncio.get_running_loop().create_task(
+            self._upload(api_key, source),
+            name=f"preupload_{key}"
+        )
+        self._uploads[key] = PreUpload(api_key=api_key, task=task)
+        self._ensure_sweeper()
+        return api_key
+
+    async def take(self, key: Hashable) -> Optional[PreUploadResult]:
+        """Забирает результат загрузки и снимает резерв (задача резервирует аккаунт сама)"""
+        upload = self._uploads.pop(key, None)
+        if upload is None:
+            return None
+        try:
+            file_name = await upload.task
+        except asyncio.CancelledError:
+            file_name = None
+        finally:
+            self.account_manager.release_reservation(upload.api_key)
+        if not file_name:
+            return None
+        return PreUploadResult(api_key=upload.api_key, file_name=file_name)
+
+    def discard(self, key: Hashable) -> None:
+        """Отменяет загрузку и снимает резерв"""
+        upload = self._uploads.pop(key, None)
+        if upload is None:
+            return
+        if not upload.task.done():
+            upload.task.cancel()
+        self.account_manager.release_reservation(upload.api_key)
+
+    async def _upload(self, api_key: str, source: ImageSource) -> Optional[str]:
+        try:
+            file_name = await self.runninghub_api.upload_image(api_key, source)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Product pre-upload failed: {e}", exc_info=True)
+            return None
+        return file_name
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep())
+
+    async def _sweep(self) -> None:
+        """Снимает резервы брошенных загрузок"""
+        while self._uploads:
+            await asyncio.sleep(config.runninghub.preupload_ttl / 4)
+            now = time.monotonic()
+            for key, upload in list(self._uploads.items()):
+                if now - upload.created_at > config.runninghub.preupload_ttl:
+                    logger.info(f"Discarding abandoned pre-upload {key}")
+                    self.discard(key)
+
+    async def close(self) -> None:
+        """Отменяет все загрузки"""
+        for key in list(self._uploads):
+            self.discard(key)
+        if self._sweeper and not self._sweeper.done():
+            self._sweeper.cancel()
+
+preuploader = PreUploader(account_manager)
@@ -0,0 +1,183 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class ResultCache:
+    """Кэш готовых результатов на диске: ключ запроса -> изображения и их file_id в Telegram.
+
+    Ключ - sha256 от хэшей исходных изображений и seed. Файлы лежат в
+    каталоге кэша, индекс - в SQLite там же. При превышении max_bytes
+    вытесняются результаты, которые дольше всех не запрашивались (LRU).
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        if directory:
+            self._open_db()
+
+    @property
+    def enabled(self) -> bool:
+        """Включен ли кэш (задан каталог и индекс открылся)"""
+        return self._db is not None
+
+    def _open_db(self) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._db = sqlite3.connect(
+                os.path.join(self.directory, "index.sqlite"),
+                check_same_thread=False,
+                isolation_level=None
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, result TEXT NOT NULL, paths TEXT NOT NULL, "
+                "file_ids TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+            self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Failed to open result cache {self.directory}: {e}")
+            self._db = None
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """Ключ результата по хэшам исходных изображений и параметрам workflow"""
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result, paths, file_ids FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            result, paths, file_ids = json.loads(row[0]), json.loads(row[1]), json.loads(row[2])
+            if not all(os.path.isfile(path) for path in paths):
+                # Файлы удалены с диска - запись бесполезна
+                self._delete(key)
+                return None
+            self._db.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+        return dict(result, cache_key=key, output_paths=paths, output_file_ids=file_ids)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Готовый результат запроса или None"""
+        if not self.enabled:
+            return None
+        try:
+            result = await asyncio.to_thread(self._get, key)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to read result cache: {e}")
+            result = None
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def _put(self, key: str, result: Dict[str, Any], images: List[bytes], urls: List[str]) -> List[str]:
+        paths = []
+        # Свои имена файлов у каждой записи: замена записи с тем же ключом
+        # удаляет только файлы старой
+        version = uuid.uuid4().hex[:8]
+        for index, (data, url) in enumerate(zip(images, urls)):
+            extension = os.path.splitext(urlparse(url).path)[1] or ".png"
+            path = os.path.join(self.directory, f"{key}_{version}_{index}{extension}")
+            with open(path, "wb") as file:
+                file.write(data)
+            paths.append(path)
+        size = sum(len(data) for data in images)
+        with self._lock:
+            self._delete(key)
+            self._db.execute(
+                "INSERT INTO results (key, result, paths, file_ids, size, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, json.dumps(result), json.dumps(paths), json.dumps([None] * len(paths)), size, time.time())
+            )
+            self._size += size
+            self._evict()
+        return paths
+
+    async def put(self, key: str, result: Dict[str, Any], images: List[bytes], urls: List[str]) -> Dict[str, Any]:
+        """Сохраняет изображения результата; возвращает результат со ссылками на файлы кэша"""
+        if not self.enabled or sum(len(data) for data in images) > self.max_bytes:
+            return result
+        try:
+            paths = await asyncio.to_thread(self._put, key, result, images, urls)
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Failed to store result in cache: {e}")
+            return result
+        return dict(result, cache_key=key, output_paths=paths, output_file_ids=[None] * len(paths))
+
+    def _set_file_id(self, key: str, index: int, file_id: str) -> None:
+        with self._lock:
+            row = self._db.execute("SELECT file_ids FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return
+            file_ids = json.loads(row[0])
+            if index < len(file_ids):
+                file_ids[index] = file_id
+                self._db.execute(
+                    "UPDATE results SET file_ids = ? WHERE key = ?", (json.dumps(file_ids), key)
+                )
+
+    async def remember_file_id(self, key: str, index: int, file_id: str) -> None:
+        """Запоминает file_id отправленного изображения - повторно оно не загружается в Telegram"""
+        if not self.enabled:
+            return
+        try:
+            await asyncio.to_thread(self._set_file_id, key, index, file_id)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to remember file_id: {e}")
+
+    def _delete(self, key: str) -> None:
+        """Удаляет запись и ее файлы (под блокировкой)"""
+        row = self._db.execute("SELECT paths, size FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return
+        for path in json.loads(row[0]):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+        self._size -= row[1]
+
+    def _evict(self) -> None:
+        """Вытесняет давно не запрошенные результаты, пока кэш не уложится в лимит"""
+        while self._size > self.max_bytes:
+            row = self._db.execute("SELECT key FROM results ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                self._size = 0
+                return
+            self._delete(row[0])
+
+    def close(self) -> None:
+        """Закрывает индекс"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+# Кэш результатов на постоянном томе (пустой путь - без кэша)
+result_cache = ResultCache(
+    directory=config.runninghub.result_cache_path or None,
+    max_bytes=config.runninghub.result_cache_max_mb * 1024 * 1024
+)
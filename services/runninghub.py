@@ -1,39 +1,321 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import time
 import aiohttp
-from typing import Dict, Optional, List, Any
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, List, Any, Tuple, Union
 from dataclasses import dataclass
 
+from config import config
+from .image_prep import ImageNormalizer
+from .phash import PerceptualIndex
+
+# Источник изображения для загрузки
+ImageSource = Union[str, bytes, io.IOBase]
+
+# Коды ответов RunningHub
+CODE_SUCCESS = 0
+CODE_TASK_RUNNING = 804
+CODE_TASK_QUEUED = 805
+CODE_QUEUE_MAXED = 421
+# Коды, означающие, что аккаунт перегружен и задачу нужно отложить
+OVERLOAD_CODES = (CODE_TASK_QUEUED, CODE_QUEUE_MAXED)
+OVERLOAD_HTTP_STATUSES = (429, 503)
+
+class RunningHubOverloadError(Exception):
+    """Аккаунт RunningHub не принял задачу из-за очереди или перегрузки"""
+
+    def __init__(self, api_key: str, code: Optional[int] = None, message: str = ""):
+        super().__init__(f"RunningHub account overloaded (code: {code}) {message}".strip())
+        self.api_key = api_key
+        self.code = code
+
 @dataclass
 class RunningHubAccount:
     api_key: str
     workflow_id: str
     max_tasks: int = 5
 
+class UploadCache:
+    """Кэш загрузок: (sha256 изображения, api_key) -> fileName в RunningHub.
+
+    Записи живут ttl секунд, при переполнении вытесняются самые старые по
+    использованию (LRU). Если задан путь, кэш дублируется в SQLite и
+    переживает перезапуск.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 86400, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self._open_db(path)
+
+    def _open_db(self, path: str) -> None:
+        """Открывает SQLite и загружает актуальные записи"""
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "digest TEXT NOT NULL, api_key TEXT NOT NULL, file_name TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, PRIMARY KEY (digest, api_key))"
+            )
+            now = time.time()
+            self._db.execute("DELETE FROM uploads WHERE expires_at <= ?", (now,))
+            rows = self._db.execute(
+                "SELECT digest, api_key, file_name, expires_at FROM uploads "
+                "ORDER BY expires_at DESC LIMIT ?",
+                (self.max_entries,)
+            ).fetchall()
+            for digest, api_key, file_name, expires_at in reversed(rows):
+                self._entries[(digest, api_key)] = (file_name, expires_at)
+            logging.info(f"Loaded {len(rows)} cached uploads from {path}")
+        except sqlite3.Error as e:
+            logging.error(f"Failed to open upload cache {path}: {e}")
+            self._db = None
+
+    def get(self, digest: str, api_key: str) -> Optional[str]:
+        """Возвращает fileName, если изображение уже загружено на этот аккаунт"""
+        key = (digest, api_key)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        file_name, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return file_name
+
+    async def put(self, digest: str, api_key: str, file_name: str) -> None:
+        """Сохраняет результат загрузки"""
+        key = (digest, api_key)
+        expires_at = time.time() + self.ttl
+        self._entries[key] = (file_name, expires_at)
+        self._entries.move_to_end(key)
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(self._entries.popitem(last=False)[0])
+        if self._db is not None:
+            await asyncio.to_thread(self._persist, key, file_name, expires_at, evicted)
+
+    def _persist(self, key: Tuple[str, str], file_name: str, expires_at: float, evicted: List[Tuple[str, str]]) -> None:
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO uploads (digest, api_key, file_name, expires_at) VALUES (?, ?, ?, ?)",
+                (key[0], key[1], file_name, expires_at)
+            )
+            if evicted:
+                self._db.executemany("DELETE FROM uploads WHERE digest = ? AND api_key = ?", evicted)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to persist upload cache entry: {e}")
+
+    def close(self) -> None:
+        """Закрывает SQLite"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def hash_image_source(source: ImageSource) -> Optional[str]:
+    """Считает sha256 локального источника изображения; для URL возвращает None"""
+    if isinstance(source, io.BytesIO):
+        # Хэшируем буфер без копирования
+        return await asyncio.to_thread(lambda: hashlib.sha256(source.getbuffer()).hexdigest())
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return await asyncio.to_thread(lambda: hashlib.sha256(source).hexdigest())
+    if isinstance(source, str) and not source.startswith(("http://", "https://")):
+        path = source[len("file://"):] if source.startswith("file://") else source
+        if os.path.isfile(path):
+            return await asyncio.to_thread(_hash_file, path)
+    return None
+
+upload_cache = UploadCache(
+    max_entries=config.runninghub.upload_cache_size,
+    ttl=config.runninghub.upload_cache_ttl,
+    path=config.runninghub.upload_cache_path or None
+)
+
+# Подготовка фото к загрузке (поворот по EXIF, уменьшение, пережатие)
+image_normalizer = ImageNormalizer(
+    max_side=config.runninghub.image_max_side,
+    quality=config.runninghub.image_jpeg_quality,
+    max_bytes=config.runninghub.image_max_bytes,
+    workers=config.runninghub.image_workers
+)
+
+# Почти одинаковые фоны (другое сжатие, масштаб) считаются одним изображением
+background_index = PerceptualIndex(
+    max_distance=config.runninghub.near_duplicate_distance,
+    max_entries=config.runninghub.near_duplicate_index_size
+)
+
 class RunningHubAPI:
-    def __init__(self, api_url: str = "https://www.runninghub.ai"):
+    def __init__(
+        self,
+        api_url: str = "https://www.runninghub.ai",
+        cache: Optional[UploadCache] = None,
+        normalizer: Optional[ImageNormalizer] = None,
+        backgrounds: Optional[PerceptualIndex] = None
+    ):
         self._session = None
         self.api_url = api_url
+        self.upload_cache = cache or upload_cache
+        self.normalizer = normalizer or image_normalizer
+        self.backgrounds = backgrounds or background_index
+        # Одинаковые загрузки, выполняющиеся прямо сейчас
+        self._uploads_in_flight: Dict[Tuple[str, str], asyncio.Future] = {}
 
-    async def _get_session(self):
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию с пулом keep-alive соединений"""
         if self._session is None or self._session.closed:
-            self._session = aiohttp.ClientSession()
+            http = config.runninghub
+            connector = aiohttp.TCPConnector(
+                limit=http.http_pool_size,
+                limit_per_host=http.http_pool_size_per_host,
+                keepalive_timeout=http.http_keepalive_timeout,
+                ttl_dns_cache=http.http_dns_cache_ttl,
+                enable_cleanup_closed=True
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=http.http_timeout,
+                    connect=http.http_connect_timeout
+                )
+            )
         return self._session
 
-    async def upload_image(self, api_key: str, image_url: str) -> Optional[str]:
-        """Загружает изображение в RunningHub"""
+    @staticmethod
+    def _timeout(total: float) -> aiohttp.ClientTimeout:
+        """Таймаут отдельного запроса"""
+        return aiohttp.ClientTimeout(total=total, connect=config.runninghub.http_connect_timeout)
+
+    @asynccontextmanager
+    async def _open_image_source(self, source: ImageSource) -> AsyncIterator[Optional[Any]]:
+        """Открывает источник изображения как потоковый payload без копирования в память"""
+        if isinstance(source, (bytes, bytearray, memoryview, io.IOBase)):
+            # BytesIO от bot.download_file и уже прочитанные байты передаем как есть
+            if isinstance(source, io.IOBase) and source.seekable():
+                source.seek(0)
+            yield source
+            return
+
+        source = str(source)
+        if source.startswith(("http://", "https://")):
+            session = await self._get_session()
+            async with session.get(
+                source,
+                timeout=self._timeout(config.runninghub.http_upload_timeout)
+            ) as download_response:
+                if download_response.status != 200:
+                    yield None
+                    return
+                # Тело ответа (например, файл Telegram) потоково уходит в multipart
+                yield download_response.content
+            return
+
+        path = source[len("file://"):] if source.startswith("file://") else source
+        if not os.path.isfile(path):
+            yield None
+            return
+        file = await asyncio.to_thread(open, path, "rb")
+        try:
+            yield file
+        finally:
+            file.close()
+
+    async def background_digest(self, source: ImageSource) -> Optional[str]:
+        """sha256 фона; для почти одинакового уже известного фона - его digest.
+
+        Так загрузки и готовые результаты переиспользуются, даже если фон
+        прислан с другим сжатием или в другом размере.
+        """
+        digest = await hash_image_source(source)
+        if digest is None or not config.runninghub.near_duplicate_backgrounds:
+            return digest
+        canonical = self.backgrounds.alias(digest)
+        if canonical is not None:
+            return canonical
+        fingerprint = await self.normalizer.fingerprint(source)
+        if fingerprint is None:
+            # Однотонные фоны и градиенты сравниваются только по точному sha256
+            return digest
+        value, signature = fingerprint
+        canonical = self.backgrounds.add(value, digest, signature)
+        if canonical != digest:
+            logging.info(f"Background {digest[:12]} is a near duplicate of {canonical[:12]}")
+        return canonical
+
+    async def upload_image(self, api_key: str, source: ImageSource) -> Optional[str]:
+        """Загружает изображение в RunningHub.
+
+        Источник: URL (в том числе файл Telegram), локальный путь, BytesIO или bytes.
+        Повторная загрузка тех же байтов на тот же аккаунт берется из кэша.
+        Перед загрузкой фото нормализуется (кэш ведется по исходным байтам).
+        """
+        digest = await hash_image_source(source)
+        if digest is None:
+            return await self._upload_image(api_key, await self.normalizer.normalize(source))
+        # Почти одинаковый фон, уже загруженный на аккаунт, не загружается заново
+        digest = self.backgrounds.canonical(digest)
+
+        file_name = self.upload_cache.get(digest, api_key)
+        if file_name:
+            logging.debug(f"Upload cache hit for {digest[:12]}")
+            return file_name
+
+        key = (digest, api_key)
+        in_flight = self._uploads_in_flight.get(key)
+        if in_flight is not None:
+            return await asyncio.shield(in_flight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._uploads_in_flight[key] = future
+        try:
+            file_name = await self._upload_image(api_key, await self.normalizer.normalize(source))
+            if file_name:
+                await self.upload_cache.put(digest, api_key, file_name)
+            future.set_result(file_name)
+            return file_name
+        except BaseException:
+            future.set_result(None)
+            raise
+        finally:
+            del self._uploads_in_flight[key]
+
+    async def _upload_image(self, api_key: str, source: ImageSource) -> Optional[str]:
+        """Загружает изображение в RunningHub без использования кэша"""
         session = await self._get_session()
-        
-        # Сначала скачиваем изображение
-        async with session.get(image_url) as download_response:
-            if download_response.status != 200:
+
+        async with self._open_image_source(source) as payload:
+            if payload is None:
                 return None
-                
-            image_data = await download_response.read()
-            
-            # Теперь загружаем в RunningHub
+
             form_data = aiohttp.FormData()
             form_data.add_field(
                 'file',
-                image_data,
+                payload,
                 filename='image.jpg',
                 content_type='image/jpeg'
             )
@@ -42,32 +324,44 @@ class RunningHubAPI:
             async with session.post(
                 f"{self.api_url}/task/openapi/upload",
                 headers={"Authorization": f"Bearer {api_key}"},
-                data=form_data
+                data=form_data,
+                timeout=self._timeout(config.runninghub.http_upload_timeout)
             ) as response:
                 if response.status == 200:
                     data = await response.json()
                     return data.get("data", {}).get("fileName")
                 return None
 
+    async def upload_images(self, api_key: str, *sources: ImageSource) -> List[Optional[str]]:
+        """Параллельно загружает несколько изображений на один аккаунт"""
+        results = await asyncio.gather(
+            *(self.upload_image(api_key, source) for source in sources),
+            return_exceptions=True
+        )
+        file_names = []
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f"RunningHub upload error: {result}")
+                file_names.append(None)
+            else:
+                file_names.append(result)
+        return file_names
+
     async def create_task(
         self,
         api_key: str,
         workflow_id: str,
-        product_image_url: str,
-        background_image_url: str
+        product_file: str,
+        background_file: str,
+        seed: Optional[int] = None
     ) -> Optional[str]:
-        """Создает задачу в RunningHub"""
+        """Создает задачу в RunningHub из ранее загруженных файлов.
+
+        При ответе об очереди или перегрузке аккаунта бросает RunningHubOverloadError.
+        """
         session = await self._get_session()
         
         try:
-            product_file = await self.upload_image(api_key, product_image_url)
-            if not product_file:
-                return None
-
-            background_file = await self.upload_image(api_key, background_image_url)
-            if not background_file:
-                return None
-
             payload = {
                 "workflowId": workflow_id,
                 "apiKey": api_key,
@@ -84,36 +378,65 @@ class RunningHubAPI:
                     }
                 ]
             }
+            if seed is not None and config.runninghub.seed_node_id:
+                # Новый seed дает другой вариант генерации на тех же файлах
+                payload["nodeInfoList"].append({
+                    "nodeId": config.runninghub.seed_node_id,
+                    "fieldName": "seed",
+                    "fieldValue": seed
+                })
 
             async with session.post(
                 f"{self.api_url}/task/openapi/create",
-                json=payload
+                json=payload,
+                timeout=self._timeout(config.runninghub.http_timeout)
             ) as response:
+                if response.status in OVERLOAD_HTTP_STATUSES:
+                    raise RunningHubOverloadError(api_key, message=f"HTTP {response.status}")
                 if response.status == 200:
                     data = await response.json()
-                    if data.get("code") == 805:  # Task in queue
-                        return "QUEUED"
-                    return data.get("data", {}).get("taskId")
+                    if data.get("code") in OVERLOAD_CODES:
+                        raise RunningHubOverloadError(api_key, data.get("code"), data.get("msg", ""))
+                    return (data.get("data") or {}).get("taskId")
                 return None
+        except RunningHubOverloadError:
+            raise
         except Exception as e:
             # Логируем ошибку с полным стектрейсом
-            import logging
             logging.error(f"RunningHub API error: {str(e)}", exc_info=True)
             return None
 
     async def get_task_outputs(self, api_key: str, task_id: str) -> Optional[List[Dict[str, Any]]]:
         """Получает результаты выполнения задачи"""
+        data = await self.get_task_response(api_key, task_id)
+        if data is None:
+            return None
+        return data.get("data") or []
+
+    async def get_task_response(self, api_key: str, task_id: str) -> Optional[Dict[str, Any]]:
+        """Получает полный ответ /task/openapi/outputs вместе с кодом статуса"""
         session = await self._get_session()
         async with session.post(
             f"{self.api_url}/task/openapi/outputs",
             json={
                 "taskId": task_id,
                 "apiKey": api_key
-            }
+            },
+            timeout=self._timeout(config.runninghub.http_poll_timeout)
         ) as response:
             if response.status == 200:
-                data = await response.json()
-                return data.get("data", [])
+                return await response.json()
+            return None
+
+    async def download_file(self, url: str) -> Optional[bytes]:
+        """Скачивает готовое изображение по fileUrl"""
+        session = await self._get_session()
+        async with session.get(
+            url,
+            timeout=self._timeout(config.runninghub.http_upload_timeout)
+        ) as response:
+            if response.status == 200:
+                return await response.read()
             return None
 
     async def check_account_status(self, api_key: str) -> Optional[Dict[str, Any]]:
@@ -121,13 +444,18 @@ class RunningHubAPI:
         session = await self._get_session()
         async with session.post(
             f"{self.api_url}/uc/openapi/accountStatus",
-            json={"apikey": api_key}
+            json={"apikey": api_key},
+            timeout=self._timeout(config.runninghub.http_poll_timeout)
         ) as response:
             if response.status == 200:
                 return await response.json()
             return None
 
     async def close(self) -> None:
-        """Закрывает сессию"""
+        """Закрывает сессию и пул соединений"""
         if self._session and not self._session.closed:
             await self._session.close()
+        self._session = None
+
+# Общий клиент RunningHub для всех компонентов процесса
+runninghub_api = RunningHubAPI(api_url=config.runninghub.api_url)
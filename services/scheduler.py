@@ -0,0 +1,154 @@
+import heapq
+import itertools
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+from .stats import LatencyStats, METRIC_RUN
+
+logger = logging.getLogger(__name__)
+
+class SchedulingPolicy(ABC):
+    """Политика выбора аккаунта на основе кучи с ленивым удалением.
+
+    В куче лежат только аккаунты со свободной емкостью. После любого
+    изменения загрузки аккаунта нужно вызвать update(): старая запись
+    становится неактуальной, а новая добавляется за O(log n).
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self._statuses: Dict[str, Any] = {}
+        self._versions: Dict[str, int] = {}
+        self._heap: List[Tuple[float, int, str, int]] = []
+        self._seq = itertools.count()
+
+    def add_account(self, api_key: str, status: Any) -> None:
+        """Регистрирует аккаунт в политике"""
+        self._statuses[api_key] = status
+        self.update(api_key)
+
+    def remove_account(self, api_key: str) -> None:
+        """Убирает аккаунт из политики"""
+        self._statuses.pop(api_key, None)
+        self._versions.pop(api_key, None)
+
+    @staticmethod
+    def occupied(status: Any) -> int:
+        """Занятые слоты: свои, зарезервированные и занятые другими процессами"""
+        return status.active_tasks + status.reserved + status.remote_tasks
+
+    @classmethod
+    def load(cls, status: Any) -> float:
+        """Загрузка аккаунта с учетом резервирований"""
+        return cls.occupied(status) / max(1, status.limit)
+
+    @classmethod
+    def has_capacity(cls, status: Any) -> bool:
+        """Есть ли у аккаунта свободная емкость"""
+        return cls.occupied(status) < status.limit
+
+    def update(self, api_key: str) -> None:
+        """Пересчитывает позицию аккаунта после изменения загрузки"""
+        status = self._statuses.get(api_key)
+        if status is None:
+            return
+        version = self._versions.get(api_key, 0) + 1
+        self._versions[api_key] = version
+        if self.has_capacity(status):
+            heapq.heappush(
+                self._heap,
+                (self._key(api_key, status), next(self._seq), api_key, version)
+            )
+        # Периодически очищаем кучу от устаревших записей
+        if len(self._heap) > 4 * len(self._statuses) + 16:
+            self._heap = [
+                entry for entry in self._heap
+                if self._versions.get(entry[2]) == entry[3]
+            ]
+            heapq.heapify(self._heap)
+
+    def choose(self) -> Optional[str]:
+        """Возвращает лучший аккаунт со свободной емкостью (без изменения загрузки)"""
+        while self._heap:
+            _, _, api_key, version = self._heap[0]
+            if self._versions.get(api_key) != version:
+                heapq.heappop(self._heap)
+                continue
+            return api_key
+        return None
+
+    def on_selected(self, api_key: str) -> None:
+        """Вызывается, когда аккаунт выбран для задачи"""
+
+    def record_latency(self, api_key: str, seconds: float) -> None:
+        """Учитывает наблюдаемое время выполнения задачи на аккаунте"""
+
+    @abstractmethod
+    def _key(self, api_key: str, status: Any) -> float:
+        """Приоритет аккаунта в куче: меньше - лучше"""
+
+class LeastLoadedPolicy(SchedulingPolicy):
+    """Выбирает аккаунт с наименьшей долей занятых слотов"""
+
+    name = "least_loaded"
+
+    def _key(self, api_key: str, status: Any) -> float:
+        return self.load(status)
+
+class WeightedRoundRobinPolicy(SchedulingPolicy):
+    """Взвешенный round-robin (stride scheduling): вес равен лимиту аккаунта"""
+
+    name = "weighted_round_robin"
+
+    def __init__(self):
+        super().__init__()
+        self._passes: Dict[str, float] = {}
+        self._virtual_time = 0.0
+
+    def on_selected(self, api_key: str) -> None:
+        status = self._statuses.get(api_key)
+        if status is None:
+            return
+        current = max(self._passes.get(api_key, 0.0), self._virtual_time)
+        self._virtual_time = current
+        self._passes[api_key] = current + 1.0 / max(1, status.limit)
+
+    def _key(self, api_key: str, status: Any) -> float:
+        # Простаивавший аккаунт не должен получить всю накопленную очередь
+        return max(self._passes.get(api_key, 0.0), self._virtual_time)
+
+class LatencyWeightedPolicy(SchedulingPolicy):
+    """Выбирает аккаунт с наименьшим ожидаемым временем выполнения новой задачи"""
+
+    name = "latency_weighted"
+
+    def __init__(self, quantile: float = 0.75):
+        super().__init__()
+        # Верхний квартиль учитывает не только среднее, но и хвост задержек аккаунта
+        self.quantile = quantile
+        self.stats = LatencyStats()
+
+    def record_latency(self, api_key: str, seconds: float) -> None:
+        self.stats.record(METRIC_RUN, seconds, api_key=api_key)
+        self.update(api_key)
+
+    def _key(self, api_key: str, status: Any) -> float:
+        # Пока нет наблюдений по аккаунту, используем общую оценку по всем
+        latency = self.stats.quantile(METRIC_RUN, self.quantile, api_key=api_key, default=1.0)
+        return (self.occupied(status) + 1) * latency / max(1, status.limit)
+
+POLICIES = {
+    LeastLoadedPolicy.name: LeastLoadedPolicy,
+    WeightedRoundRobinPolicy.name: WeightedRoundRobinPolicy,
+    LatencyWeightedPolicy.name: LatencyWeightedPolicy,
+}
+
+def create_policy(name: str) -> SchedulingPolicy:
+    """Создает политику планирования по имени"""
+    policy_class = POLICIES.get(name)
+    if policy_class is None:
+        logger.warning(f"Unknown scheduling policy {name}, using {LeastLoadedPolicy.name}")
+        policy_class = LeastLoadedPolicy
+    return policy_class()
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class SlotLedger(ABC):
+    """Учет занятых слотов аккаунтов, общий для нескольких процессов.
+
+    Слот выдается в виде аренды (lease). Если процесс-владелец упал и
+    перестал продлевать аренды, они истекают и слоты возвращаются в пул.
+    Ожидающие получают номер в очереди (ticket), слоты выдаются по порядку
+    номеров независимо от процесса.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    @abstractmethod
+    async def try_acquire(
+        self,
+        api_key: str,
+        limit: int,
+        ticket: Optional[int] = None
+    ) -> Tuple[Optional[str], Optional[int]]:
+        """Пытается занять слот: (lease_id, None) или (None, номер в очереди)"""
+
+    async def cancel_ticket(self, ticket: int) -> None:
+        """Снимает ожидающего с очереди"""
+
+    async def release(self, lease_id: str) -> None:
+        """Освобождает слот"""
+
+    async def release_all(self) -> None:
+        """Освобождает все слоты и очередь этого процесса"""
+
+    async def renew(self) -> None:
+        """Продлевает аренды и номера в очереди этого процесса"""
+
+    async def remote_usage(self) -> Dict[str, int]:
+        """Количество слотов, занятых другими процессами, по аккаунтам"""
+        return {}
+
+    async def close(self) -> None:
+        """Освобождает ресурсы"""
+
+class LocalSlotLedger(SlotLedger):
+    """Один процесс: лимиты полностью контролирует AccountManager"""
+
+    async def try_acquire(
+        self,
+        api_key: str,
+        limit: int,
+        ticket: Optional[int] = None
+    ) -> Tuple[Optional[str], Optional[int]]:
+        return uuid.uuid4().hex, None
+
+class SQLiteSlotLedger(SlotLedger):
+    """Общий учет слотов в SQLite-файле для процессов на одном узле"""
+
+    shared = True
+
+    def __init__(self, path: str, lease_ttl: float = 60.0):
+        super().__init__()
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "lease_id TEXT PRIMARY KEY, api_key TEXT NOT NULL, holder TEXT NOT NULL, "
+            "expires_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tickets ("
+            "ticket INTEGER PRIMARY KEY AUTOINCREMENT, api_key TEXT NOT NULL, "
+            "holder TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS leases_api_key ON leases (api_key)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tickets_api_key ON tickets (api_key)")
+
+    def _transaction(self, func, *args):
+        """Выполняет func в транзакции с эксклюзивной блокировкой записи"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def _try_acquire(self, api_key: str, limit: int, ticket: Optional[int]) -> Tuple[Optional[str], Optional[int]]:
+        now = time.time()
+        # Аренды и очередь упавших процессов
+        self._db.execute("DELETE FROM leases WHERE expires_at <= ?", (now,))
+        self._db.execute("DELETE FROM tickets WHERE expires_at <= ?", (now,))
+        if ticket is not None and self._db.execute(
+            "SELECT 1 FROM tickets WHERE ticket = ?", (ticket,)
+        ).fetchone() is None:
+            # Номер истек - встаем в конец очереди
+            ticket = None
+
+        used = self._db.execute(
+            "SELECT COUNT(*) FROM leases WHERE api_key = ?", (api_key,)
+        ).fetchone()[0]
+        if ticket is None:
+            ahead = self._db.execute(
+                "SELECT COUNT(*) FROM tickets WHERE api_key = ?", (api_key,)
+            ).fetchone()[0]
+        else:
+            ahead = self._db.execute(
+                "SELECT COUNT(*) FROM tickets WHERE api_key = ? AND ticket < ?", (api_key, ticket)
+            ).fetchone()[0]
+
+        expires_at = now + self.lease_ttl
+        if used + ahead >= limit:
+            if ticket is None:
+                ticket = self._db.execute(
+                    "INSERT INTO tickets (api_key, holder, expires_at) VALUES (?, ?, ?)",
+                    (api_key, self.holder, expires_at)
+                ).lastrowid
+            return None, ticket
+
+        lease_id = uuid.uuid4().hex
+        self._db.execute(
+            "INSERT INTO leases (lease_id, api_key, holder, expires_at) VALUES (?, ?, ?, ?)",
+            (lease_id, api_key, self.holder, expires_at)
+        )
+        if ticket is not None:
+            self._db.execute("DELETE FROM tickets WHERE ticket = ?", (ticket,))
+        return lease_id, None
+
+    async def try_acquire(
+        self,
+        api_key: str,
+        limit: int,
+        ticket: Optional[int] = None
+    ) -> Tuple[Optional[str], Optional[int]]:
+        return await asyncio.to_thread(self._transaction, self._try_acquire, api_key, limit, ticket)
+
+    def _execute(self, query: str, *params) -> None:
+        self._transaction(self._db.execute, query, params)
+
+    async def cancel_ticket(self, ticket: int) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM tickets WHERE ticket = ?", ticket)
+
+    async def release(self, lease_id: str) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM leases WHERE lease_id = ?", lease_id)
+
+    def _release_all(self) -> None:
+        self._db.execute("DELETE FROM leases WHERE holder = ?", (self.holder,))
+        self._db.execute("DELETE FROM tickets WHERE holder = ?", (self.holder,))
+
+    async def release_all(self) -> None:
+        await asyncio.to_thread(self._transaction, self._release_all)
+
+    def _renew(self) -> None:
+        expires_at = time.time() + self.lease_ttl
+        self._db.execute("UPDATE leases SET expires_at = ? WHERE holder = ?", (expires_at, self.holder))
+        self._db.execute("UPDATE tickets SET expires_at = ? WHERE holder = ?", (expires_at, self.holder))
+
+    async def renew(self) -> None:
+        await asyncio.to_thread(self._transaction, self._renew)
+
+    def _remote_usage(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT api_key, COUNT(*) FROM leases WHERE holder != ? AND expires_at > ? GROUP BY api_key",
+                (self.holder, time.time())
+            ).fetchall()
+        return dict(rows)
+
+    async def remote_usage(self) -> Dict[str, int]:
+        return await asyncio.to_thread(self._remote_usage)
+
+    async def close(self) -> None:
+        await self.release_all()
+        with self._lock:
+            self._db.close()
+
+def create_ledger(path: Optional[str], lease_ttl: float = 60.0) -> SlotLedger:
+    """Создает общий учет слотов (SQLite) или локальный, если путь не задан"""
+    if not path:
+        return LocalSlotLedger()
+    try:
+        return SQLiteSlotLedger(path, lease_ttl=lease_ttl)
+    except sqlite3.Error as e:
+        logger.error(f"Failed to open slot ledger {path}, using local limits: {e}")
+        return LocalSlotLedger()
@@ -0,0 +1,129 @@
+import asyncio
+import io
+import logging
+import os
+import time
+import uuid
+from typing import List, Optional, Tuple, Union
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class SpoolStore:
+    """Временное хранилище фото на диске.
+
+    В FSM-состоянии лежит только handle, байты - в файле каталога spool.
+    Файлы, к которым не обращались дольше ttl секунд (пользователь бросил
+    сценарий), удаляет фоновая очистка, поэтому память не растет с числом
+    незавершенных диалогов. Если каталог больше max_bytes, очистка удаляет
+    и более свежие файлы, начиная с самых старых.
+    """
+
+    def __init__(self, directory: str, ttl: float = 3600, max_bytes: int = 0):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def _path(self, handle: str) -> str:
+        # handle - uuid hex, лишние символы отбрасываем
+        return os.path.join(self.directory, "".join(c for c in handle if c.isalnum()))
+
+    def _write(self, path: str, data: Union[bytes, io.BytesIO]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(data.getbuffer() if isinstance(data, io.BytesIO) else data)
+
+    async def put(self, data: Union[bytes, io.BytesIO]) -> str:
+        """Сохраняет фото на диск и возвращает handle"""
+        handle = uuid.uuid4().hex
+        await asyncio.to_thread(self._write, self._path(handle), data)
+        self._ensure_sweeper()
+        return handle
+
+    def allocate(self) -> Tuple[str, str]:
+        """Новый handle и путь файла для потоковой записи (например, bot.download_file)"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._ensure_sweeper()
+        handle = uuid.uuid4().hex
+        return handle, self._path(handle)
+
+    def source(self, handle: Optional[str]) -> Optional[str]:
+        """Источник изображения для загрузки в RunningHub (file://); None, если фото уже удалено"""
+        if not handle:
+            return None
+        path = self._path(handle)
+        try:
+            # Обращение продлевает жизнь файла
+            os.utime(path)
+        except OSError:
+            return None
+        return f"file://{path}"
+
+    def discard(self, handle: Optional[str]) -> None:
+        """Удаляет фото"""
+        if not handle:
+            return
+        try:
+            os.remove(self._path(handle))
+        except OSError:
+            pass
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep(), name="spool_sweeper")
+
+    def _remove_expired(self) -> int:
+        files: List[Tuple[float, int, str]] = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+                except OSError:
+                    pass
+
+        removed = 0
+        deadline = time.time() - self.ttl
+        total = sum(size for _, size, _ in files)
+        # Сначала самые старые: по возрасту, затем пока не уложимся в размер
+        for mtime, size, path in sorted(files):
+            if mtime >= deadline and (not self.max_bytes or total <= self.max_bytes):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    async def _sweep(self) -> None:
+        """Удаляет фото брошенных сценариев"""
+        while True:
+            await asyncio.sleep(config.runninghub.spool_sweep_interval)
+            try:
+                removed = await asyncio.to_thread(self._remove_expired)
+            except OSError as e:
+                logger.error(f"Failed to sweep spool {self.directory}: {e}")
+                continue
+            if removed:
+                logger.info(f"Removed {removed} expired spooled photos")
+
+    async def close(self) -> None:
+        """Останавливает очистку"""
+        if self._sweeper and not self._sweeper.done():
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+        self._sweeper = None
+
+spool = SpoolStore(
+    config.runninghub.spool_path,
+    ttl=config.runninghub.spool_ttl,
+    max_bytes=config.runninghub.spool_max_mb * 1024 * 1024
+)
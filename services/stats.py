@@ -0,0 +1,184 @@
+import math
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+# Измеряемые интервалы жизни задачи
+METRIC_UPLOAD = "upload"  # Загрузка изображений в RunningHub
+METRIC_QUEUE = "queue"  # От приема задачи до отправки в RunningHub
+METRIC_START = "start"  # Ожидание в очереди RunningHub до начала выполнения
+METRIC_RUN = "run"  # От отправки до готового результата
+METRIC_DELIVERY = "delivery"  # Отправка результата пользователю
+
+class Ewma:
+    """Экспоненциальное скользящее среднее"""
+
+    __slots__ = ("alpha", "value")
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.value: Optional[float] = None
+
+    def add(self, sample: float) -> None:
+        if self.value is None:
+            self.value = sample
+        else:
+            self.value += self.alpha * (sample - self.value)
+
+class LogHistogram:
+    """Гистограмма с логарифмическими корзинами фиксированного размера.
+
+    Корзины растут в growth раз от min_value до max_value, поэтому
+    относительная ошибка квантиля не превышает growth. Когда накоплено
+    decay_after наблюдений, все счетчики делятся пополам - старые данные
+    постепенно теряют вес, а память не растет.
+    """
+
+    __slots__ = ("min_value", "growth", "_log_growth", "counts", "total", "decay_after")
+
+    def __init__(
+        self,
+        min_value: float = 0.01,
+        max_value: float = 3600.0,
+        growth: float = 1.2,
+        decay_after: int = 2000
+    ):
+        self.min_value = min_value
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        size = int(math.ceil(math.log(max_value / min_value) / self._log_growth)) + 1
+        self.counts: List[float] = [0.0] * size
+        self.total = 0.0
+        self.decay_after = decay_after
+
+    def _index(self, value: float) -> int:
+        if value <= self.min_value:
+            return 0
+        index = int(math.log(value / self.min_value) / self._log_growth) + 1
+        return min(index, len(self.counts) - 1)
+
+    def _upper_bound(self, index: int) -> float:
+        return self.min_value * self.growth ** index
+
+    def add(self, value: float) -> None:
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        if self.total >= self.decay_after:
+            self.counts = [count / 2 for count in self.counts]
+            self.total /= 2
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Оценка квантиля q (0..1); None, если наблюдений нет"""
+        if self.total <= 0:
+            return None
+        target = q * self.total
+        seen = 0.0
+        for index, count in enumerate(self.counts):
+            if count <= 0:
+                continue
+            if seen + count >= target:
+                # Интерполяция внутри корзины в логарифмической шкале
+                lower = self._upper_bound(index - 1) if index > 0 else 0.0
+                upper = self._upper_bound(index)
+                fraction = (target - seen) / count
+                if lower <= 0:
+                    return upper * fraction
+                return lower * (upper / lower) ** fraction
+            seen += count
+        return self._upper_bound(len(self.counts) - 1)
+
+class _Series:
+    __slots__ = ("ewma", "histogram")
+
+    def __init__(self):
+        self.ewma = Ewma()
+        self.histogram = LogHistogram()
+
+class LatencyStats:
+    """Статистика длительностей по метрике, workflow и аккаунту.
+
+    Память ограничена: по одной гистограмме фиксированного размера на
+    (метрика, workflow) и (метрика, аккаунт). Вызывается только из
+    event loop, поэтому блокировки не нужны.
+    """
+
+    def __init__(self):
+        self._series: Dict[Tuple[str, str, Hashable], _Series] = {}
+
+    def _get(self, key: Tuple[str, str, Hashable]) -> _Series:
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series()
+        return series
+
+    def record(
+        self,
+        metric: str,
+        seconds: float,
+        workflow_id: Optional[str] = None,
+        api_key: Optional[str] = None
+    ) -> None:
+        """Учитывает наблюдение в общей серии, серии workflow и серии аккаунта"""
+        keys = [(metric, "all", None)]
+        if workflow_id is not None:
+            keys.append((metric, "workflow", workflow_id))
+        if api_key is not None:
+            keys.append((metric, "account", api_key))
+        for key in keys:
+            series = self._get(key)
+            series.ewma.add(seconds)
+            series.histogram.add(seconds)
+
+    def _find(self, metric: str, workflow_id: Optional[str], api_key: Optional[str]) -> Optional[_Series]:
+        """Самая точная серия, по которой есть наблюдения"""
+        candidates = []
+        if api_key is not None:
+            candidates.append((metric, "account", api_key))
+        if workflow_id is not None:
+            candidates.append((metric, "workflow", workflow_id))
+        candidates.append((metric, "all", None))
+        for key in candidates:
+            series = self._series.get(key)
+            if series is not None and series.histogram.total > 0:
+                return series
+        return None
+
+    def mean(
+        self,
+        metric: str,
+        workflow_id: Optional[str] = None,
+        api_key: Optional[str] = None,
+        default: Optional[float] = None
+    ) -> Optional[float]:
+        """Недавнее среднее (EWMA) длительности"""
+        series = self._find(metric, workflow_id, api_key)
+        return series.ewma.value if series else default
+
+    def quantile(
+        self,
+        metric: str,
+        q: float,
+        workflow_id: Optional[str] = None,
+        api_key: Optional[str] = None,
+        default: Optional[float] = None
+    ) -> Optional[float]:
+        """Оценка квантиля длительности"""
+        series = self._find(metric, workflow_id, api_key)
+        if series is None:
+            return default
+        value = series.histogram.quantile(q)
+        return default if value is None else value
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Сводка для логов: среднее, p50 и p95 по каждой серии"""
+        result = {}
+        for (metric, scope, name), series in self._series.items():
+            label = metric if scope == "all" else f"{metric}/{scope}/{str(name)[:8]}"
+            result[label] = {
+                "mean": round(series.ewma.value or 0.0, 2),
+                "p50": round(series.histogram.quantile(0.5) or 0.0, 2),
+                "p95": round(series.histogram.quantile(0.95) or 0.0, 2),
+                "count": int(series.histogram.total),
+            }
+        return result
+
+# Общая статистика процесса
+latency_stats = LatencyStats()
@@ -1,99 +1,620 @@
 import asyncio
+import inspect
 import logging
-from typing import Dict, Optional, Any
-from dataclasses import dataclass
+import os
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Any, Set, Tuple
+from dataclasses import dataclass, field
+from config import config
 from .account_manager import AccountManager
-from .runninghub import RunningHubAPI
+from .pipeline import Pipeline, Stage
+from .fair_queue import FairQueue, priority_lane, lane_weights
+from .stats import (
+    LatencyStats, latency_stats,
+    METRIC_UPLOAD, METRIC_QUEUE, METRIC_START, METRIC_DELIVERY
+)
+from .poller import TaskPoller, task_poller
+from .runninghub import (
+    RunningHubAPI, RunningHubOverloadError, ImageSource, CODE_TASK_QUEUED,
+    hash_image_source, runninghub_api
+)
+from .result_cache import ResultCache, result_cache
+from .task_store import (
+    TaskStore, StoredTask, task_store,
+    STATE_QUEUED, STATE_UPLOADED, STATE_SUBMITTED, STATE_COMPLETED, STATE_DELIVERED
+)
 
 logger = logging.getLogger(__name__)
 
+# Статусы, передаваемые в callback
+STATUS_SUCCESS = "SUCCESS"
+STATUS_FAILED = "FAILED"
+STATUS_CANCELLED = "CANCELLED"
+
+# Причины отказа в приеме задачи
+REJECT_NO_ACCOUNTS = "no_accounts"
+REJECT_QUEUE_FULL = "queue_full"
+REJECT_USER_LIMIT = "user_limit"
+
+@dataclass
+class AdmissionResult:
+    """Результат постановки задачи в очередь"""
+    accepted: bool
+    reason: Optional[str] = None
+    position: Optional[int] = None  # Примерное место в очереди (1 - следующая)
+    eta: Optional[float] = None  # Ожидаемое время до результата в секундах
+    cached: bool = False  # Результат уже готов, RunningHub не используется
+
+    def __bool__(self) -> bool:
+        return self.accepted
+
 @dataclass
 class Task:
-    product_image_url: str
-    background_image_url: str
+    product_image_url: ImageSource
+    background_image_url: ImageSource
     callback: Any
     retries: int = 0
+    api_key: Optional[str] = None
+    product_file: Optional[str] = None
+    background_file: Optional[str] = None
+    task_id: Optional[str] = None
+    result: Optional[Dict[str, Any]] = None
+    created_at: float = field(default_factory=time.monotonic)
+    submitted_at: Optional[float] = None
+    overloads: int = 0
+    # Аккаунты, долго отвечавшие перегрузкой: повторная загрузка идет мимо них
+    excluded: Set[str] = field(default_factory=set)
+    seed: Optional[int] = None
+    # Данные для доставки результата после перезапуска (chat_id и т.п.)
+    context: Optional[Dict[str, Any]] = None
+    record_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    waiting: bool = False  # Учтена в очереди до отправки в RunningHub
+    # Одинаковые запросы, присоединенные к задаче: (callback, context)
+    followers: List[Tuple[Any, Optional[Dict[str, Any]]]] = field(default_factory=list)
+    # Хэши изображений и seed: для объединения одинаковых запросов и кэша результатов
+    request_key: Optional[tuple] = None
+
+def _local_file_missing(source: ImageSource) -> bool:
+    """Локальный источник (путь или file://), файла которого больше нет"""
+    if not isinstance(source, str) or source.startswith(("http://", "https://")):
+        return False
+    path = source[len("file://"):] if source.startswith("file://") else source
+    return not os.path.isfile(path)
+
+@dataclass
+class Attempt:
+    """Запуск задачи на одном аккаунте (основной или дублирующий)"""
+    api_key: str
+    task_id: str
+    product_file: Optional[str]
+    background_file: Optional[str]
+    started_at: float = field(default_factory=time.monotonic)
+
+# Сколько дублей можно запустить подряд из накопленного бюджета
+HEDGE_BURST = 5.0
 
 class TaskQueue:
-    def __init__(self, account_manager: AccountManager):
-        self.queue = asyncio.Queue()
+    """Очередь генераций в виде конвейера: upload -> submit -> poll -> deliver"""
+
+    def __init__(
+        self,
+        account_manager: AccountManager,
+        poller: Optional[TaskPoller] = None,
+        api: Optional[RunningHubAPI] = None,
+        store: Optional[TaskStore] = None,
+        stats: Optional[LatencyStats] = None,
+        results: Optional[ResultCache] = None
+    ):
         self.account_manager = account_manager
-        self.runninghub_api = RunningHubAPI()
+        self.runninghub_api = api or runninghub_api
+        self.poller = poller or task_poller
+        self.store = store or task_store
+        self.stats = stats or latency_stats
+        self.results = results or result_cache
+        # Создает callback для задачи, восстановленной после перезапуска, по ее context
+        self.recovery_handler: Optional[Callable[[Optional[Dict[str, Any]]], Any]] = None
+        # Задачи, принятые, но еще не отправленные в RunningHub
+        self._waiting = 0
+        # Незавершенные задачи по пользователям (пакет считается одной задачей)
+        self._user_tasks: Dict[Any, int] = {}
+        # Незавершенные задачи пакетов (альбомов): пакет занимает в лимите пользователя одно место
+        self._batches: Dict[str, int] = {}
+        # Выполняющиеся задачи по содержимому запроса (single-flight)
+        self._in_flight: Dict[tuple, Task] = {}
+        self._coalesced = 0
+        # Бюджет дублирования: пополняется на hedge_ratio с каждой отправленной задачей
+        self._hedge_budget = 1.0
+        self._hedges = 0
+        self._hedge_wins = 0
         self._running = False
-        self._task = None
-        self._lock = asyncio.Lock()
-        self.loop = asyncio.get_running_loop()
+        # Создается в stop() внутри event loop (в Python 3.9 примитивы привязываются к loop)
+        self._lock: Optional[asyncio.Lock] = None
+        self._stats_task: Optional[asyncio.Task] = None
+        self._recovery_task: Optional[asyncio.Task] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.pipeline: Optional[Pipeline] = None
+        # Стадии с очередями asyncio создаются в start(), внутри event loop
+        self.upload_stage: Optional[Stage] = None
+        self.deliver_stage: Optional[Stage] = None
 
     async def add_task(
         self,
-        product_image_url: str,
-        background_image_url: str,
-        callback: Any
-    ) -> bool:
-        """Добавляет задачу в очередь"""
-        if not self.account_manager.has_available_accounts():
-            logger.warning("No available accounts to process new task")
-            return False
+        product_image_url: ImageSource,
+        background_image_url: ImageSource,
+        callback: Any,
+        api_key: Optional[str] = None,
+        product_file: Optional[str] = None,
+        background_file: Optional[str] = None,
+        seed: Optional[int] = None,
+        context: Optional[Dict[str, Any]] = None
+    ) -> AdmissionResult:
+        """Добавляет задачу в очередь.
+
+        api_key и fileName передаются, если изображения уже загружены на этот
+        аккаунт (предзагрузка или повторная генерация). Если у аккаунта нет
+        свободного слота, изображения прозрачно загружаются заново.
+
+        Задача отклоняется сразу, если очередь заполнена или у пользователя
+        слишком много незавершенных задач. Запрос, совпадающий с уже
+        выполняющимся, присоединяется к нему и получит тот же результат.
+        """
+        if not self.account_manager.accounts:
+            logger.warning("No accounts to process new task")
+            return AdmissionResult(accepted=False, reason=REJECT_NO_ACCOUNTS)
+
+        request_key = None
+        if config.runninghub.dedup_requests or self.results.enabled:
+            request_key = await self._request_key(product_image_url, background_image_url, seed)
+        if request_key and self.results.enabled:
+            cached = await self.results.get(ResultCache.make_key(*request_key))
+            if cached is not None:
+                return await self._deliver_cached(cached, callback, context)
+        if request_key and config.runninghub.dedup_requests:
+            leader = self._in_flight.get(request_key)
+            if leader is not None:
+                return self._join(leader, callback, context)
+
+        max_depth = config.runninghub.max_queue_depth
+        if max_depth and self._waiting >= max_depth:
+            logger.warning(f"Queue is full ({self._waiting} tasks), rejecting new task")
+            return AdmissionResult(accepted=False, reason=REJECT_QUEUE_FULL)
+
+        user_id = (context or {}).get("user_id")
+        batch_id = (context or {}).get("batch_id")
+        max_user_tasks = config.runninghub.max_user_tasks
+        if (
+            max_user_tasks
+            and user_id is not None
+            and batch_id not in self._batches
+            and self._user_tasks.get(user_id, 0) >= max_user_tasks
+        ):
+            logger.info(f"User {user_id} already has {max_user_tasks} tasks in progress")
+            return AdmissionResult(accepted=False, reason=REJECT_USER_LIMIT)
+
+        if api_key and not self.account_manager.has_free_slot(api_key):
+            logger.info(f"Account {api_key[:5]}... is full, uploading images again")
+            api_key = product_file = background_file = None
             
         task = Task(
             product_image_url=product_image_url,
             background_image_url=background_image_url,
-            callback=callback
+            callback=callback,
+            api_key=api_key,
+            product_file=product_file if api_key else None,
+            background_file=background_file if api_key else None,
+            seed=seed,
+            context=context,
+            request_key=request_key
+        )
+        if request_key and config.runninghub.dedup_requests:
+            self._in_flight[request_key] = task
+        self._admit(task, waiting=True)
+        position = self._queue_position(user_id)
+        admission = AdmissionResult(
+            accepted=True,
+            position=position,
+            eta=self.estimate_wait(position)
+        )
+        if task.api_key:
+            self.account_manager.reserve_account(task.api_key)
+        if task.product_file and task.background_file:
+            # Все файлы уже на аккаунте - сразу отправляем задачу
+            self._persist(task, STATE_UPLOADED)
+            await self.pipeline["submit"].put(task)
+            logger.info("Added task with uploaded files straight to submit stage")
+            return admission
+        self._persist(task, STATE_QUEUED)
+        await self.upload_stage.put(task)
+        logger.info(f"Added new task to queue (waiting: {self._waiting}, position: {position})")
+        return admission
+
+    async def _request_key(
+        self,
+        product_image_url: ImageSource,
+        background_image_url: ImageSource,
+        seed: Optional[int]
+    ) -> Optional[tuple]:
+        """Ключ запроса: содержимое обоих изображений и параметры workflow.
+
+        Почти одинаковые фоны дают один ключ, поэтому для них тоже
+        срабатывают объединение запросов и кэш результатов.
+        """
+        digests = []
+        for source, digest_of in (
+            (product_image_url, hash_image_source),
+            (background_image_url, self.runninghub_api.background_digest)
+        ):
+            digest = await digest_of(source)
+            if digest is None and isinstance(source, str):
+                # URL сравниваем как есть
+                digest = source
+            if digest is None:
+                return None
+            digests.append(digest)
+        return (*digests, seed)
+
+    async def _deliver_cached(
+        self,
+        result: Dict[str, Any],
+        callback: Any,
+        context: Optional[Dict[str, Any]]
+    ) -> AdmissionResult:
+        """Отдает готовый результат из кэша через стадию deliver"""
+        task = Task(
+            product_image_url=None,
+            background_image_url=None,
+            callback=callback,
+            task_id=result.get("task_id"),
+            result=result,
+            seed=result.get("seed"),
+            context=context
+        )
+        self._admit(task, waiting=False)
+        self._persist(task, STATE_COMPLETED)
+        await self.deliver_stage.put(task)
+        logger.info(f"Result cache hit for task {task.task_id}")
+        return AdmissionResult(accepted=True, cached=True)
+
+    def _join(self, leader: Task, callback: Any, context: Optional[Dict[str, Any]]) -> AdmissionResult:
+        """Присоединяет запрос к выполняющейся задаче с тем же содержимым"""
+        leader.followers.append((callback, context))
+        self._coalesced += 1
+        self._persist(leader, self._state_of(leader))
+        logger.info(f"Request joined in-flight task {leader.record_id} ({len(leader.followers)} followers)")
+        if not leader.waiting:
+            # Задача уже выполняется в RunningHub
+            return AdmissionResult(accepted=True)
+        position = self._queue_position((leader.context or {}).get("user_id"))
+        return AdmissionResult(accepted=True, position=position, eta=self.estimate_wait(position))
+
+    @staticmethod
+    def _state_of(task: Task) -> str:
+        """Состояние задачи для журнала по ее полям"""
+        if task.result is not None:
+            return STATE_COMPLETED
+        if task.task_id:
+            return STATE_SUBMITTED
+        if task.product_file and task.background_file:
+            return STATE_UPLOADED
+        return STATE_QUEUED
+
+    def _admit(self, task: Task, waiting: bool) -> None:
+        """Учитывает принятую задачу в счетчиках очереди и пользователя"""
+        user_id = (task.context or {}).get("user_id")
+        batch_id = (task.context or {}).get("batch_id")
+        if batch_id is not None:
+            self._batches[batch_id] = self._batches.get(batch_id, 0) + 1
+        # Пакет учитывается в лимите пользователя один раз, по первой задаче
+        if user_id is not None and (batch_id is None or self._batches[batch_id] == 1):
+            self._user_tasks[user_id] = self._user_tasks.get(user_id, 0) + 1
+        if waiting:
+            task.waiting = True
+            self._waiting += 1
+
+    def _leave_queue(self, task: Task) -> None:
+        """Задача отправлена в RunningHub или завершилась - больше не ждет в очереди"""
+        if task.waiting:
+            task.waiting = False
+            self._waiting -= 1
+
+    def _finish_user_task(self, task: Task) -> None:
+        """Освобождает место задачи в лимите пользователя"""
+        self._leave_queue(task)
+        batch_id = (task.context or {}).get("batch_id")
+        batch_count = self._batches.get(batch_id)
+        if batch_count is not None:
+            if batch_count > 1:
+                # Место пакета освобождается с его последней задачей
+                self._batches[batch_id] = batch_count - 1
+                return
+            del self._batches[batch_id]
+        user_id = (task.context or {}).get("user_id")
+        count = self._user_tasks.get(user_id)
+        if count is None:
+            return
+        if count <= 1:
+            del self._user_tasks[user_id]
+        else:
+            self._user_tasks[user_id] = count - 1
+
+    def _queue_position(self, user_id: Any) -> int:
+        """Примерное место последней задачи пользователя в очереди.
+
+        Очередь справедливая, поэтому перед задачей стоит не больше чем по
+        столько же задач каждого другого пользователя.
+        """
+        own = self._user_tasks.get(user_id, 1) if user_id is not None else self._waiting
+        return max(1, min(self._waiting, own * max(1, len(self._user_tasks))))
+
+    def estimate_wait(self, position: int) -> float:
+        """Ожидаемое время до результата задачи на данном месте очереди, в секундах"""
+        statuses = self.account_manager.account_status
+        capacity = max(1, sum(status.limit for status in statuses.values()))
+        workflows = {account.workflow_id for account in self.account_manager.accounts.values()}
+        run_time = (
+            sum(self.poller.expected_completion(workflow) for workflow in workflows) / len(workflows)
+            if workflows else config.runninghub.expected_completion_time
+        )
+        free = sum(
+            max(0, status.limit - self.account_manager.policy.occupied(status))
+            for status in statuses.values()
+        )
+        upload_time = self.stats.quantile(
+            METRIC_UPLOAD, 0.5, default=self.upload_stage.avg_service_time if self.upload_stage else 0.0
         )
-        await self.queue.put(task)
-        logger.info(f"Added new task to queue (queue size: {self.queue.qsize()})")
-        return True
+        delivery_time = self.stats.quantile(METRIC_DELIVERY, 0.5, default=0.0)
+        # Каждый слот освобождается в среднем раз в run_time секунд
+        slots_ahead = max(0, position - free)
+        return upload_time + slots_ahead / capacity * run_time + run_time + delivery_time
 
     async def start(self) -> None:
-        """Запускает обработчик очереди"""
+        """Запускает стадии конвейера"""
         if self._running:
             return
 
         self._running = True
-        self._task = self.loop.create_task(self._process_queue())
+        self.loop = asyncio.get_running_loop()
+        # Стадии submit и poll удерживают слот аккаунта, поэтому их
+        # параллельность равна суммарной емкости пула
+        capacity = max(1, self.account_manager.total_capacity)
+        # Загрузка файлов не занимает слоты аккаунтов
+        self.upload_stage = Stage(
+            "upload",
+            self._upload,
+            concurrency=config.runninghub.upload_concurrency,
+            queue=self._fair_queue(config.runninghub.stage_queue_size)
+        )
+        self.deliver_stage = Stage(
+            "deliver",
+            self._deliver,
+            concurrency=config.runninghub.deliver_concurrency,
+            maxsize=config.runninghub.stage_queue_size
+        )
+        self.pipeline = Pipeline([
+            self.upload_stage,
+            # Очередь перед слотами аккаунтов - справедливая между пользователями
+            Stage(
+                "submit",
+                self._submit,
+                concurrency=capacity,
+                queue=self._fair_queue(config.runninghub.stage_queue_size)
+            ),
+            Stage("poll", self._poll, concurrency=capacity, maxsize=capacity),
+            self.deliver_stage,
+        ])
+        self.pipeline.start()
+        self.poller.start()
+        if self._on_poll_status not in self.poller.status_listeners:
+            self.poller.status_listeners.append(self._on_poll_status)
+        if config.runninghub.stats_log_interval > 0:
+            self._stats_task = self.loop.create_task(self._log_stats())
+        self.store.start()
+        if self.store.enabled:
+            # Восстановление ждет свободных слотов, поэтому идет в фоне
+            self._recovery_task = self.loop.create_task(self._recover(), name="task_recovery")
+        logger.info(f"Started task pipeline with capacity {capacity}")
+
+    def _persist(self, task: Task, state: str) -> None:
+        """Записывает состояние задачи в журнал"""
+        self.store.save(StoredTask(
+            record_id=task.record_id,
+            state=state,
+            # Байты и файловые объекты не переживут перезапуск - храним только ссылки
+            product_image_url=task.product_image_url if isinstance(task.product_image_url, str) else None,
+            background_image_url=task.background_image_url if isinstance(task.background_image_url, str) else None,
+            api_key=task.api_key,
+            product_file=task.product_file,
+            background_file=task.background_file,
+            task_id=task.task_id,
+            seed=task.seed,
+            retries=task.retries,
+            result=task.result,
+            context=dict(task.context or {}, followers=[context for _, context in task.followers])
+            if task.followers else task.context
+        ))
+
+    async def _recover(self) -> None:
+        """Продолжает задачи, прерванные перезапуском, с последнего состояния"""
+        records = await asyncio.to_thread(self.store.load_unfinished)
+        if records:
+            logger.info(f"Recovering {len(records)} unfinished tasks")
+        for record in records:
+            context = dict(record.context) if record.context else None
+            followers = context.pop("followers", []) if context else []
+            task = Task(
+                product_image_url=record.product_image_url,
+                background_image_url=record.background_image_url,
+                callback=self._recovered_callback(context),
+                retries=record.retries,
+                api_key=record.api_key,
+                product_file=record.product_file,
+                background_file=record.background_file,
+                task_id=record.task_id,
+                result=record.result,
+                seed=record.seed,
+                context=context,
+                record_id=record.record_id,
+                followers=[
+                    (self._recovered_callback(follower), follower) for follower in followers
+                ]
+            )
+            self._admit(task, waiting=record.state in (STATE_QUEUED, STATE_UPLOADED))
+            try:
+                await self._resume(task, record.state)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to recover task {record.record_id}: {e}", exc_info=True)
+
+    async def _resume(self, task: Task, state: str) -> None:
+        """Возвращает восстановленную задачу в нужную стадию конвейера"""
+        if state == STATE_COMPLETED:
+            await self.deliver_stage.put(task)
+            return
+
+        if task.api_key not in self.account_manager.accounts:
+            # Аккаунт убран из конфигурации - его файлы и задачи недоступны
+            if state == STATE_SUBMITTED:
+                await self._fail(task, f"Account of task {task.task_id} is no longer configured")
+                return
+            task.api_key = task.product_file = task.background_file = None
+            state = STATE_QUEUED
+
+        if state == STATE_SUBMITTED:
+            # Задача уже создана в RunningHub - только продолжаем опрос
+            await self.account_manager.acquire_account(task.api_key)
+            task.submitted_at = time.monotonic()
+            logger.info(f"Resuming polling of task {task.task_id}")
+            await self.pipeline["poll"].put(task)
+        elif state == STATE_UPLOADED:
+            self.account_manager.reserve_account(task.api_key)
+            await self.pipeline["submit"].put(task)
+        elif task.product_image_url and task.background_image_url:
+            missing = [
+                source for source in (task.product_image_url, task.background_image_url)
+                if _local_file_missing(source)
+            ]
+            if missing:
+                # Фото из spool удалены или spool не на постоянном диске (SPOOL_PATH)
+                await self._fail(task, f"Task images are gone after restart: {', '.join(missing)}")
+                return
+            if task.api_key and not self.account_manager.has_free_slot(task.api_key):
+                # Как в add_task: без свободного слота фото загружается заново
+                task.api_key = task.product_file = task.background_file = None
+            if task.api_key:
+                # Резерв под заранее загруженное фото, который снимет стадия submit
+                self.account_manager.reserve_account(task.api_key)
+            await self.upload_stage.put(task)
+        else:
+            await self._fail(task, "Task images were not persisted")
+
+    def _recovered_callback(self, context: Optional[Dict[str, Any]]) -> Any:
+        """Callback для восстановленной задачи (исходный не переживает перезапуск)"""
+        if self.recovery_handler is None:
+            return None
+        try:
+            return self.recovery_handler(context)
+        except Exception as e:
+            logger.error(f"Error in recovery handler: {e}", exc_info=True)
+            return None
+
+    @staticmethod
+    def _fair_queue(maxsize: int) -> FairQueue:
+        """Очередь с deficit round-robin по пользователям и полосам приоритета"""
+        return FairQueue(key=TaskQueue._flow_key, weights=lane_weights(), maxsize=maxsize)
+
+    @staticmethod
+    def _flow_key(task: "Task") -> tuple:
+        """(полоса, пользователь) задачи; задачи без пользователя делят один поток"""
+        user_id = (task.context or {}).get("user_id")
+        return priority_lane(user_id), user_id
+
+    def free_capacity(self) -> int:
+        """Сколько еще задач можно принять, не создавая очередь перед слотами"""
+        free = sum(
+            max(0, status.limit - self.account_manager.policy.occupied(status))
+            for status in self.account_manager.account_status.values()
+        )
+        queued = self.upload_stage.queue.qsize() if self.upload_stage else 0
+        return max(0, free - queued)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Возвращает глубину очередей и время обработки по стадиям"""
+        if not self.pipeline:
+            return {}
+        return self.pipeline.get_stats()
+
+    async def _log_stats(self) -> None:
+        """Периодически пишет метрики стадий в лог"""
+        while self._running:
+            await asyncio.sleep(config.runninghub.stats_log_interval)
+            for name, stats in self.get_stats().items():
+                logger.info(
+                    f"Stage {name}: queue={stats['queue_depth']}/{stats['queue_limit']} "
+                    f"in_progress={stats['in_progress']}/{stats['concurrency']} "
+                    f"processed={stats['processed']} failed={stats['failed']} "
+                    f"avg={stats['avg_service_time']}s"
+                )
+            logger.info(
+                f"Admission: waiting={self._waiting}/{config.runninghub.max_queue_depth} "
+                f"users={len(self._user_tasks)} coalesced={self._coalesced}"
+            )
+            if self.results.enabled:
+                logger.info(f"Result cache: hits={self.results.hits} misses={self.results.misses}")
+            if config.runninghub.hedging:
+                logger.info(f"Hedging: hedged={self._hedges} won={self._hedge_wins} budget={self._hedge_budget:.1f}")
+            for name, stats in self.stats.snapshot().items():
+                logger.info(
+                    f"Latency {name}: mean={stats['mean']}s p50={stats['p50']}s "
+                    f"p95={stats['p95']}s n={stats['count']}"
+                )
 
     async def stop(self) -> None:
-        """Останавливает обработчик очереди"""
+        """Останавливает конвейер"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
         async with self._lock:
             if not self._running:
                 return
                 
             self._running = False
             
-            # Отменяем основной обработчик
-            if self._task and not self._task.done():
-                self._task.cancel()
-                try:
-                    await self._task
-                except asyncio.CancelledError:
-                    logger.debug("Main task cancelled successfully")
-                except Exception as e:
-                    logger.error(f"Error during task execution: {e}")
-                finally:
-                    self._task = None
+            if self._stats_task and not self._stats_task.done():
+                self._stats_task.cancel()
+            self._stats_task = None
+            if self._recovery_task and not self._recovery_task.done():
+                self._recovery_task.cancel()
+            self._recovery_task = None
 
-            # Обрабатываем оставшиеся задачи в очереди
+            # Отменяем обработчики всех стадий
+            if self.pipeline:
+                await self.pipeline.stop()
+            await self.poller.stop()
+            logger.debug("Task pipeline stopped successfully")
+
+            # Обрабатываем оставшиеся задачи в очередях стадий
             pending_tasks = []
-            try:
-                while not self.queue.empty():
-                    task = self.queue.get_nowait()
-                    if task.callback:
-                        try:
-                            # Создаем задачу для callback в текущем loop
-                            if asyncio.iscoroutinefunction(task.callback):
-                                callback_task = asyncio.create_task(
-                                    task.callback(None),
-                                    name=f"callback_task_{id(task)}"
-                                )
-                                pending_tasks.append(callback_task)
-                            else:
-                                # Для синхронных callback'ов используем run_in_executor
-                                await asyncio.to_thread(task.callback, None)
-                        except Exception as e:
-                            logger.error(f"Error during callback execution: {e}", exc_info=True)
-                    self.queue.task_done()
-            except Exception as e:
-                logger.error(f"Error while processing remaining tasks: {e}")
+            remaining = []
+            if self.pipeline:
+                for stage in self.pipeline.stages.values():
+                    remaining.extend(stage.drain())
+            self._in_flight.clear()
+            for task in remaining:
+                if self.store.enabled:
+                    # Задача сохранена в журнале и продолжится после перезапуска
+                    continue
+                for callback in [task.callback] + [callback for callback, _ in task.followers]:
+                    if not callback:
+                        continue
+                    try:
+                        # Обработчики часто - lambda, возвращающие корутину, поэтому
+                        # callback вызывается в loop, а результат ожидается, если он awaitable
+                        notification = callback({"status": STATUS_CANCELLED})
+                        if inspect.isawaitable(notification):
+                            pending_tasks.append(asyncio.ensure_future(notification))
+                    except Exception as e:
+                        logger.error(f"Error during callback execution: {e}", exc_info=True)
 
             # Ожидаем завершения всех callback задач
             if pending_tasks:
@@ -141,6 +662,9 @@ class TaskQueue:
                 except Exception as e:
                     logger.error(f"Error while waiting for tasks completion: {e}", exc_info=True)
 
+            # Сохраняем последние состояния задач
+            await self.store.flush()
+
             # Освобождаем все аккаунты
             await self.account_manager.release_all_accounts()
 
@@ -169,71 +693,322 @@ class TaskQueue:
         except Exception as e:
             logger.error(f"Error during task execution: {e}", exc_info=True)
 
-    async def _process_queue(self) -> None:
-        """Обрабатывает задачи из очереди"""
-        while self._running:
-            async with self._lock:
-                if not self._running:
-                    break
-                    
-                # Проверяем доступность аккаунтов
-                if not self.account_manager.has_available_accounts():
-                    await asyncio.sleep(1)
-                    continue
-                    
-                task = await self.queue.get()
-                api_key = await self.account_manager.get_available_account()
-                
-                if not api_key:
-                    logger.warning("No available accounts, putting task back to queue")
-                    await self.queue.put(task)
-                    await asyncio.sleep(1)
-                    continue
-                    
-                logger.info(f"Selected account {api_key} for task processing")
+    async def _upload(self, task: Task) -> None:
+        """Стадия upload: загружает изображения, не занимая слот аккаунта"""
+        # Если аккаунт уже задан, он зарезервирован в add_task
+        api_key = task.api_key or self.account_manager.reserve_account(exclude=task.excluded)
+        if not api_key:
+            await self._fail(task, "No accounts configured")
+            return
 
-                try:
-                    account = self.account_manager.accounts[api_key]
-                    task_id = await self.runninghub_api.create_task(
-                        api_key=api_key,
-                        workflow_id=account.workflow_id,
-                        product_image_url=task.product_image_url,
-                        background_image_url=task.background_image_url
+        started = time.monotonic()
+        if task.product_file:
+            # Фото продукта загружено заранее - догружаем только фон
+            (task.background_file,) = await self.runninghub_api.upload_images(
+                api_key,
+                task.background_image_url
+            )
+        else:
+            # Оба изображения загружаются одновременно
+            task.product_file, task.background_file = await self.runninghub_api.upload_images(
+                api_key,
+                task.product_image_url,
+                task.background_image_url
+            )
+
+        if not task.product_file or not task.background_file:
+            self.account_manager.release_reservation(api_key)
+            await self._retry(task, "Image upload failed")
+            return
+
+        self.stats.record(
+            METRIC_UPLOAD,
+            time.monotonic() - started,
+            self.account_manager.accounts[api_key].workflow_id,
+            api_key
+        )
+        # Загруженные файлы принадлежат аккаунту, задача закрепляется за ним
+        task.api_key = api_key
+        self._persist(task, STATE_UPLOADED)
+        await self.pipeline["submit"].put(task)
+
+    async def _submit(self, task: Task) -> None:
+        """Стадия submit: занимает слот аккаунта и создает задачу"""
+        await self.account_manager.acquire_account(task.api_key)
+        self.account_manager.release_reservation(task.api_key)
+        logger.info(f"Selected account {task.api_key} for task processing")
+        try:
+            account = self.account_manager.accounts[task.api_key]
+            task.task_id = await self.runninghub_api.create_task(
+                api_key=task.api_key,
+                workflow_id=account.workflow_id,
+                product_file=task.product_file,
+                background_file=task.background_file,
+                seed=task.seed
+            )
+        except RunningHubOverloadError as e:
+            logger.warning(f"{e}, postponing task")
+            self.account_manager.on_overload(task.api_key)
+            await self.account_manager.release_account(task.api_key)
+            await self._postpone(task)
+            return
+        except Exception as e:
+            logger.error(f"Error creating task: {e}", exc_info=True)
+            task.task_id = None
+
+        if not task.task_id:
+            await self.account_manager.release_account(task.api_key)
+            await self._retry(task, "Task creation failed")
+            return
+
+        # Слот остается занятым до завершения стадии poll
+        task.submitted_at = time.monotonic()
+        self._hedge_budget = min(HEDGE_BURST, self._hedge_budget + config.runninghub.hedge_ratio)
+        self._leave_queue(task)
+        self.stats.record(
+            METRIC_QUEUE,
+            task.submitted_at - task.created_at,
+            self.account_manager.accounts[task.api_key].workflow_id,
+            task.api_key
+        )
+        self._persist(task, STATE_SUBMITTED)
+        await self.pipeline["poll"].put(task)
+
+    async def _poll(self, task: Task) -> None:
+        """Стадия poll: ожидает результат и освобождает слот"""
+        attempts = [
+            Attempt(task.api_key, task.task_id, task.product_file, task.background_file, task.submitted_at)
+        ]
+        winner: Optional[Attempt] = None
+        outputs = None
+        try:
+            if config.runninghub.hedging and len(self.account_manager.accounts) > 1:
+                winner, outputs = await self._wait_hedged(task, attempts)
+            else:
+                outputs = await self._wait_for_task_completion(
+                    api_key=task.api_key,
+                    task_id=task.task_id,
+                    workflow_id=self.account_manager.accounts[task.api_key].workflow_id
+                )
+        except Exception as e:
+            logger.error(f"Error waiting for task {task.task_id}: {e}", exc_info=True)
+            outputs = None
+        finally:
+            for attempt in attempts:
+                if attempt is not winner:
+                    # Проигравший запуск бросаем: отменить задачу в RunningHub API не позволяет
+                    self.poller.cancel(attempt.task_id)
+                await self.account_manager.release_account(attempt.api_key)
+
+        if winner is not None and winner is not attempts[0]:
+            self._hedge_wins += 1
+            logger.info(f"Hedged run {winner.task_id} finished before task {task.task_id}")
+            task.api_key, task.task_id = winner.api_key, winner.task_id
+            task.product_file, task.background_file = winner.product_file, winner.background_file
+
+        if outputs:
+            started_at = winner.started_at if winner is not None else task.submitted_at
+            await self.account_manager.on_task_completed(task.api_key, time.monotonic() - started_at)
+            task.result = {
+                "status": STATUS_SUCCESS,
+                "task_id": task.task_id,
+                "output_urls": [output.get("fileUrl") for output in outputs if output.get("fileUrl")],
+                # Для повторной генерации без повторной загрузки
+                "api_key": task.api_key,
+                "product_file": task.product_file,
+                "background_file": task.background_file,
+                "seed": task.seed,
+            }
+        else:
+            task.result = {"status": STATUS_FAILED, "task_id": task.task_id}
+        self._persist(task, STATE_COMPLETED)
+        await self.deliver_stage.put(task)
+
+    async def _wait_hedged(
+        self,
+        task: Task,
+        attempts: List[Attempt]
+    ) -> Tuple[Optional[Attempt], Optional[List[Dict[str, Any]]]]:
+        """Ожидает результат; если задача застряла в очереди RunningHub, дублирует ее на другом аккаунте.
+
+        Побеждает первый запуск с результатом. attempts дополняется
+        дублирующим запуском, чтобы вызывающий освободил его слот.
+        """
+        primary = attempts[0]
+        workflow_id = self.account_manager.accounts[primary.api_key].workflow_id
+        futures = {self.poller.watch(primary.api_key, primary.task_id, workflow_id): primary}
+        # Дублируем, когда ожидание в очереди превысило обычное (квантиль по workflow)
+        delay = max(
+            config.runninghub.hedge_min_delay,
+            self.stats.quantile(
+                METRIC_START,
+                config.runninghub.hedge_quantile,
+                workflow_id=workflow_id,
+                default=config.runninghub.hedge_min_delay
+            )
+        )
+        hedge_at: Optional[float] = task.submitted_at + delay
+        pending = set(futures)
+        while pending:
+            timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                outputs = future.result()
+                if outputs:
+                    return futures[future], outputs
+            if not done and hedge_at is not None:
+                hedge_at = None
+                hedge = await self._hedge(task, primary)
+                if hedge is not None:
+                    attempts.append(hedge)
+                    future = self.poller.watch(
+                        hedge.api_key,
+                        hedge.task_id,
+                        self.account_manager.accounts[hedge.api_key].workflow_id
                     )
+                    futures[future] = hedge
+                    pending.add(future)
+        return None, None
 
-                    if task_id:
-                        results = await self._wait_for_task_completion(
-                            api_key=api_key,
-                            task_id=task_id
-                        )
-                        await task.callback(results)
-                    else:
-                        await task.callback(None)
+    async def _hedge(self, task: Task, primary: Attempt) -> Optional[Attempt]:
+        """Запускает дубль задачи на другом аккаунте, если она еще не начала выполняться"""
+        if self._hedge_budget < 1:
+            return None
+        code = self.poller.get_status(primary.task_id)
+        if code is None:
+            # Поллер еще не опрашивал задачу - спрашиваем статус сами
+            response = await self.runninghub_api.get_task_response(primary.api_key, primary.task_id)
+            code = response.get("code") if response else None
+        if code != CODE_TASK_QUEUED:
+            return None
 
-                except Exception as e:
-                    if task.retries < 3:
-                        task.retries += 1
-                        await self.queue.put(task)
-                    else:
-                        await task.callback(None)
-                finally:
-                    await self.account_manager.release_account(api_key)
-                    self.queue.task_done()
+        api_key = await self.account_manager.try_acquire_account(exclude=(primary.api_key,))
+        if api_key is None:
+            return None
+        self._hedge_budget -= 1
+        try:
+            # Исходники уже загружались - кэш загрузок отдаст имена файлов без повторной передачи
+            product_file, background_file = await self.runninghub_api.upload_images(
+                api_key,
+                task.product_image_url,
+                task.background_image_url
+            )
+            task_id = None
+            if product_file and background_file:
+                task_id = await self.runninghub_api.create_task(
+                    api_key=api_key,
+                    workflow_id=self.account_manager.accounts[api_key].workflow_id,
+                    product_file=product_file,
+                    background_file=background_file,
+                    seed=task.seed
+                )
+        except Exception as e:
+            logger.warning(f"Failed to hedge task {primary.task_id}: {e}")
+            task_id = None
+        if not task_id:
+            await self.account_manager.release_account(api_key)
+            return None
+
+        self._hedges += 1
+        logger.info(f"Task {primary.task_id} is stuck in RunningHub queue, hedged as {task_id} on {api_key[:5]}...")
+        return Attempt(api_key, task_id, product_file, background_file)
+
+    async def _deliver(self, task: Task) -> None:
+        """Стадия deliver: передает результат в callback задачи и присоединившихся запросов"""
+        if task.request_key and self.results.enabled and task.result.get("status") == STATUS_SUCCESS:
+            task.result = await self._cache_result(task.request_key, task.result)
+        if task.request_key and self._in_flight.get(task.request_key) is task:
+            # Дальше одинаковые запросы получат результат из кэша или запустят новую задачу
+            del self._in_flight[task.request_key]
+        started = time.monotonic()
+        callbacks = [task.callback] + [callback for callback, _ in task.followers]
+        if not any(callbacks):
+            logger.warning(f"Task {task.task_id} finished with no one to deliver the result to")
+        for callback in callbacks:
+            if not callback:
+                continue
+            try:
+                # Каждому получателю своя копия результата
+                await callback(dict(task.result))
+            except Exception as e:
+                logger.error(f"Error delivering task result: {e}", exc_info=True)
+        if task.callback:
+            self.stats.record(METRIC_DELIVERY, time.monotonic() - started)
+        self._finish_user_task(task)
+        self._persist(task, STATE_DELIVERED)
+
+    async def _cache_result(self, request_key: tuple, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Скачивает изображения результата в кэш; при ошибке возвращает результат как есть"""
+        urls = result.get("output_urls") or []
+        if not urls:
+            return result
+        images = await asyncio.gather(
+            *(self.runninghub_api.download_file(url) for url in urls),
+            return_exceptions=True
+        )
+        if not all(isinstance(image, bytes) for image in images):
+            logger.warning(f"Failed to download outputs of task {result.get('task_id')}, not caching")
+            return result
+        return await self.results.put(ResultCache.make_key(*request_key), result, images, urls)
+
+    async def _postpone(self, task: Task) -> None:
+        """Возвращает задачу в стадию submit после отказа перегруженного аккаунта"""
+        task.overloads += 1
+        if task.overloads > config.runninghub.max_retries:
+            # Аккаунт долго не принимает задачи - загружаем на другой
+            task.overloads = 0
+            task.excluded.add(task.api_key)
+            await self._retry(task, "Account stays overloaded")
+            return
+        # Уменьшенный лимит аккаунта сам ограничит повторную отправку
+        self.account_manager.reserve_account(task.api_key)
+        self.loop.call_later(
+            config.runninghub.retry_delay,
+            lambda: self.loop.create_task(self.pipeline["submit"].put(task))
+        )
+
+    def _on_poll_status(self, api_key: str, code: Optional[int]) -> None:
+        """Задача стоит в очереди RunningHub - аккаунт работает выше своего лимита"""
+        if code == CODE_TASK_QUEUED:
+            self.account_manager.on_overload(api_key)
+
+    async def _retry(self, task: Task, reason: str) -> None:
+        """Повторяет задачу с начала или завершает ее с ошибкой"""
+        if task.retries < config.runninghub.max_retries:
+            task.retries += 1
+            logger.warning(f"{reason}, retrying task (attempt {task.retries})")
+            # Аккаунт выбирается заново, без исключенных после перегрузки
+            task.api_key = None
+            task.product_file = task.background_file = None
+            # Повтор приходит из обработчиков стадий: ожидание места в очереди
+            # upload при заполненных upload и submit заблокировало бы обе стадии
+            if self.upload_stage.offer(task):
+                self._persist(task, STATE_QUEUED)
+            else:
+                await self._fail(task, f"{reason}, upload queue is full")
+        else:
+            await self._fail(task, reason)
+
+    async def _fail(self, task: Task, reason: str) -> None:
+        """Передает ошибку на стадию deliver"""
+        logger.error(f"Task failed: {reason}")
+        self._leave_queue(task)
+        task.result = {"status": STATUS_FAILED, "task_id": task.task_id}
+        self._persist(task, STATE_COMPLETED)
+        await self.deliver_stage.put(task)
 
     async def _wait_for_task_completion(
         self,
         api_key: str,
-        task_id: str
-    ) -> Optional[Dict[str, Any]]:
-        """Ожидает завершения задачи"""
-        while True:
-            await asyncio.sleep(5)
-            results = await self.runninghub_api.get_task_outputs(
-                api_key=api_key,
-                task_id=task_id
-            )
-            if results:
-                return results
+        task_id: str,
+        workflow_id: Optional[str] = None
+    ) -> Optional[List[Dict[str, Any]]]:
+        """Ожидает завершения задачи через общий поллер"""
+        return await self.poller.wait_for_outputs(
+            api_key=api_key,
+            task_id=task_id,
+            workflow_id=workflow_id
+        )
 
 # Создаем экземпляр TaskQueue
 from .account_manager import account_manager
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Состояния задачи в хранилище
+STATE_QUEUED = "queued"
+STATE_UPLOADED = "uploaded"
+STATE_SUBMITTED = "submitted"
+STATE_COMPLETED = "completed"
+STATE_DELIVERED = "delivered"
+
+# Задачи в этих состояниях восстанавливаются после перезапуска
+RECOVERABLE_STATES = (STATE_QUEUED, STATE_UPLOADED, STATE_SUBMITTED, STATE_COMPLETED)
+
+@dataclass
+class StoredTask:
+    record_id: str
+    state: str
+    product_image_url: Optional[str] = None
+    background_image_url: Optional[str] = None
+    api_key: Optional[str] = None
+    product_file: Optional[str] = None
+    background_file: Optional[str] = None
+    task_id: Optional[str] = None
+    seed: Optional[int] = None
+    retries: int = 0
+    result: Optional[Dict[str, Any]] = None
+    context: Optional[Dict[str, Any]] = None
+    updated_at: float = 0.0
+
+_COLUMNS = (
+    "record_id", "state", "product_image_url", "background_image_url", "api_key",
+    "product_file", "background_file", "task_id", "seed", "retries", "result",
+    "context", "updated_at"
+)
+
+class TaskStore:
+    """Журнал состояний задач в SQLite (WAL).
+
+    Изменения копятся в памяти и записываются одной транзакцией раз в
+    flush_interval секунд, поэтому запись не блокирует конвейер даже при
+    сотнях задач в минуту. Для каждой задачи хранится только последнее
+    состояние.
+    """
+
+    def __init__(self, path: Optional[str] = None, flush_interval: float = 0.2, retention: float = 86400):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self._db: Optional[sqlite3.Connection] = None
+        self._pending: Dict[str, StoredTask] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # Запись идет из потоков to_thread, соединение одно
+        self._write_lock = threading.Lock()
+        if path:
+            self._open_db()
+
+    @property
+    def enabled(self) -> bool:
+        """Ведется ли журнал (задан путь и база открылась)"""
+        return self._db is not None
+
+    def _open_db(self) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "record_id TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                "product_image_url TEXT, background_image_url TEXT, api_key TEXT, "
+                "product_file TEXT, background_file TEXT, task_id TEXT, seed INTEGER, "
+                "retries INTEGER NOT NULL DEFAULT 0, result TEXT, context TEXT, "
+                "updated_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to open task store {self.path}: {e}")
+            self._db = None
+
+    def start(self) -> None:
+        """Запускает фоновую запись изменений"""
+        if not self.enabled or (self._flusher and not self._flusher.done()):
+            return
+        self._wakeup = asyncio.Event()
+        self._flusher = asyncio.get_running_loop().create_task(
+            self._flush_loop(), name="task_store_flusher"
+        )
+
+    def save(self, record: StoredTask) -> None:
+        """Запоминает новое состояние задачи (запишется при следующем сбросе)"""
+        if not self.enabled:
+            return
+        record.updated_at = time.time()
+        self._pending[record.record_id] = record
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения одной транзакцией"""
+        if not self._pending or not self.enabled:
+            return
+        batch = list(self._pending.values())
+        self._pending.clear()
+        await asyncio.to_thread(self._write, batch)
+
+    def _write(self, batch: List[StoredTask]) -> None:
+        rows = [
+            (
+                record.record_id, record.state, record.product_image_url,
+                record.background_image_url, record.api_key, record.product_file,
+                record.background_file, record.task_id, record.seed, record.retries,
+                json.dumps(record.result) if record.result is not None else None,
+                json.dumps(record.context) if record.context is not None else None,
+                record.updated_at
+            )
+            for record in batch
+        ]
+        with self._write_lock:
+            self._write_rows(rows)
+
+    def _write_rows(self, rows: List[tuple]) -> None:
+        try:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO tasks ({', '.join(_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(_COLUMNS))})",
+                rows
+            )
+            self._db.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to persist {len(rows)} task states: {e}")
+            try:
+                self._db.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # Даем накопиться пачке изменений
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing task store: {e}", exc_info=True)
+
+    def load_unfinished(self) -> List[StoredTask]:
+        """Возвращает задачи, не доведенные до доставки, и чистит старые записи"""
+        if not self.enabled:
+            return []
+        try:
+            self._db.execute(
+                "DELETE FROM tasks WHERE state = ? AND updated_at < ?",
+                (STATE_DELIVERED, time.time() - self.retention)
+            )
+            rows = self._db.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM tasks "
+                f"WHERE state IN ({', '.join('?' * len(RECOVERABLE_STATES))}) "
+                "ORDER BY updated_at",
+                RECOVERABLE_STATES
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to load unfinished tasks: {e}")
+            return []
+
+        records = []
+        for row in rows:
+            values = dict(zip(_COLUMNS, row))
+            values["result"] = json.loads(values["result"]) if values["result"] else None
+            values["context"] = json.loads(values["context"]) if values["context"] else None
+            records.append(StoredTask(**values))
+        return records
+
+    async def close(self) -> None:
+        """Сбрасывает изменения на диск и закрывает SQLite"""
+        if self._flusher and not self._flusher.done():
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+        self._flusher = None
+        await self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+# Журнал задач на постоянном томе (пустой путь - без восстановления)
+task_store = TaskStore(
+    path=config.runninghub.task_store_path or None,
+    flush_interval=config.runninghub.task_store_flush_interval
+)
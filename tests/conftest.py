@@ -0,0 +1,7 @@
+import os
+
+# Конфигурация загружается при импорте сервисов и требует токен и хотя бы один аккаунт
+os.environ.setdefault("BOT_TOKEN", "123:test")
+os.environ.setdefault("WEBHOOK_HOST", "example.com")
+os.environ.setdefault("RUNNINGHUB_API_KEY_1", "test-key")
+os.environ.setdefault("RUNNINGHUB_WORKFLOW_ID_1", "1")
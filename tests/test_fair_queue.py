@@ -0,0 +1,53 @@
+import sys
+import os
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+
+from services.fair_queue import FairQueue
+
+def drain(queue):
+    return [queue.get_nowait() for _ in range(queue.qsize())]
+
+def test_users_are_interleaved():
+    """Пачка задач одного пользователя не блокирует остальных"""
+    async def run():
+        queue = FairQueue(key=lambda item: ("standard", item[0]))
+        for i in range(5):
+            queue.put_nowait(("heavy", i))
+        queue.put_nowait(("light", 0))
+        queue.put_nowait(("other", 0))
+        return drain(queue)
+
+    order = asyncio.run(run())
+    assert order[:3] == [("heavy", 0), ("light", 0), ("other", 0)]
+    assert [item for item in order if item[0] == "heavy"] == [("heavy", i) for i in range(5)]
+
+def test_lane_weights():
+    """Полосы получают задачи пропорционально весам"""
+    async def run():
+        queue = FairQueue(
+            key=lambda item: (item[0], item[1]),
+            weights={"paid": 3, "standard": 1}
+        )
+        for i in range(12):
+            queue.put_nowait(("standard", i % 3, i))
+            queue.put_nowait(("paid", i % 2, i))
+        return drain(queue)
+
+    order = asyncio.run(run())
+    first = [item[0] for item in order[:8]]
+    assert first.count("paid") == 6
+    assert first.count("standard") == 2
+    assert len(order) == 24
+
+def test_maxsize_is_respected():
+    async def run():
+        queue = FairQueue(key=lambda item: ("standard", item), maxsize=2)
+        queue.put_nowait(1)
+        queue.put_nowait(2)
+        return queue.full()
+
+    assert asyncio.run(run())
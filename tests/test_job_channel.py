@@ -0,0 +1,87 @@
+import sys
+import os
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+
+from config import config
+from services.integration import IntegrationService, MODE_FRONTEND
+from services.job_channel import JobChannel
+from services.task_queue import REJECT_QUEUE_FULL, REJECT_USER_LIMIT
+
+async def noop(result):
+    pass
+
+def make_frontend(tmp_path):
+    service = IntegrationService({}, mode=MODE_FRONTEND)
+    service.channel = JobChannel(str(tmp_path / "jobs.sqlite"), poll_interval=0.01)
+    return service
+
+def test_frontend_enforces_user_limit(tmp_path, monkeypatch):
+    """Frontend отклоняет задания сверх лимита пользователя, пакет занимает одно место"""
+    monkeypatch.setattr(config.runninghub, "max_user_tasks", 2)
+    service = make_frontend(tmp_path)
+
+    async def scenario():
+        submit = service.add_generation_task
+        batch = [
+            await submit("p", "b", noop, context={"user_id": 1, "batch_id": "album"})
+            for _ in range(4)
+        ]
+        single = await submit("p", "b", noop, context={"user_id": 1})
+        extra = await submit("p", "b", noop, context={"user_id": 1})
+        other = await submit("p", "b", noop, context={"user_id": 2})
+        return batch, single, extra, other
+
+    batch, single, extra, other = asyncio.run(scenario())
+    assert all(batch) and single and other
+    assert extra.reason == REJECT_USER_LIMIT
+    assert single.position == 5
+
+def test_frontend_enforces_queue_depth_and_frees_places(tmp_path, monkeypatch):
+    """Невзятые задания канала ограничены max_queue_depth; доставленный результат освобождает место"""
+    monkeypatch.setattr(config.runninghub, "max_queue_depth", 2)
+    monkeypatch.setattr(config.runninghub, "max_user_tasks", 1)
+    service = make_frontend(tmp_path)
+    worker = JobChannel(str(tmp_path / "jobs.sqlite"))
+    delivered = []
+
+    async def record(result):
+        delivered.append(result)
+
+    async def scenario():
+        first = await service.add_generation_task("p", "b", record, context={"user_id": 1})
+        second = await service.add_generation_task("p", "b", noop, context={"user_id": 2})
+        full = await service.add_generation_task("p", "b", noop, context={"user_id": 3})
+
+        (job_id, _), = await worker.claim(1)
+        await worker.complete(job_id, {"status": "SUCCESS"})
+        delivery = asyncio.get_running_loop().create_task(service.channel.deliver_results())
+        while not delivered:
+            await asyncio.sleep(0.01)
+        delivery.cancel()
+        again = await service.add_generation_task("p", "b", noop, context={"user_id": 1})
+        return first, second, full, again
+
+    first, second, full, again = asyncio.run(scenario())
+    assert first and second
+    assert full.reason == REJECT_QUEUE_FULL
+    assert again
+
+def test_workers_claim_jobs_fairly(tmp_path, monkeypatch):
+    """Воркеры забирают задания по кругу между пользователями, платная полоса - чаще"""
+    monkeypatch.setattr(config.runninghub, "paid_user_ids", frozenset({3}))
+    channel = JobChannel(str(tmp_path / "jobs.sqlite"))
+
+    async def scenario():
+        for user_id in (1, 1, 1, 1, 2, 2, 3, 3, 3):
+            await channel.submit({"context": {"user_id": user_id}})
+        first = await channel.claim(3)
+        # Следующие задания учитывают уже взятые воркерами
+        rest = [await channel.claim(1) for _ in range(6)]
+        return [job for jobs in [first] + rest for job in jobs]
+
+    users = [payload["context"]["user_id"] for _, payload in asyncio.run(scenario())]
+    assert users == [3, 3, 1, 2, 3, 1, 2, 1, 1]
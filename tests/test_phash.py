@@ -0,0 +1,101 @@
+import sys
+import os
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+from services.image_prep import ImageNormalizer
+from services.phash import PerceptualIndex
+from services.runninghub import RunningHubAPI
+
+def flip(value, *bits):
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+def test_near_duplicate_maps_to_first_digest():
+    """Хэш на расстоянии не больше порога находит уже известное изображение"""
+    index = PerceptualIndex(max_distance=3)
+    base = random.Random(1).getrandbits(64)
+    assert index.add(base, "first") == "first"
+    assert index.add(flip(base, 0, 17, 63), "second") == "first"
+    assert index.canonical("second") == "first"
+    assert index.add(flip(base, 0, 17, 40, 63), "third") == "third"
+    assert len(index) == 2
+
+def test_finds_neighbours_among_many_entries():
+    """Поиск точен и среди большого числа случайных хэшей"""
+    rng = random.Random(2)
+    index = PerceptualIndex(max_distance=3, max_entries=50000)
+    hashes = [rng.getrandbits(64) for _ in range(20000)]
+    for number, value in enumerate(hashes):
+        index.add(value, f"d{number}")
+    for number in range(0, 20000, 997):
+        assert index.find(flip(hashes[number], rng.randrange(64), rng.randrange(64))) == f"d{number}"
+
+def test_index_is_bounded():
+    """Старые записи вытесняются, их части удаляются из таблиц"""
+    index = PerceptualIndex(max_distance=3, max_entries=100)
+    rng = random.Random(3)
+    first = rng.getrandbits(64)
+    index.add(first, "old")
+    for number in range(200):
+        index.add(rng.getrandbits(64), f"d{number}")
+    assert len(index) == 100
+    assert index.find(first) is None
+    assert sum(len(bucket) for table in index._tables for bucket in table.values()) == 100 * 4
+
+def image_bytes(image, format="PNG", **options):
+    output = io.BytesIO()
+    image.save(output, format=format, **options)
+    return output.getvalue()
+
+def background_digests(*images):
+    api = RunningHubAPI(normalizer=ImageNormalizer(workers=0), backgrounds=PerceptualIndex())
+
+    async def digests():
+        return [await api.background_digest(data) for data in images]
+
+    return asyncio.run(digests())
+
+def gradient(start, end):
+    image = Image.new("RGB", (64, 64))
+    for row in range(64):
+        color = tuple(a + (b - a) * row // 63 for a, b in zip(start, end))
+        ImageDraw.Draw(image).line([(0, row), (63, row)], fill=color)
+    return image
+
+def test_plain_backgrounds_are_not_merged():
+    """Однотонные фоны и градиенты разных цветов не считаются одним изображением"""
+    images = [
+        image_bytes(Image.new("RGB", (64, 64), color))
+        for color in ("red", "blue", "white")
+    ] + [
+        image_bytes(gradient((0, 0, 0), (255, 255, 255))),
+        image_bytes(gradient((255, 0, 0), (0, 0, 255)))
+    ]
+    digests = background_digests(*images)
+    assert len(set(digests)) == len(images)
+
+def test_textured_background_differs_by_color():
+    """Пережатый фон считается тем же, перекрашенный с тем же рисунком - нет"""
+    rng = random.Random(4)
+    image = Image.new("RGB", (64, 48), (200, 180, 160))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(64), rng.randrange(48)
+        draw.ellipse([x, y, x + 12, y + 12], fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    tinted = Image.eval(image, lambda value: min(255, value + 60))
+    original, recompressed, other = background_digests(
+        image_bytes(image),
+        image_bytes(image.resize((128, 96)), format="JPEG", quality=85),
+        image_bytes(tinted)
+    )
+    assert recompressed == original
+    assert other != original
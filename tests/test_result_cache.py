@@ -0,0 +1,65 @@
+import sys
+import os
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import time
+
+from services.result_cache import ResultCache
+
+def test_result_and_file_ids_survive_restart(tmp_path):
+    """Результат и file_id отправленных изображений читаются после перезапуска"""
+    directory = str(tmp_path)
+    key = ResultCache.make_key("hash", 42)
+
+    async def store():
+        cache = ResultCache(directory)
+        stored = await cache.put(key, {"status": "SUCCESS"}, [b"one", b"two"], ["u/a.jpg", "u/b"])
+        await cache.remember_file_id(key, 1, "file-2")
+        cache.close()
+        return stored
+
+    stored = asyncio.run(store())
+    assert [os.path.splitext(path)[1] for path in stored["output_paths"]] == [".jpg", ".png"]
+
+    cache = ResultCache(directory)
+    result = asyncio.run(cache.get(key))
+    assert result["status"] == "SUCCESS"
+    assert result["output_file_ids"] == [None, "file-2"]
+    assert asyncio.run(cache.get(ResultCache.make_key("hash", 43))) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_least_recently_used_result_is_evicted(tmp_path):
+    """При превышении лимита вытесняется результат, который дольше всех не запрашивался"""
+    cache = ResultCache(str(tmp_path), max_bytes=10)
+
+    async def scenario():
+        await cache.put("a", {}, [b"aaaa"], ["a.png"])
+        time.sleep(0.01)
+        await cache.put("b", {}, [b"bbbb"], ["b.png"])
+        time.sleep(0.01)
+        await cache.get("a")
+        time.sleep(0.01)
+        await cache.put("c", {}, [b"cccc"], ["c.png"])
+        return [await cache.get(key) is not None for key in "abc"]
+
+    assert asyncio.run(scenario()) == [True, False, True]
+    assert not any(name.startswith("b_") for name in os.listdir(str(tmp_path)))
+
+def test_storing_same_key_again_keeps_new_files(tmp_path):
+    """Повторное сохранение результата заменяет старые файлы, не удаляя новые"""
+    cache = ResultCache(str(tmp_path))
+
+    async def scenario():
+        first = await cache.put("a", {}, [b"old"], ["a.png"])
+        second = await cache.put("a", {}, [b"newer"], ["a.png"])
+        return first, second, await cache.get("a")
+
+    first, second, result = asyncio.run(scenario())
+    assert not os.path.exists(first["output_paths"][0])
+    assert result["output_paths"] == second["output_paths"]
+    with open(result["output_paths"][0], "rb") as file:
+        assert file.read() == b"newer"
+    assert cache._size == len(b"newer")
@@ -0,0 +1,77 @@
+import sys
+import os
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataclasses import dataclass
+
+from services.scheduler import (
+    LeastLoadedPolicy,
+    WeightedRoundRobinPolicy,
+    LatencyWeightedPolicy,
+    create_policy,
+)
+
+@dataclass
+class Status:
+    active_tasks: int = 0
+    max_tasks: int = 5
+    reserved: int = 0
+    remote_tasks: int = 0
+
+    @property
+    def limit(self) -> int:
+        return self.max_tasks
+
+def take(policy, statuses):
+    """Занимает слот так же, как AccountManager"""
+    api_key = policy.choose()
+    if api_key is None:
+        return None
+    statuses[api_key].active_tasks += 1
+    policy.on_selected(api_key)
+    policy.update(api_key)
+    return api_key
+
+def make(policy, limits):
+    statuses = {f"key{i}": Status(max_tasks=limit) for i, limit in enumerate(limits)}
+    for api_key, status in statuses.items():
+        policy.add_account(api_key, status)
+    return statuses
+
+def test_least_loaded_spreads_tasks():
+    policy = LeastLoadedPolicy()
+    statuses = make(policy, [5, 5, 5])
+    chosen = [take(policy, statuses) for _ in range(3)]
+    assert sorted(chosen) == ["key0", "key1", "key2"]
+
+def test_full_accounts_are_not_chosen_until_released():
+    policy = LeastLoadedPolicy()
+    statuses = make(policy, [1, 1])
+    assert take(policy, statuses) is not None
+    assert take(policy, statuses) is not None
+    assert take(policy, statuses) is None
+
+    statuses["key1"].active_tasks -= 1
+    policy.update("key1")
+    assert take(policy, statuses) == "key1"
+
+def test_weighted_round_robin_follows_limits():
+    policy = WeightedRoundRobinPolicy()
+    statuses = make(policy, [4, 2])
+    counts = {"key0": 0, "key1": 0}
+    for _ in range(6):
+        api_key = take(policy, statuses)
+        counts[api_key] += 1
+    assert counts == {"key0": 4, "key1": 2}
+
+def test_latency_weighted_prefers_fast_account():
+    policy = LatencyWeightedPolicy()
+    statuses = make(policy, [5, 5])
+    policy.record_latency("key0", 100.0)
+    policy.record_latency("key1", 10.0)
+    assert take(policy, statuses) == "key1"
+
+def test_unknown_policy_falls_back_to_least_loaded():
+    assert isinstance(create_policy("unknown"), LeastLoadedPolicy)
@@ -0,0 +1,48 @@
+import sys
+import os
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+
+from services.slot_ledger import SQLiteSlotLedger
+
+def test_slots_are_shared_between_processes_in_ticket_order(tmp_path):
+    """Два процесса делят лимит аккаунта, освободившийся слот получает первый в очереди"""
+    path = str(tmp_path / "slots.sqlite")
+
+    async def scenario():
+        first, second = SQLiteSlotLedger(path), SQLiteSlotLedger(path)
+        lease, _ = await first.try_acquire("key", limit=1)
+        assert lease
+        assert await first.remote_usage() == {}
+        assert await second.remote_usage() == {"key": 1}
+
+        waiting, ticket = await second.try_acquire("key", limit=1)
+        assert waiting is None and ticket is not None
+        # Новый запрос без номера не обгоняет очередь
+        await first.release(lease)
+        assert (await first.try_acquire("key", limit=1))[0] is None
+        granted, _ = await second.try_acquire("key", limit=1, ticket=ticket)
+        assert granted
+        await first.close()
+        await second.close()
+
+    asyncio.run(scenario())
+
+def test_expired_leases_of_crashed_process_are_reclaimed(tmp_path):
+    """Аренды процесса, переставшего их продлевать, истекают и слот возвращается в пул"""
+    path = str(tmp_path / "slots.sqlite")
+
+    async def scenario():
+        crashed = SQLiteSlotLedger(path, lease_ttl=0.05)
+        alive = SQLiteSlotLedger(path)
+        assert (await crashed.try_acquire("key", limit=1))[0]
+        waiting, ticket = await alive.try_acquire("key", limit=1)
+        assert waiting is None
+        await asyncio.sleep(0.1)
+        assert (await alive.try_acquire("key", limit=1, ticket=ticket))[0]
+        await alive.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,39 @@
+import sys
+import os
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import time
+
+from services.spool import SpoolStore
+
+def test_put_source_discard(tmp_path):
+    """Фото доступно по handle до удаления"""
+    spool = SpoolStore(str(tmp_path))
+
+    async def scenario():
+        handle = await spool.put(b"photo")
+        source = spool.source(handle)
+        spool.discard(handle)
+        await spool.close()
+        return handle, source
+
+    handle, source = asyncio.run(scenario())
+    assert source == f"file://{os.path.join(str(tmp_path), handle)}"
+    assert spool.source(handle) is None
+    assert spool.source(None) is None
+
+def test_remove_expired_by_age_then_size(tmp_path):
+    """Очистка удаляет устаревшие фото, затем самые старые сверх лимита размера"""
+    spool = SpoolStore(str(tmp_path), ttl=60, max_bytes=8)
+    now = time.time()
+    for name, age in (("old", 120), ("recent", 30), ("fresh", 0)):
+        path = os.path.join(str(tmp_path), name)
+        with open(path, "wb") as file:
+            file.write(b"12345")
+        os.utime(path, (now - age, now - age))
+
+    assert spool._remove_expired() == 2
+    assert os.listdir(str(tmp_path)) == ["fresh"]
@@ -0,0 +1,36 @@
+import sys
+import os
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import random
+
+from services.stats import LatencyStats, LogHistogram, METRIC_RUN
+
+def test_histogram_quantiles_are_close():
+    histogram = LogHistogram()
+    values = [random.uniform(10, 100) for _ in range(1000)]
+    for value in values:
+        histogram.add(value)
+    values.sort()
+    for q in (0.1, 0.5, 0.9):
+        exact = values[int(q * len(values))]
+        assert abs(histogram.quantile(q) - exact) / exact < 0.2
+
+def test_histogram_memory_is_constant():
+    histogram = LogHistogram(decay_after=100)
+    size = len(histogram.counts)
+    for i in range(10000):
+        histogram.add(i % 50 + 1)
+    assert len(histogram.counts) == size
+    assert histogram.total < 100
+
+def test_stats_fall_back_to_wider_series():
+    stats = LatencyStats()
+    assert stats.quantile(METRIC_RUN, 0.5, workflow_id="1", default=7.0) == 7.0
+    for _ in range(10):
+        stats.record(METRIC_RUN, 30.0, workflow_id="1", api_key="key0")
+    # Для аккаунта без наблюдений используется серия workflow
+    assert 25 < stats.quantile(METRIC_RUN, 0.5, workflow_id="1", api_key="key1") < 36
+    assert stats.mean(METRIC_RUN, api_key="key0") == 30.0
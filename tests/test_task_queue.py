@@ -0,0 +1,449 @@
+import sys
+import os
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import math
+import time
+
+import pytest
+
+from config import config
+from services.account_manager import AccountManager
+from services.poller import TaskPoller
+from services.result_cache import ResultCache
+from services.runninghub import CODE_TASK_QUEUED, RunningHubOverloadError
+from services.slot_ledger import LocalSlotLedger
+from services.stats import LatencyStats
+from services.task_queue import TaskQueue
+from services.task_store import (
+    STATE_COMPLETED,
+    STATE_DELIVERED,
+    STATE_QUEUED,
+    STATE_SUBMITTED,
+    STATE_UPLOADED,
+    StoredTask,
+    TaskStore,
+)
+
+class FakeAPI:
+    """RunningHub, у которого перегружены аккаунты из overloaded"""
+
+    def __init__(self, overloaded=()):
+        self.overloaded = set(overloaded)
+        self.created = []
+        self.uploaded = []
+
+    async def upload_images(self, api_key, *sources):
+        self.uploaded.extend(sources)
+        return [f"{api_key}-{source}" for source in sources]
+
+    async def create_task(self, api_key, **kwargs):
+        self.created.append(api_key)
+        if api_key in self.overloaded:
+            raise RunningHubOverloadError(api_key, 421)
+        return f"task-{len(self.created)}"
+
+    async def get_task_response(self, api_key, task_id):
+        return {"code": 0, "data": [{"fileUrl": f"https://result/{task_id}.png"}]}
+
+    async def background_digest(self, source):
+        return None
+
+class QueuedAPI(FakeAPI):
+    """RunningHub, где задача стоит в очереди stuck[аккаунт] секунд после создания"""
+
+    def __init__(self, stuck):
+        super().__init__()
+        self.stuck = stuck
+        self.tasks = {}
+        self.polls = []
+
+    async def create_task(self, api_key, **kwargs):
+        task_id = await super().create_task(api_key, **kwargs)
+        self.tasks[task_id] = (api_key, time.monotonic())
+        return task_id
+
+    async def get_task_response(self, api_key, task_id):
+        self.polls.append((api_key, time.monotonic()))
+        owner, created_at = self.tasks.setdefault(task_id, (api_key, time.monotonic()))
+        if time.monotonic() - created_at < self.stuck.get(owner, math.inf):
+            return {"code": CODE_TASK_QUEUED}
+        return await super().get_task_response(api_key, task_id)
+
+@pytest.fixture(autouse=True)
+def fast_config(monkeypatch):
+    settings = config.runninghub
+    monkeypatch.setattr(settings, "retry_delay", 0)
+    monkeypatch.setattr(settings, "max_retries", 3)
+    monkeypatch.setattr(settings, "expected_completion_time", 0.05)
+    monkeypatch.setattr(settings, "min_poll_interval", 0.01)
+    monkeypatch.setattr(settings, "stats_log_interval", 0)
+    monkeypatch.setattr(settings, "hedging", False)
+    monkeypatch.setattr(settings, "dedup_requests", False)
+
+def make_queue(api, store=None):
+    manager = AccountManager(policy="least_loaded", api=api, ledger=LocalSlotLedger())
+    manager.add_account("k1", "w1", max_tasks=2)
+    manager.add_account("k2", "w2", max_tasks=2)
+    stats = LatencyStats()
+    return TaskQueue(
+        manager,
+        poller=TaskPoller(api=api, stats=stats),
+        api=api,
+        store=store or TaskStore(None),
+        stats=stats,
+        results=ResultCache(None)
+    )
+
+async def recover(queue, records, count):
+    """Запускает очередь на журнале с записями records и ждет count результатов"""
+    results = []
+    done = asyncio.Event()
+
+    def recovery_handler(context):
+        async def deliver(result):
+            results.append((context["chat_id"], result))
+            if len(results) == count:
+                done.set()
+        return deliver
+
+    for record in records:
+        queue.store.save(record)
+    await queue.store.flush()
+    queue.recovery_handler = recovery_handler
+    await queue.start()
+    try:
+        await asyncio.wait_for(done.wait(), timeout=10)
+    finally:
+        await queue.stop()
+        await queue.store.close()
+    return sorted(results, key=lambda item: item[0])
+
+def before_stop(queue, check):
+    """Выполняет check перед queue.stop(), который освобождает все слоты и резервы"""
+    checked = []
+    stop = queue.stop
+
+    async def check_and_stop():
+        checked.append(check())
+        await stop()
+
+    queue.stop = check_and_stop
+    return checked
+
+async def run_tasks(queue, count, **options):
+    results = []
+    done = asyncio.Event()
+
+    async def callback(result):
+        results.append(result)
+        if len(results) == count:
+            done.set()
+
+    await queue.start()
+    try:
+        for number in range(count):
+            await queue.add_task(f"product{number}", "background", callback, **options)
+        await asyncio.wait_for(done.wait(), timeout=10)
+    finally:
+        await queue.stop()
+    return results
+
+def test_overloaded_account_is_excluded_on_retry():
+    """Задача, которую аккаунт долго отклоняет из-за перегрузки, уходит на другой аккаунт"""
+    api = FakeAPI(overloaded={"k1"})
+    results = asyncio.run(run_tasks(make_queue(api), 4))
+
+    assert [result["status"] for result in results] == ["SUCCESS"] * 4
+    assert {result["api_key"] for result in results} == {"k2"}
+    # Каждая задача отправляется на k1 не больше max_retries + 1 раз
+    assert api.created.count("k1") <= 4 * (config.runninghub.max_retries + 1)
+
+def test_stop_notifies_lambda_callbacks():
+    """При остановке ожидающие задачи получают CANCELLED и через lambda, возвращающую корутину"""
+    class SlowAPI(FakeAPI):
+        async def create_task(self, api_key, **kwargs):
+            await asyncio.sleep(60)
+
+    async def scenario():
+        queue = make_queue(SlowAPI())
+        results = []
+
+        async def record(result):
+            results.append(result["status"])
+
+        await queue.start()
+        for number in range(8):
+            await queue.add_task(f"product{number}", "background", lambda result: record(result))
+        await asyncio.sleep(0.2)
+        await queue.stop()
+        return results
+
+    assert "CANCELLED" in asyncio.run(scenario())
+
+def test_retries_do_not_block_full_stage_queues(monkeypatch):
+    """Повторы при заполненных очередях upload и submit не блокируют конвейер"""
+    monkeypatch.setattr(config.runninghub, "stage_queue_size", 1)
+    monkeypatch.setattr(config.runninghub, "upload_concurrency", 1)
+
+    class FailingAPI(FakeAPI):
+        async def create_task(self, api_key, **kwargs):
+            await asyncio.sleep(0.01)
+            return None
+
+    queue = make_queue(FailingAPI())
+
+    async def scenario():
+        results = []
+        done = asyncio.Event()
+
+        async def callback(result):
+            results.append(result)
+            if len(results) == 8:
+                done.set()
+
+        await queue.start()
+        try:
+            await asyncio.gather(*(
+                queue.add_task(f"product{number}", "background", callback) for number in range(8)
+            ))
+            await asyncio.wait_for(done.wait(), timeout=5)
+        finally:
+            await queue.stop()
+        return results
+
+    results = asyncio.run(scenario())
+    assert [result["status"] for result in results] == ["FAILED"] * 8
+
+def test_batch_takes_one_place_in_user_limit(monkeypatch):
+    """Пакет из нескольких фото занимает в лимите пользователя одно место"""
+    monkeypatch.setattr(config.runninghub, "max_user_tasks", 2)
+
+    class SlowAPI(FakeAPI):
+        async def create_task(self, api_key, **kwargs):
+            await asyncio.sleep(60)
+
+    async def noop(result):
+        pass
+
+    async def scenario():
+        queue = make_queue(SlowAPI())
+        await queue.start()
+        try:
+            batch = {"user_id": 7, "batch_id": "album"}
+            admitted = [
+                await queue.add_task(f"product{number}", "background", noop, context=dict(batch))
+                for number in range(5)
+            ]
+            single = await queue.add_task("single", "background", noop, context={"user_id": 7})
+            rejected = await queue.add_task("extra", "background", noop, context={"user_id": 7})
+            return admitted, single, rejected, dict(queue._user_tasks)
+        finally:
+            await queue.stop()
+
+    admitted, single, rejected, user_tasks = asyncio.run(scenario())
+    assert all(admitted)
+    assert single
+    assert not rejected
+    assert user_tasks == {7: 2}
+
+def test_regenerate_seed_changes_request_key():
+    """Повтор с новым seed не объединяется с исходным запросом и не берется из кэша"""
+    queue = make_queue(FakeAPI())
+    first = asyncio.run(queue._request_key("https://p.png", "https://b.png", None))
+    again = asyncio.run(queue._request_key("https://p.png", "https://b.png", 42))
+    assert first != again
+
+def test_recovered_task_without_spooled_photo_fails(tmp_path):
+    """Задача из журнала, фото которой больше нет на диске, завершается ошибкой без загрузки"""
+    api = FakeAPI()
+    queue = make_queue(api, store=TaskStore(str(tmp_path / "tasks.sqlite")))
+    record = StoredTask(
+        record_id="lost",
+        state=STATE_QUEUED,
+        product_image_url=f"file://{tmp_path / 'spool' / 'gone'}",
+        background_image_url="https://example.com/background.png",
+        context={"chat_id": 1}
+    )
+    results = asyncio.run(recover(queue, [record], 1))
+    assert results[0][1]["status"] == "FAILED"
+    assert api.uploaded == []
+
+def test_recovery_resumes_each_task_from_its_state(tmp_path):
+    """После перезапуска созданная задача только опрашивается, загруженная - только создается"""
+    api = FakeAPI()
+    path = str(tmp_path / "tasks.sqlite")
+    records = [
+        StoredTask(
+            record_id="submitted", state=STATE_SUBMITTED, api_key="k1",
+            product_file="k1-p", background_file="k1-b", task_id="task-old",
+            context={"chat_id": 1}
+        ),
+        StoredTask(
+            record_id="uploaded", state=STATE_UPLOADED, api_key="k2",
+            product_file="k2-p", background_file="k2-b", context={"chat_id": 2}
+        ),
+        StoredTask(
+            record_id="completed", state=STATE_COMPLETED,
+            result={"status": "SUCCESS", "output_urls": ["https://result/done.png"]},
+            context={"chat_id": 3}
+        ),
+    ]
+    results = asyncio.run(recover(make_queue(api, store=TaskStore(path)), records, 3))
+
+    assert [result["status"] for _, result in results] == ["SUCCESS"] * 3
+    assert results[0][1]["output_urls"] == ["https://result/task-old.png"]
+    # Задача, уже созданная в RunningHub, не отправляется повторно
+    assert api.created == ["k2"]
+    assert api.uploaded == []
+    # Доставленные задачи больше не восстанавливаются
+    store = TaskStore(path)
+    assert store.load_unfinished() == []
+    assert all(
+        state == STATE_DELIVERED
+        for (state,) in store._db.execute("SELECT state FROM tasks").fetchall()
+    )
+
+def test_recovered_preuploaded_task_reserves_its_account(tmp_path):
+    """Восстановленная задача с заранее загруженным фото резервирует свой аккаунт"""
+    api = FakeAPI()
+    queue = make_queue(api, store=TaskStore(str(tmp_path / "tasks.sqlite")))
+    # Резерв другой задачи не должен сниматься восстановленной
+    queue.account_manager.reserve_account("k1")
+    record = StoredTask(
+        record_id="preuploaded", state=STATE_QUEUED, api_key="k1", product_file="k1-p",
+        product_image_url="https://example.com/product.png",
+        background_image_url="https://example.com/background.png",
+        context={"chat_id": 1}
+    )
+    reserved = before_stop(queue, lambda: queue.account_manager.account_status["k1"].reserved)
+    results = asyncio.run(recover(queue, [record], 1))
+    assert results[0][1]["status"] == "SUCCESS"
+    assert api.uploaded == ["https://example.com/background.png"]
+    assert reserved == [1]
+
+def test_identical_requests_share_one_generation(monkeypatch):
+    """Одинаковые запросы, пришедшие одновременно, выполняются в RunningHub один раз"""
+    monkeypatch.setattr(config.runninghub, "dedup_requests", True)
+    api = FakeAPI()
+    queue = make_queue(api)
+
+    async def scenario():
+        results = []
+        done = asyncio.Event()
+
+        async def callback(result):
+            results.append(result)
+            if len(results) == 2:
+                done.set()
+
+        await queue.start()
+        try:
+            for chat_id in (1, 2):
+                await queue.add_task("https://p.png", "https://b.png", callback, context={"chat_id": chat_id})
+            await asyncio.wait_for(done.wait(), timeout=10)
+        finally:
+            await queue.stop()
+        return results
+
+    results = asyncio.run(scenario())
+    assert len(api.created) == 1
+    assert results[0]["task_id"] == results[1]["task_id"]
+
+@pytest.fixture
+def hedging(monkeypatch):
+    settings = config.runninghub
+    monkeypatch.setattr(settings, "hedging", True)
+    monkeypatch.setattr(settings, "hedge_min_delay", 0.2)
+    monkeypatch.setattr(settings, "hedge_ratio", 0.1)
+    monkeypatch.setattr(settings, "poll_rate_per_account", 1000)
+
+def slots(queue):
+    """Занятые слоты аккаунтов и задачи на опросе"""
+    status = queue.account_manager.account_status
+    return status["k1"].active_tasks, status["k2"].active_tasks, queue.poller.in_flight
+
+# Задачи закрепляются за k1 через уже загруженные файлы
+ON_K1 = {"api_key": "k1", "product_file": "k1-p", "background_file": "k1-b"}
+
+def test_stuck_task_is_hedged_after_delay(hedging):
+    """Задача, застрявшая в очереди RunningHub, дублируется на другом аккаунте, побеждает дубль"""
+    api = QueuedAPI(stuck={"k2": 0})
+    queue = make_queue(api)
+    state = before_stop(queue, lambda: slots(queue))
+    (result,) = asyncio.run(run_tasks(queue, 1, **ON_K1))
+
+    assert api.created == ["k1", "k2"]
+    (_, primary_at), (_, hedge_at) = api.tasks["task-1"], api.tasks["task-2"]
+    assert hedge_at - primary_at >= config.runninghub.hedge_min_delay
+    assert result["status"] == "SUCCESS"
+    assert (result["api_key"], result["task_id"]) == ("k2", "task-2")
+    # Проигравший запуск снят с опроса, слоты обоих аккаунтов свободны
+    assert state == [(0, 0, 0)]
+
+def test_primary_result_wins_over_hedge(hedging):
+    """Если исходная задача завершается первой, дубль бросается и его слот освобождается"""
+    api = QueuedAPI(stuck={"k1": 0.4})
+    queue = make_queue(api)
+    state = before_stop(queue, lambda: slots(queue))
+    (result,) = asyncio.run(run_tasks(queue, 1, **ON_K1))
+
+    assert api.created == ["k1", "k2"]
+    assert (result["api_key"], result["task_id"]) == ("k1", "task-1")
+    assert state == [(0, 0, 0)]
+
+@pytest.mark.parametrize("ratio, hedges", [(0, 1), (1, 2)])
+def test_hedge_ratio_limits_hedges(hedging, monkeypatch, ratio, hedges):
+    """Бюджет дублирования пополняется на hedge_ratio с каждой отправленной задачей"""
+    monkeypatch.setattr(config.runninghub, "hedge_ratio", ratio)
+    monkeypatch.setattr(config.runninghub, "hedge_min_delay", 0.05)
+    api = QueuedAPI(stuck={"k1": 0.4})
+    results = asyncio.run(run_tasks(make_queue(api), 2, **ON_K1))
+
+    assert [result["api_key"] for result in results] == ["k1", "k1"]
+    assert api.created.count("k2") == hedges
+
+def test_poller_gives_up_after_task_timeout():
+    """Задача, не завершившаяся к дедлайну, снимается с опроса с результатом None"""
+    poller = TaskPoller(api=QueuedAPI(stuck={}), stats=LatencyStats())
+
+    async def scenario():
+        started = time.monotonic()
+        try:
+            outputs = await poller.wait_for_outputs("k1", "stuck", timeout=0.2)
+        finally:
+            await poller.stop()
+        return outputs, time.monotonic() - started
+
+    outputs, elapsed = asyncio.run(scenario())
+    assert outputs is None
+    assert 0.2 <= elapsed < 1
+    assert poller.in_flight == 0
+
+def test_poller_throttles_each_account(monkeypatch):
+    """Опрос каждого аккаунта ограничен своим token bucket"""
+    rate = 10
+    monkeypatch.setattr(config.runninghub, "poll_rate_per_account", rate)
+    api = QueuedAPI(stuck={})
+    poller = TaskPoller(api=api, stats=LatencyStats())
+
+    async def scenario():
+        for number in range(5):
+            poller.watch("k1", f"k1-{number}")
+        poller.watch("k2", "k2-0")
+        await asyncio.sleep(0.5)
+        await poller.stop()
+
+    started = time.monotonic()
+    asyncio.run(scenario())
+    elapsed = time.monotonic() - started
+    k1 = [at for api_key, at in api.polls if api_key == "k1"]
+    k2 = [at for api_key, at in api.polls if api_key == "k2"]
+    # Не больше запаса bucket и rate запросов в секунду
+    assert len(k1) <= rate + rate * elapsed + 1
+    # Пять задач k1 расходуют его bucket, но не задерживают опрос k2
+    assert len(k1) >= rate
+    assert k2 and k2[0] - started < 0.2
@@ -0,0 +1,37 @@
+import sys
+import os
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import time
+
+from services.runninghub import UploadCache
+
+def test_entries_are_per_account_and_evicted_lru():
+    """fileName действителен только для своего аккаунта, лишние записи вытесняются по LRU"""
+    cache = UploadCache(max_entries=2)
+
+    async def scenario():
+        await cache.put("a", "k1", "a-on-k1")
+        await cache.put("b", "k1", "b-on-k1")
+        assert cache.get("a", "k1") == "a-on-k1"
+        await cache.put("c", "k1", "c-on-k1")
+
+    asyncio.run(scenario())
+    assert cache.get("a", "k2") is None
+    assert cache.get("b", "k1") is None
+    assert cache.get("a", "k1") == "a-on-k1"
+    assert cache.get("c", "k1") == "c-on-k1"
+
+def test_entries_survive_restart_until_ttl(tmp_path):
+    """Записи из SQLite загружаются после перезапуска, истекшие - нет"""
+    path = str(tmp_path / "uploads.sqlite")
+    asyncio.run(UploadCache(path=path).put("a", "k1", "a-on-k1"))
+    asyncio.run(UploadCache(path=path, ttl=0.01).put("b", "k1", "b-on-k1"))
+    time.sleep(0.02)
+
+    restarted = UploadCache(path=path)
+    assert restarted.get("a", "k1") == "a-on-k1"
+    assert restarted.get("b", "k1") is None